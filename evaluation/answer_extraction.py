@@ -0,0 +1,157 @@
+"""Vectorized extraction of numeric answers from model responses.
+
+Responses don't always follow the requested `<answer>...</answer>` format:
+closing tags get truncated ('<answer>8.4</answer') or misspelled
+('</aanswer>', '</stranswer>'), answers come as percentages, with thousands
+separators, in scientific notation or as ranges, a response can hold several
+answer tags, and some have no tags at all. `extract_answers` parses whole
+columns of responses at once with compiled (RE2) regular expressions over
+Arrow string arrays, and gives every response a parse status, so that each
+failure is accounted for:
+
+  * 'ok': a number within proper answer tags,
+  * 'percent': a percentage (converted to a fraction for probabilities),
+  * 'range': a range such as '10-20' or '10 to 20', taken at its midpoint,
+  * 'multiple': several answer tags, of which the last is taken,
+  * 'unclosed': an answer tag without a proper closing tag,
+  * 'untagged': no answer tag, so the last number of the response is taken,
+  * 'no_number': no number where the answer should be, and
+  * 'empty': a missing (None or NaN) or blank response.
+
+A response with several of these takes the first status in this list that
+isn't 'ok', read from the end ('empty' first). The `pyarrow` and `pandas`
+packages are needed.
+"""
+
+PARSE_STATUSES = (
+    'ok',
+    'percent',
+    'range',
+    'multiple',
+    'unclosed',
+    'untagged',
+    'no_number',
+    'empty',
+)
+
+# Statuses whose values are taken from a proper answer tag
+TAGGED_STATUSES = ('ok', 'percent', 'range', 'multiple')
+
+_NUMBER = r'[-\x{2212}]?(?:\d[\d,]*(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+
+# The last answer tags, since a response may restate or correct its answer
+_TAGGED = r'(?is).*<answer>(?P<body>.*?)</answer>'
+# The text after the last opening tag, up to a malformed closing tag
+_OPENED = r'(?is).*<answer>(?P<body>[^<]*)'
+# The last number, i.e., one followed by no other digits
+_LAST_NUMBER = rf'(?s)(?P<body>{_NUMBER})\D*$'
+_RANGE = (
+    rf'(?i)(?P<low>{_NUMBER})\s*(?:-|\x{{2013}}|\x{{2014}}|to)\s*'
+    rf'(?P<high>{_NUMBER})'
+)
+_VALUE = rf'(?P<number>{_NUMBER})(?P<percent>\s*%)?'
+_OPEN_TAG = r'(?i)<answer>'
+
+
+def _to_float(strings):
+  """Casts matched number strings (or nulls) to float64."""
+  import pyarrow as pa
+  import pyarrow.compute as pc
+
+  strings = pc.replace_substring(strings, ',', '')
+  strings = pc.replace_substring(strings, '\N{MINUS SIGN}', '-')
+  return pc.cast(strings, pa.float64())
+
+
+def _field(array, pattern, name):
+  """Returns a named group of a regex match, null where it didn't match."""
+  import pyarrow.compute as pc
+
+  matches = pc.extract_regex(array, pattern)
+  return pc.if_else(pc.is_valid(matches), matches.field(name), None)
+
+
+def _mask(array):
+  """Returns a boolean array as a numpy mask, with nulls as False."""
+  import pyarrow.compute as pc
+
+  return pc.fill_null(array, False).to_numpy(zero_copy_only=False)
+
+
+def extract_answers(responses, task=None):
+  """Extracts the numeric answers of many responses at once.
+
+  Args:
+    responses: A sequence of response texts (None or NaN where missing),
+      such as a list, a pandas Series or a pyarrow string array.
+    task: The responses' task. For 'probabilities', percentages are
+      converted to fractions.
+
+  Returns:
+    A pandas DataFrame with a row per response (with the Series' index, if
+    given one) and the `value` (NaN where none was found) and the `status`
+    (a categorical of `PARSE_STATUSES`) columns.
+  """
+  import numpy as np
+  import pandas as pd
+  import pyarrow as pa
+  import pyarrow.compute as pc
+
+  index = responses.index if isinstance(responses, pd.Series) else None
+  if isinstance(responses, pa.ChunkedArray):
+    responses = responses.combine_chunks()
+  if not isinstance(responses, pa.Array):
+    # Missing entries may be None or, in pandas and numpy, NaN
+    responses = pa.array(
+        responses if hasattr(responses, 'dtype') else list(responses),
+        pa.string(),
+        from_pandas=True,
+    )
+  responses = pc.cast(responses, pa.string())
+
+  tagged = _field(responses, _TAGGED, 'body')
+  opened = _field(responses, _OPENED, 'body')
+  body = pc.coalesce(
+      tagged, opened, _field(responses, _LAST_NUMBER, 'body')
+  )
+  low = _to_float(_field(body, _RANGE, 'low'))
+  high = _to_float(_field(body, _RANGE, 'high'))
+  number = _to_float(_field(body, _VALUE, 'number'))
+  # An unmatched optional group is extracted as ''
+  percent_sign = _field(body, _VALUE, 'percent')
+  percent = _mask(pc.greater(pc.utf8_length(percent_sign), 0))
+  is_range = _mask(pc.is_valid(low))
+
+  midpoint = pc.divide(pc.add(low, high), 2.0)
+  values = pc.if_else(is_range, midpoint, number).to_numpy(
+      zero_copy_only=False
+  ).astype(float)
+  percent &= ~is_range
+  if task == 'probabilities':
+    values = np.where(percent, values / 100, values)
+
+  empty = ~_mask(
+      pc.greater(pc.utf8_length(pc.utf8_trim_whitespace(responses)), 0)
+  )
+  conditions = [
+      empty,
+      np.isnan(values),
+      ~_mask(pc.is_valid(opened)),
+      ~_mask(pc.is_valid(tagged)),
+      _mask(pc.greater(pc.count_substring_regex(responses, _OPEN_TAG), 1)),
+      is_range,
+      percent,
+  ]
+  codes = np.select(
+      conditions,
+      [PARSE_STATUSES.index(s) for s in PARSE_STATUSES[:0:-1]],
+      default=0,
+  )
+  values[empty] = np.nan
+  return pd.DataFrame(
+      {
+          'value': values,
+          'status': pd.Categorical.from_codes(codes, PARSE_STATUSES),
+      },
+      index=index,
+  )
@@ -0,0 +1,290 @@
+"""Ground-truth CDFs and quantile functions of the evaluated distributions.
+
+Scoring a percentile answer needs the true percentile of the queried value,
+and scoring samples needs the true CDF. An oracle answers both for whole
+arrays at once, so that a group's answers are scored with one call:
+
+  * 'analytic' oracles use the scipy.stats form of an idealized family (see
+    `idealized_distributions.scipy_distribution`), with the parameters of
+    its `distribution_questions_config` entry by default,
+  * 'samples' oracles use the sorted reference samples the generators draw
+    (with the same seed and sample size), which reproduce the sample-based
+    answers of the question tables exactly. They are cached per family and
+    parameters, and are the fallback for families without an analytic form.
+  * 'table' oracles interpolate monotonically (PCHIP) over the percentile
+    tables of the real-world ground truths (`health_gt_dict`,
+    `finance_gt_dict` and `climate_gt_dict`).
+"""
+
+import json
+
+import numpy as np
+
+from generation.idealized_generation import idealized_distributions
+from generation.idealized_generation import idealized_generation
+
+DEFAULT_SAMPLE_SIZE = 100000
+DEFAULT_SEED = 1337
+
+_SAMPLES_CACHE = {}
+
+
+def _family_config(dist_name):
+  for config in idealized_generation.distribution_questions_config:
+    if config['name'] == dist_name:
+      return config
+  names = [
+      c['name'] for c in idealized_generation.distribution_questions_config
+  ]
+  raise ValueError(
+      f'Unknown distribution: {dist_name}. Please pick from {names}.'
+  )
+
+
+def reference_samples(
+    dist_name,
+    params=None,
+    outcome_num=None,
+    sample_size=DEFAULT_SAMPLE_SIZE,
+    seed=DEFAULT_SEED,
+):
+  """Returns the sorted reference samples of an idealized family (cached).
+
+  Args:
+    dist_name: The family's name in `distribution_questions_config`.
+    params: Its parameters. Defaults to those of its config.
+    outcome_num: The (1-based) outcome of a multinomial distribution.
+    sample_size: The number of samples, as in the generators.
+    seed: The generators' random seed.
+
+  Returns:
+    A sorted, read-only numpy array of the samples.
+
+  Raises:
+    ValueError: If the family is unknown, or a multinomial's outcome_num is
+      missing.
+  """
+  config = _family_config(dist_name)
+  params = config['params'] if params is None else params
+  key = (
+      dist_name,
+      json.dumps(params, sort_keys=True),
+      outcome_num,
+      sample_size,
+      seed,
+  )
+  if key not in _SAMPLES_CACHE:
+    _, samples = config['func'](
+        **params,
+        sample_size=sample_size,
+        task='sampling',
+        seed=seed,
+        debug=False,
+        approximate_as_normal=False,
+    )
+    if isinstance(samples, dict):
+      if outcome_num is None:
+        raise ValueError('Please pass the outcome_num of a multinomial.')
+      samples = samples[f'Outcome {outcome_num}']
+    samples = np.sort(np.asarray(samples, dtype=float))
+    samples.flags.writeable = False
+    _SAMPLES_CACHE[key] = samples
+  return _SAMPLES_CACHE[key]
+
+
+def samples_oracle(samples, name=None):
+  """Returns the oracle of an empirical distribution.
+
+  The CDF is the fraction of samples at or below each value, and quantiles
+  interpolate linearly between samples (as `np.percentile` does, which the
+  question tables were computed with).
+
+  Args:
+    samples: The samples, in any order.
+    name: An optional name for the oracle.
+
+  Returns:
+    An oracle for `cdf` and `ppf`.
+  """
+  samples = np.sort(np.asarray(samples, dtype=float))
+  return {
+      'name': name,
+      'kind': 'samples',
+      'cdf': lambda x: (
+          np.searchsorted(samples, x, side='right') / len(samples)
+      ),
+      'ppf': lambda q: np.quantile(samples, q),
+  }
+
+
+def family_oracle(
+    dist_name,
+    params=None,
+    outcome_num=None,
+    method='analytic',
+    sample_size=DEFAULT_SAMPLE_SIZE,
+    seed=DEFAULT_SEED,
+):
+  """Returns the oracle of an idealized distribution family.
+
+  Args:
+    dist_name: The family's name in `distribution_questions_config`, e.g.,
+      'normal' or 'multinomial'.
+    params: Its parameters. Defaults to those of its config.
+    outcome_num: The (1-based) outcome of a multinomial distribution.
+    method: 'analytic' for the scipy.stats form (falling back to reference
+      samples where there is none), or 'samples' for the reference samples.
+    sample_size: The number of reference samples.
+    seed: The reference samples' random seed.
+
+  Returns:
+    An oracle for `cdf` and `ppf`.
+
+  Raises:
+    ValueError: If the family or method is unknown, or a multinomial's
+      outcome_num is missing.
+  """
+  if method not in ('analytic', 'samples'):
+    raise ValueError(
+        f"Unknown method: {method}. Please pick 'analytic' or 'samples'."
+    )
+  config = _family_config(dist_name)
+  params = config['params'] if params is None else params
+  if dist_name == 'multinomial' and outcome_num is None:
+    raise ValueError('Please pass the outcome_num of a multinomial.')
+  name = dist_name if outcome_num is None else f'{dist_name}_{outcome_num}'
+  if method == 'analytic':
+    try:
+      dist = idealized_distributions.scipy_distribution(
+          dist_name, params, outcome_num
+      )
+    except ValueError:
+      dist = None
+    if dist is not None:
+      return {
+          'name': name,
+          'kind': 'analytic',
+          'cdf': dist.cdf,
+          'ppf': dist.ppf,
+      }
+  return samples_oracle(
+      reference_samples(dist_name, params, outcome_num, sample_size, seed),
+      name,
+  )
+
+
+def table_oracle(percentile_values, name=None):
+  """Returns the oracle of a percentile table.
+
+  The CDF is a monotone cubic (PCHIP) interpolation of the table's points,
+  and the quantile function interpolates them the other way around, so both
+  are monotone and exact at the table's points. Beyond the table's first
+  and last points, they are held at those points.
+
+  Args:
+    percentile_values: A dict of values keyed by percentile (in [0, 100]),
+      such as a ground-truth table's `target_percentile_values`.
+    name: An optional name for the oracle.
+
+  Returns:
+    An oracle for `cdf` and `ppf`.
+
+  Raises:
+    ValueError: If the table has fewer than two points, or its values don't
+      increase with its percentiles.
+  """
+  import scipy.interpolate
+
+  points = sorted(percentile_values.items())
+  qs = np.array([p for p, _ in points], dtype=float) / 100
+  values = np.array([v for _, v in points], dtype=float)
+  if len(points) < 2 or np.any(np.diff(values) <= 0):
+    raise ValueError(
+        'A percentile table needs at least two points, with values that'
+        ' increase with their percentiles.'
+    )
+  cdf_spline = scipy.interpolate.PchipInterpolator(values, qs)
+  ppf_spline = scipy.interpolate.PchipInterpolator(qs, values)
+  return {
+      'name': name,
+      'kind': 'table',
+      'cdf': lambda x: cdf_spline(np.clip(x, values[0], values[-1])),
+      'ppf': lambda q: ppf_spline(np.clip(q, qs[0], qs[-1])),
+  }
+
+
+def real_world_tables():
+  """Returns the real-world ground-truth tables, keyed by name.
+
+  Names are those of the tables, e.g., 'Average Step Count'.
+  """
+  from generation.real_world_generation import real_world_prompt_generator
+
+  return {
+      **real_world_prompt_generator.health_gt_dict,
+      **real_world_prompt_generator.finance_gt_dict,
+      **real_world_prompt_generator.climate_gt_dict,
+  }
+
+
+def _table_key(name):
+  return name.lower().replace(' ', '_')
+
+
+def real_world_oracle(name):
+  """Returns the oracle of a real-world distribution's ground truth.
+
+  Args:
+    name: The distribution's table name (e.g., 'Average Step Count') or
+      prompt group name (e.g., 'average_step_count').
+
+  Returns:
+    An oracle for `cdf` and `ppf`.
+
+  Raises:
+    ValueError: If there is no ground truth of that name.
+  """
+  tables = {_table_key(k): (k, v) for k, v in real_world_tables().items()}
+  if _table_key(name) not in tables:
+    raise ValueError(
+        f'Unknown real-world distribution: {name}. Please pick from'
+        f' {[k for k, _ in tables.values()]}.'
+    )
+  table_name, table = tables[_table_key(name)]
+  return table_oracle(table['target_percentile_values'], table_name)
+
+
+def question_oracles(method='analytic'):
+  """Returns the oracles of every idealized question family.
+
+  Args:
+    method: 'analytic' or 'samples' (see `family_oracle`).
+
+  Returns:
+    A dict of oracles keyed by family name, with a multinomial's outcomes
+    keyed as 'multinomial_1', 'multinomial_2', and so on.
+  """
+  oracles = {}
+  for config in idealized_generation.distribution_questions_config:
+    if config['name'] == 'multinomial':
+      for outcome_num in range(1, len(config['params']['probs']) + 1):
+        oracle = family_oracle(config['name'], None, outcome_num, method)
+        oracles[oracle['name']] = oracle
+    else:
+      oracles[config['name']] = family_oracle(config['name'], method=method)
+  return oracles
+
+
+def cdf(oracle, values):
+  """Returns the true CDF at each value, as a numpy array in [0, 1]."""
+  return np.asarray(oracle['cdf'](np.asarray(values, dtype=float)), float)
+
+
+def ppf(oracle, qs):
+  """Returns the true quantile of each probability in [0, 1]."""
+  return np.asarray(oracle['ppf'](np.asarray(qs, dtype=float)), float)
+
+
+def percentiles(oracle, values):
+  """Returns the true percentile of each value (in [0, 100])."""
+  return 100 * cdf(oracle, values)
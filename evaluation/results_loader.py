@@ -0,0 +1,175 @@
+"""A parallel, column-pruned loader of result CSVs.
+
+The notebook's `load_all_dataframes` reads every result CSV in full, file by
+file, although scoring mostly needs only the `answer` column (and sometimes
+`reasoning`), while every row repeats the whole prompt text. `load_results`
+picks the files by their name's metadata before opening any, reads only the
+requested columns on a pool of worker processes, and returns one frame with
+the metadata as columns, using categoricals for the repeated strings.
+
+For repeated analyses of the same results, `results_store` converts them
+once into a Parquet dataset instead.
+"""
+
+import concurrent.futures
+import os
+
+from generation.corpus import prompt_records
+from inference import results_csv
+
+DEFAULT_COLUMNS = ('answer',)
+
+# The metadata columns, in frame order, and their dtypes
+_METADATA_DTYPES = {
+    'model': 'category',
+    'group': 'category',
+    'task': 'category',
+    'num_shots': 'int16',
+    'dist_name': 'category',
+    'outcome': 'Int16',
+    'sample_count': 'int32',
+    'context': 'category',
+}
+
+
+def _matches(value, wanted):
+  """Returns whether a value is wanted: None, one value or a collection."""
+  if wanted is None:
+    return True
+  if isinstance(wanted, (list, tuple, set, frozenset)):
+    return value in wanted
+  return value == wanted
+
+
+def list_result_files(root, model=None, task=None, shots=None, **metadata):
+  """Lists result CSVs by the metadata in their names, without reading them.
+
+  Args:
+    root: A directory (searched recursively), a glob pattern, or a list of
+      CSV paths named '<model>_<group>.csv'.
+    model: The model name(s) to keep, e.g., 'Gpt4Turbo' (None for all).
+    task: The task(s) to keep, e.g., 'sampling' (None for all).
+    shots: The number(s) of shots to keep (None for all).
+    **metadata: Other `prompt_records.parse_prompt_name` fields to filter
+      on, e.g., `dist_name='normal'` or `context='real_world'`.
+
+  Returns:
+    A list of (path, metadata) tuples, sorted by model and group, where the
+    metadata has the `model`, the `group` and its parsed name fields. Files
+    named otherwise are left out.
+  """
+  wanted = {'model': model, 'task': task, 'num_shots': shots, **metadata}
+  files = []
+  for path in results_csv.find_results_csvs(root):
+    name = results_csv.parse_results_csv_name(path)
+    if name is None:
+      continue
+    try:
+      file_metadata = prompt_records.parse_prompt_name(name[1])
+    except ValueError:
+      continue
+    file_metadata = {'model': name[0], 'group': name[1], **file_metadata}
+    if all(_matches(file_metadata[k], v) for k, v in wanted.items()):
+      files.append((path, file_metadata))
+  return sorted(files, key=lambda file: (file[1]['model'], file[1]['group']))
+
+
+def _read_columns(path, columns):
+  """Reads some columns of a result CSV as strings ('' where empty)."""
+  import pandas as pd
+
+  return pd.read_csv(
+      path,
+      usecols=list(columns),
+      dtype=str,
+      keep_default_na=False,
+  )
+
+
+def load_results(
+    root,
+    model=None,
+    task=None,
+    shots=None,
+    columns=DEFAULT_COLUMNS,
+    workers=None,
+    **metadata,
+):
+  """Loads result CSVs into one DataFrame.
+
+  For example, `load_results('sample_results_from_paper', model='Gpt4Turbo',
+  task='percentiles', shots=(0, 1))` replaces the notebook's
+  `load_all_dataframes`.
+
+  Args:
+    root: A directory (searched recursively), a glob pattern, or a list of
+      CSV paths named '<model>_<group>.csv'.
+    model: The model name(s) to load (None for all).
+    task: The task(s) to load (None for all).
+    shots: The number(s) of shots to load (None for all).
+    columns: The CSV columns to read, of 'prompt', 'answer' and
+      'reasoning'. The others aren't materialized.
+    workers: The number of worker processes. Defaults to the CPU count; 1
+      reads in-process.
+    **metadata: Other file name fields to filter on (see
+      `list_result_files`).
+
+  Returns:
+    A DataFrame with the metadata columns (`model`, `group`, `task`,
+    `num_shots`, `dist_name`, `outcome`, `sample_count` and `context`)
+    followed by the requested columns as strings, with a row per result
+    row, ordered by model, group and row.
+
+  Raises:
+    ValueError: If a requested column is not a result column.
+  """
+  import numpy as np
+  import pandas as pd
+
+  unknown = [c for c in columns if c not in results_csv.CSV_COLUMNS]
+  if unknown:
+    raise ValueError(
+        f'Unknown result columns: {unknown}. Please pick from'
+        f' {results_csv.CSV_COLUMNS}.'
+    )
+  files = list_result_files(root, model, task, shots, **metadata)
+  paths = [path for path, _ in files]
+  workers = workers or os.cpu_count() or 1
+  if workers > 1 and len(paths) > 1:
+    chunksize = max(1, len(paths) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(workers, len(paths))
+    ) as executor:
+      frames = list(
+          executor.map(
+              _read_columns,
+              paths,
+              [columns] * len(paths),
+              chunksize=chunksize,
+          )
+      )
+  else:
+    frames = [_read_columns(path, columns) for path in paths]
+
+  lengths = [len(frame) for frame in frames]
+  data = {}
+  for column, dtype in _METADATA_DTYPES.items():
+    values = [file_metadata[column] for _, file_metadata in files]
+    if dtype == 'category':
+      categories = sorted({v for v in values if v is not None})
+      codes = [categories.index(v) if v is not None else -1 for v in values]
+      data[column] = pd.Categorical.from_codes(
+          np.repeat(np.array(codes, dtype=np.int32), lengths), categories
+      )
+    else:
+      data[column] = pd.array(
+          np.repeat(np.array(values, dtype=object), lengths), dtype=dtype
+      )
+  frame = pd.DataFrame(data)
+  for column in columns:
+    frame[column] = (
+        pd.concat([f[column] for f in frames], ignore_index=True)
+        if frames
+        else pd.Series([], dtype=str)
+    )
+  return frame
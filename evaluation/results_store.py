@@ -0,0 +1,259 @@
+"""A columnar store of result CSVs.
+
+Result CSVs repeat the whole prompt text on every row, and their metadata
+is only in the file names, so loading them means re-parsing megabytes of
+repeated text and re-deriving the metadata file by file. A results store
+converts result directories once into a Parquet dataset of two tables:
+
+  * `results/`: one row per response, partitioned by task (hive-style, e.g.,
+    'results/task=sampling/'), with the file name metadata as typed columns
+    (`model`, `group`, `num_shots`, `dist_name`, `outcome`, `sample_count`
+    and the real-world template `context`), the `prompt_id` of its prompt,
+    its `repeat` index within the prompt's rows, the `answer`, the numeric
+    `value` and parse `status` from `answer_extraction`, and the full
+    `reasoning`.
+  * `prompts.parquet`: one row per distinct prompt text, with its
+    `prompt_id` and `text_hash`.
+
+Repeated strings are dictionary-encoded (and load as pandas categoricals),
+so reading and filtering every result takes milliseconds. A `manifest.json`
+with the sources and counts is written last, so a store without one is
+incomplete. The `pyarrow` package is needed.
+"""
+
+import json
+import math
+import os
+import shutil
+
+from evaluation import answer_extraction
+from generation.corpus import corpus_export
+from generation.corpus import prompt_records
+from inference import results_csv
+
+MANIFEST_NAME = 'manifest.json'
+STORE_VERSION = 2
+RESULTS_DIR = 'results'
+PROMPTS_NAME = 'prompts.parquet'
+
+# The columns results are partitioned by
+PARTITION_COLUMNS = ('task',)
+
+
+def _results_schema():
+  import pyarrow as pa
+
+  category = pa.dictionary(pa.int32(), pa.string())
+  return pa.schema([
+      ('model', category),
+      ('group', category),
+      ('task', category),
+      ('num_shots', pa.int16()),
+      ('dist_name', category),
+      ('outcome', pa.int16()),
+      ('sample_count', pa.int32()),
+      ('context', category),
+      ('prompt_id', pa.int32()),
+      ('repeat', pa.int32()),
+      ('answer', pa.string()),
+      ('value', pa.float64()),
+      ('status', category),
+      ('reasoning', pa.string()),
+  ])
+
+
+def ingest_results(results, store_dir, compression_level=10):
+  """Converts result CSVs into a results store.
+
+  Args:
+    results: A directory (searched recursively), a glob pattern, or a list
+      of CSV paths named '<model>_<group>.csv' (see
+      `results_csv.find_results_csvs`), e.g., `sample_results_from_paper`
+      or a `checkpoint` job directory.
+    store_dir: The directory to write the store to. An existing store there
+      is replaced.
+    compression_level: The zstd compression level.
+
+  Returns:
+    manifest: The manifest dict that was written to `manifest.json`. Files
+      whose names are not in the result naming schemes are listed under
+      `skipped`.
+  """
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  os.makedirs(store_dir, exist_ok=True)
+  # A stale manifest would make a partially rewritten store look complete
+  manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+  results_dir = os.path.join(store_dir, RESULTS_DIR)
+  if os.path.exists(results_dir):
+    shutil.rmtree(results_dir)
+
+  files = []
+  skipped = []
+  for path in sorted(results_csv.find_results_csvs(results)):
+    name = results_csv.parse_results_csv_name(path)
+    try:
+      metadata = name and prompt_records.parse_prompt_name(name[1])
+    except ValueError:
+      metadata = None
+    if metadata:
+      files.append((*name, path, metadata))
+    else:
+      skipped.append(path)
+  # Rows sorted by model and group give each row group tight statistics
+  # for filter pushdown
+  files.sort(key=lambda file: file[:2])
+
+  schema = _results_schema()
+  columns = {name: [] for name in schema.names}
+  prompt_ids = {}
+  sources = []
+  csv_bytes = 0
+  for model, group, path, metadata in files:
+    rows = results_csv.read_results_csv(path)
+    # Rows without a `reasoning` only have the answer text
+    answers = answer_extraction.extract_answers(
+        [row.get('reasoning') or row.get('answer') for row in rows],
+        metadata['task'],
+    )
+    repeats = {}
+    for row, answer_value, status in zip(
+        rows, answers['value'], answers['status']
+    ):
+      prompt = row['prompt']
+      prompt_id = prompt_ids.setdefault(prompt, len(prompt_ids))
+      repeat = repeats.get(prompt_id, 0)
+      repeats[prompt_id] = repeat + 1
+      for column, value in (
+          ('model', model),
+          ('group', group),
+          ('task', metadata['task']),
+          ('num_shots', metadata['num_shots']),
+          ('dist_name', metadata['dist_name']),
+          ('outcome', metadata['outcome']),
+          ('sample_count', metadata['sample_count']),
+          ('context', metadata['context']),
+          ('prompt_id', prompt_id),
+          ('repeat', repeat),
+          ('answer', row.get('answer') or ''),
+          ('value', None if math.isnan(answer_value) else answer_value),
+          ('status', status),
+          ('reasoning', row.get('reasoning') or ''),
+      ):
+        columns[column].append(value)
+    csv_bytes += os.path.getsize(path)
+    sources.append({
+        'path': path,
+        'model': model,
+        'group': group,
+        'rows': len(rows),
+    })
+
+  table = pa.Table.from_pydict(columns, schema=schema)
+  pq.write_to_dataset(
+      table,
+      results_dir,
+      partition_cols=list(PARTITION_COLUMNS),
+      basename_template='part-{i}.parquet',
+      compression='zstd',
+      compression_level=compression_level,
+  )
+  prompts = list(prompt_ids)
+  pq.write_table(
+      pa.table({
+          'prompt_id': pa.array(range(len(prompts)), pa.int32()),
+          'text_hash': [corpus_export.text_hash(p) for p in prompts],
+          'prompt': prompts,
+      }),
+      os.path.join(store_dir, PROMPTS_NAME),
+      compression='zstd',
+      compression_level=compression_level,
+  )
+
+  store_bytes = sum(
+      os.path.getsize(os.path.join(root, file_name))
+      for root, _, file_names in os.walk(store_dir)
+      for file_name in file_names
+  )
+  manifest = {
+      'format_version': STORE_VERSION,
+      'partition_by': list(PARTITION_COLUMNS),
+      'compression': {'codec': 'zstd', 'level': compression_level},
+      'counts': {
+          'files': len(sources),
+          'rows': table.num_rows,
+          'prompts': len(prompts),
+          'models': len({source['model'] for source in sources}),
+          'groups': len({source['group'] for source in sources}),
+          'csv_bytes': csv_bytes,
+          'store_bytes': store_bytes,
+      },
+      'sources': sources,
+      'skipped': skipped,
+  }
+  with open(manifest_path, 'w') as f:
+    json.dump(manifest, f, indent=2)
+  return manifest
+
+
+def read_store_manifest(store_dir):
+  """Reads the manifest of a results store."""
+  with open(os.path.join(store_dir, MANIFEST_NAME)) as f:
+    return json.load(f)
+
+
+def read_results(store_dir, columns=None, filters=None, with_prompts=False):
+  """Reads results from a results store as a pandas DataFrame.
+
+  Args:
+    store_dir: The store directory.
+    columns: The columns to read (all by default). Reading fewer is faster;
+      `reasoning` is by far the largest.
+    filters: Optional row filters in the `pyarrow.parquet.read_table`
+      format, e.g., `[('model', '=', 'Gpt4Turbo'), ('num_shots', '<=', 3)]`.
+      Filters on the task skip whole partitions, and the others skip row
+      groups by their statistics.
+    with_prompts: Whether to add each row's `prompt` text.
+
+  Returns:
+    A DataFrame with a row per response, whose repeated strings are
+    categoricals.
+
+  Raises:
+    FileNotFoundError: If the store is missing or incomplete.
+  """
+  import pyarrow.parquet as pq
+
+  if not os.path.exists(os.path.join(store_dir, MANIFEST_NAME)):
+    raise FileNotFoundError(f'No complete results store in {store_dir}.')
+  if columns is not None and with_prompts and 'prompt_id' not in columns:
+    columns = list(columns) + ['prompt_id']
+  table = pq.read_table(
+      os.path.join(store_dir, RESULTS_DIR),
+      columns=columns,
+      filters=filters,
+      partitioning='hive',
+  )
+  if with_prompts:
+    # Prompt ids are the row numbers of the prompts table
+    prompts = pq.read_table(
+        os.path.join(store_dir, PROMPTS_NAME), columns=['prompt']
+    )
+    table = table.append_column(
+        'prompt', prompts['prompt'].take(table['prompt_id'])
+    )
+  return table.to_pandas()
+
+
+def read_prompts(store_dir):
+  """Returns a results store's prompt texts, indexed by `prompt_id`."""
+  import pyarrow.parquet as pq
+
+  return (
+      pq.read_table(os.path.join(store_dir, PROMPTS_NAME))
+      .to_pandas()
+      .set_index('prompt_id')
+  )
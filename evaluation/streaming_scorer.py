@@ -0,0 +1,600 @@
+"""Scores model responses as they arrive.
+
+The notebook scores a run once all of its result CSVs exist, so a prompt
+group that is broken (e.g., whose responses have no parseable answer) is
+only caught when a multi-hour run ends. The streaming scorer instead tails
+the result files while they are written (the append-only files of a
+`checkpoint` job directory, or any '<model>_<group>.csv' files), or consumes
+an iterator of responses, and keeps running metrics per model and group:
+
+  * the mean absolute error of percentile and probability answers, against
+    the exact answers computed from each prompt's text (see
+    `prompt_parser.true_answer`), or for real-world data, from its
+    ground-truth table (see `ground_truth.real_world_oracle`),
+  * the K-S statistic of the samples against the prompt's distribution, and
+  * the fraction of responses with a parseable answer, and the count of
+    each parse status (see `answer_extraction`).
+
+The metrics are sums and value counts, so they are updated in constant time
+per response and can be merged across files, groups or scorer processes
+(see `merge_metrics`). Snapshots of them, with alerts for groups that look
+broken, can be written to a JSON file or served over HTTP while a job runs.
+"""
+
+import asyncio
+import collections
+import json
+import math
+import os
+import statistics
+import time
+
+import numpy as np
+
+from evaluation import answer_extraction
+from evaluation import ground_truth
+from generation.corpus import corpus_export
+from generation.corpus import prompt_parser
+from generation.corpus import prompt_records
+from inference import results_csv
+
+# The responses a group needs before it can raise an alert
+DEFAULT_MIN_RESPONSES = 20
+
+# Groups with a lower fraction of parseable answers raise an alert
+DEFAULT_MIN_ANSWER_RATE = 0.5
+
+# The most bytes read from one result file per poll
+_MAX_READ_BYTES = 1 << 24
+
+# The most prompts whose ground truths are kept, least recently used first
+_MAX_CACHED_TRUTHS = 100000
+
+# The bytes before a tailed file's offset that are checked for changes
+_MARK_BYTES = 4096
+
+
+def prompt_truth(prompt, group=None):
+  """Returns a prompt's ground truth, computed from its text.
+
+  The percentiles of real-world data are taken from its ground-truth table
+  instead of the distribution the prompt describes (e.g., a normal
+  approximation), as in the paper.
+
+  Args:
+    prompt: A prompt's text.
+    group: The prompt's group name, if known.
+
+  Returns:
+    A dict with the `task` and either the exact `answer` (percentiles and
+    probabilities) or the frozen scipy.stats `dist` (sampling), or None if
+    the prompt can't be parsed.
+  """
+  parsed = prompt_parser.parse_prompt(prompt)
+  if parsed is None:
+    return None
+  try:
+    dist = prompt_parser.cached_distribution(parsed)
+  except ValueError:
+    return None
+  if parsed['task'] == 'sampling':
+    return {'task': 'sampling', 'dist': dist}
+  oracle = _real_world_oracle(group)
+  if oracle is not None and parsed['task'] == 'percentiles':
+    return {
+        'task': 'percentiles',
+        'answer': float(ground_truth.percentiles(oracle, parsed['target'])),
+    }
+  return {
+      'task': parsed['task'],
+      'answer': prompt_parser.true_answer(parsed, dist),
+  }
+
+
+def _real_world_oracle(group):
+  """Returns the ground-truth oracle of a real-world group, or None."""
+  try:
+    metadata = group and prompt_records.parse_prompt_name(group)
+  except ValueError:
+    return None
+  if not metadata or not metadata['context']:
+    return None
+  try:
+    return ground_truth.real_world_oracle(metadata['dist_name'])
+  except ValueError:
+    return None
+
+
+def make_scorer(
+    truth=prompt_truth,
+    min_responses=DEFAULT_MIN_RESPONSES,
+    min_answer_rate=DEFAULT_MIN_ANSWER_RATE,
+    max_errors=None,
+):
+  """Creates a streaming scorer.
+
+  Args:
+    truth: A function mapping a prompt's text and group name to its ground
+      truth (see `prompt_truth`), or None where it has none. Its results
+      are cached for the most recently scored prompts.
+    min_responses: The responses a group needs before it can raise an alert.
+    min_answer_rate: The fraction of parseable answers below which a group
+      raises an alert.
+    max_errors: An optional dict of the error above which a group raises an
+      alert, keyed by task (mean absolute error for percentiles and
+      probabilities, K-S statistic for sampling).
+
+  Returns:
+    scorer: A handle for `score_response`, `score_responses`, `snapshot` and
+      `tail_results_async`. Its `groups` dict maps each (model, group) to
+      its metrics.
+  """
+  return {
+      'truth': truth,
+      'truths': collections.OrderedDict(),
+      'groups': {},
+      'min_responses': min_responses,
+      'min_answer_rate': min_answer_rate,
+      'max_errors': max_errors or {},
+      'start': time.time(),
+  }
+
+
+def new_metrics(task):
+  """Returns the empty running metrics of a task's group."""
+  return {
+      'task': task,
+      'responses': 0,
+      'answered': 0,
+      'scored': 0,
+      'error_sum': 0.0,
+      'error_sq_sum': 0.0,
+      'values': collections.Counter(),
+      'dist': None,
+      'statuses': collections.Counter(),
+  }
+
+
+def merge_metrics(metrics, other):
+  """Returns the metrics of two groups' responses taken together.
+
+  The groups of sampling metrics should share their distribution; the first
+  one's is kept.
+  """
+  if metrics['task'] != other['task']:
+    raise ValueError(
+        f"Can't merge {metrics['task']} and {other['task']} metrics."
+    )
+  merged = new_metrics(metrics['task'])
+  for key in ('responses', 'answered', 'scored', 'error_sum', 'error_sq_sum'):
+    merged[key] = metrics[key] + other[key]
+  merged['values'] = metrics['values'] + other['values']
+  merged['statuses'] = metrics['statuses'] + other['statuses']
+  merged['dist'] = metrics['dist'] or other['dist']
+  return merged
+
+
+def _truth(scorer, group, prompt):
+  # Keyed by the prompt's hash, so that cached prompt texts aren't kept
+  truths = scorer['truths']
+  key = group, corpus_export.text_hash(prompt)
+  if key in truths:
+    truths.move_to_end(key)
+    return truths[key]
+  truth = scorer['truth'](prompt, group)
+  truths[key] = truth
+  if len(truths) > _MAX_CACHED_TRUTHS:
+    truths.popitem(last=False)
+  return truth
+
+
+def _task(group):
+  return group.split('_', 1)[0]
+
+
+def score_value(scorer, group, prompt, value, model='', status=None):
+  """Adds one parsed answer (None or NaN if unparseable) to its group.
+
+  Args:
+    scorer: A handle from `make_scorer`.
+    group: The prompt group, e.g., 'percentiles_zero_shot_normal_...'.
+    prompt: The prompt's text.
+    value: The parsed answer.
+    model: An optional model name, to score several models apart.
+    status: The answer's parse status (see `answer_extraction`), if known.
+  """
+  key = model, group
+  if key not in scorer['groups']:
+    scorer['groups'][key] = new_metrics(_task(group))
+  metrics = scorer['groups'][key]
+  metrics['responses'] += 1
+  if status is not None:
+    metrics['statuses'][status] += 1
+  if value is None or not math.isfinite(value):
+    return
+  metrics['answered'] += 1
+  truth = _truth(scorer, group, prompt)
+  if truth is None:
+    return
+  metrics['scored'] += 1
+  if truth['task'] == 'sampling':
+    metrics['values'][value] += 1
+    if metrics['dist'] is None:
+      metrics['dist'] = truth['dist']
+  else:
+    error = abs(value - truth['answer'])
+    metrics['error_sum'] += error
+    metrics['error_sq_sum'] += error * error
+
+
+def score_response(scorer, group, prompt, response, model=''):
+  """Adds one response to its group's metrics (see `score_value`)."""
+  answer = answer_extraction.extract_answers([response], _task(group))
+  score_value(
+      scorer,
+      group,
+      prompt,
+      answer['value'].iloc[0],
+      model,
+      answer['status'].iloc[0],
+  )
+
+
+def score_responses(scorer, responses, model=''):
+  """Scores an iterable of (group, prompt, response) tuples as they come."""
+  for group, prompt, response in responses:
+    score_response(scorer, group, prompt, response, model)
+
+
+def ks_statistic(values, dist):
+  """Returns the K-S statistic of samples against a distribution.
+
+  Args:
+    values: A dict of the sample counts keyed by value.
+    dist: A frozen scipy.stats distribution, continuous or discrete.
+
+  Returns:
+    The largest distance between the samples' empirical CDF and the
+    distribution's CDF, or None without samples.
+  """
+  if not values:
+    return None
+  points = np.array(sorted(values))
+  counts = np.array([values[v] for v in points], dtype=float)
+  below = np.cumsum(counts) - counts
+  n = counts.sum()
+  # The supremum is at a sample value, or just below one
+  return float(
+      max(
+          np.max(np.abs((below + counts) / n - dist.cdf(points))),
+          np.max(np.abs(below / n - prompt_parser.cdf_below(dist, points))),
+      )
+  )
+
+
+def summarize_metrics(metrics):
+  """Returns a group's metrics as a JSON-serializable summary.
+
+  The summary has the number of `responses`, the `answer_rate` (parseable
+  answers per response), the number of `scored` answers (those with a
+  ground truth), the count of each parse `statuses`, and either the `mae`
+  and its `mae_stderr` (percentiles and probabilities, in the answers'
+  units) or the `ks` statistic (sampling).
+  """
+  summary = {
+      'task': metrics['task'],
+      'responses': metrics['responses'],
+      'answer_rate': (
+          metrics['answered'] / metrics['responses']
+          if metrics['responses']
+          else None
+      ),
+      'scored': metrics['scored'],
+      'statuses': dict(metrics['statuses']),
+  }
+  scored = metrics['scored']
+  if metrics['task'] == 'sampling':
+    summary['ks'] = (
+        ks_statistic(metrics['values'], metrics['dist'])
+        if metrics['dist'] is not None
+        else None
+    )
+  elif scored:
+    mae = metrics['error_sum'] / scored
+    variance = max(metrics['error_sq_sum'] / scored - mae * mae, 0.0)
+    summary['mae'] = mae
+    summary['mae_stderr'] = math.sqrt(variance / scored)
+  else:
+    summary['mae'] = None
+    summary['mae_stderr'] = None
+  return summary
+
+
+def _alerts(scorer, summary):
+  """Returns the reasons a group's summary looks broken."""
+  if summary['responses'] < scorer['min_responses']:
+    return []
+  reasons = []
+  if summary['answer_rate'] < scorer['min_answer_rate']:
+    reasons.append(
+        f"only {summary['answer_rate']:.0%} of the responses have a"
+        ' parseable answer'
+    )
+  elif not summary['scored']:
+    reasons.append('no ground truth for the prompts')
+  error = summary.get('ks', summary.get('mae'))
+  max_error = scorer['max_errors'].get(summary['task'])
+  if error is not None and max_error is not None and error > max_error:
+    reasons.append(f'error {error:.3g} is above {max_error:.3g}')
+  return reasons
+
+
+def snapshot(scorer):
+  """Returns a JSON-serializable snapshot of a scorer's metrics.
+
+  Returns:
+    A dict with the `time` and `seconds` since the scorer was made, the
+    total `responses`, a `groups` list of each (model, group)'s summary
+    (see `summarize_metrics`), a `tasks` list of the summaries of each
+    model's groups merged by task (with the mean K-S statistic of its
+    sampling groups), and an `alerts` list of the groups that look broken,
+    with their `reasons`.
+  """
+  groups = []
+  tasks = {}
+  ks_values = collections.defaultdict(list)
+  alerts = []
+  for (model, group), metrics in sorted(scorer['groups'].items()):
+    summary = summarize_metrics(metrics)
+    groups.append({'model': model, 'group': group, **summary})
+    reasons = _alerts(scorer, summary)
+    if reasons:
+      alerts.append({'model': model, 'group': group, 'reasons': reasons})
+    key = model, metrics['task']
+    if metrics['task'] == 'sampling':
+      # Samples of different distributions can't be pooled into one K-S
+      # statistic, so the groups' statistics are averaged instead
+      if summary['ks'] is not None:
+        ks_values[key].append(summary['ks'])
+      metrics = dict(metrics, values=collections.Counter(), dist=None)
+    tasks[key] = (
+        merge_metrics(tasks[key], metrics) if key in tasks else metrics
+    )
+  task_summaries = []
+  for key, metrics in sorted(tasks.items()):
+    summary = {'model': key[0], **summarize_metrics(metrics)}
+    if key in ks_values:
+      summary['ks'] = statistics.mean(ks_values[key])
+    task_summaries.append(summary)
+  now = time.time()
+  return {
+      'time': now,
+      'seconds': now - scorer['start'],
+      'responses': sum(g['responses'] for g in groups),
+      'groups': groups,
+      'tasks': task_summaries,
+      'alerts': alerts,
+  }
+
+
+def write_snapshot(snapshot_dict, path):
+  """Atomically writes a snapshot as JSON, so readers never see a partial."""
+  with open(path + '.tmp', 'w') as f:
+    json.dump(snapshot_dict, f, indent=1)
+  os.replace(path + '.tmp', path)
+
+
+def open_tail(results):
+  """Starts tailing result CSVs.
+
+  Args:
+    results: A directory (searched recursively), a glob pattern, or a list
+      of CSV paths named '<model>_<group>.csv'. Directories and patterns are
+      searched again on every poll, so files created later are found.
+
+  Returns:
+    tail: A handle for `poll_results`.
+  """
+  return {'results': results, 'offsets': {}, 'marks': {}}
+
+
+def _complete_rows_end(data):
+  """Returns the end of the last complete CSV row in a chunk of rows.
+
+  A newline ends a row unless it's within a quoted field, i.e., unless an
+  odd number of quotes precedes it (quotes within fields are doubled).
+  """
+  end = data.rfind(b'\n')
+  while end >= 0 and data.count(b'"', 0, end) % 2:
+    end = data.rfind(b'\n', 0, end)
+  return end + 1
+
+
+def _read_appended(path, offset, mark, size):
+  """Reads the bytes after an offset, or None if the mark before it changed.
+
+  Args:
+    path: The file to read.
+    offset: The offset to read from.
+    mark: The bytes that were last read just before the offset.
+    size: The file's size.
+  """
+  with open(path, 'rb') as f:
+    f.seek(offset - len(mark))
+    data = f.read(len(mark) + min(size - offset, _MAX_READ_BYTES))
+  if not data.startswith(mark):
+    return None
+  return data[len(mark):]
+
+
+def poll_results(tail, scorer):
+  """Scores the rows appended to the tailed result CSVs since the last poll.
+
+  Only complete rows are read, so a row being written is scored on a later
+  poll. A file that was rewritten before the last read offset (e.g., a
+  resumed `checkpoint` job truncated rows that were never indexed, and may
+  have appended others since) is scored again from its start. Rewrites are
+  noticed when the file shrank, or when the bytes just before the offset
+  changed.
+
+  Args:
+    tail: A handle from `open_tail`.
+    scorer: A handle from `make_scorer`.
+
+  Returns:
+    The number of rows scored.
+  """
+  offsets = tail['offsets']
+  marks = tail['marks']
+  scored = 0
+  for path in results_csv.find_results_csvs(tail['results']):
+    name = results_csv.parse_results_csv_name(path)
+    if name is None:
+      continue
+    model, group = name
+    try:
+      size = os.path.getsize(path)
+    except OSError:
+      continue
+    offset = offsets.get(path, 0)
+    if size == offset:
+      continue
+    mark = marks.get(path, b'')
+    data = None
+    if size > offset:
+      data = _read_appended(path, offset, mark, size)
+    if data is None:
+      scorer['groups'].pop((model, group), None)
+      offset, mark = 0, b''
+      data = _read_appended(path, offset, mark, size)
+    end = _complete_rows_end(data)
+    if not end:
+      continue
+    rows = results_csv.decode_rows(data[:end])
+    if not offset and rows and tuple(rows[0]) == results_csv.CSV_COLUMNS:
+      rows = rows[1:]
+    rows = [(row + ['', '', ''])[:3] for row in rows]
+    # Rows without a `reasoning` only have the answer text
+    answers = answer_extraction.extract_answers(
+        [reasoning or answer for _, answer, reasoning in rows], _task(group)
+    )
+    for (prompt, _, _), value, status in zip(
+        rows, answers['value'], answers['status']
+    ):
+      score_value(scorer, group, prompt, value, model, status)
+    offsets[path] = offset + end
+    marks[path] = (mark + data[:end])[-_MARK_BYTES:]
+    scored += len(rows)
+  return scored
+
+
+async def tail_results_async(
+    results,
+    scorer,
+    snapshot_path=None,
+    server=None,
+    interval=5.0,
+    idle_timeout=None,
+    done=None,
+):
+  """Scores result CSVs as they are written, publishing live snapshots.
+
+  For example, to score a job while it runs:
+
+    done = asyncio.Event()
+    async def run():
+      try:
+        return await runner.run_prompts_async(..., checkpoint=checkpoint)
+      finally:
+        done.set()
+    await asyncio.gather(
+        run(), tail_results_async(job_dir, scorer, 'scores.json', done=done)
+    )
+
+  Args:
+    results: The result CSVs (see `open_tail`), e.g., a job directory.
+    scorer: A handle from `make_scorer`.
+    snapshot_path: An optional JSON file to write each snapshot to.
+    server: An optional server from `start_snapshot_server` to serve the
+      latest snapshot.
+    interval: The seconds between polls.
+    idle_timeout: Stop after this many seconds without new rows (None to
+      follow the files until `done` is set or the task is cancelled).
+    done: An optional `asyncio.Event`; once set, the files are polled a last
+      time and tailing stops.
+
+  Returns:
+    The last snapshot.
+  """
+  tail = open_tail(results)
+  last_rows = time.monotonic()
+  while True:
+    finished = done is not None and done.is_set()
+    if poll_results(tail, scorer):
+      last_rows = time.monotonic()
+    latest = snapshot(scorer)
+    if snapshot_path:
+      write_snapshot(latest, snapshot_path)
+    if server is not None:
+      server['snapshot'] = latest
+    idle = time.monotonic() - last_rows
+    if finished or (idle_timeout is not None and idle >= idle_timeout):
+      return latest
+    if done is None:
+      await asyncio.sleep(interval)
+    else:
+      try:
+        await asyncio.wait_for(done.wait(), interval)
+      except asyncio.TimeoutError:
+        pass
+
+
+def tail_results(results, scorer, **kwargs):
+  """Synchronous wrapper of `tail_results_async`."""
+  return asyncio.run(tail_results_async(results, scorer, **kwargs))
+
+
+async def start_snapshot_server(scorer, host='127.0.0.1', port=0):
+  """Starts an HTTP server that answers GET requests with a JSON snapshot.
+
+  The server serves its `snapshot` entry, kept up to date by
+  `tail_results_async`, or a fresh snapshot of the scorer if there's none.
+
+  Returns:
+    server: A dict with the `url`, the `snapshot` and the asyncio `server`,
+      for `stop_snapshot_server`.
+  """
+  state = {'snapshot': None}
+
+  async def handle(reader, writer):
+    try:
+      request_line = await reader.readline()
+      while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+      if request_line.split(b' ')[0] == b'GET':
+        status = '200 OK'
+        body = json.dumps(state['snapshot'] or snapshot(scorer))
+      else:
+        status = '405 Method Not Allowed'
+        body = json.dumps({'error': 'Only GET is supported.'})
+      body = body.encode('utf-8')
+      writer.write(
+          f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+          f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+          .encode('ascii')
+          + body
+      )
+      await writer.drain()
+    finally:
+      writer.close()
+
+  server = await asyncio.start_server(handle, host, port)
+  port = server.sockets[0].getsockname()[1]
+  state.update({'url': f'http://{host}:{port}', 'server': server})
+  return state
+
+
+async def stop_snapshot_server(server):
+  """Stops a server from `start_snapshot_server`."""
+  server['server'].close()
+  await server['server'].wait_closed()
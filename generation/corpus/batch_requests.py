@@ -0,0 +1,428 @@
+"""Batch-API request files for generated prompts.
+
+Offline batch endpoints take a JSONL file with one request per line and are
+much cheaper and higher-throughput than interactive calls. This module turns a
+prompt dictionary into such files for a provider:
+
+  * every request gets a stable `custom_id` derived from its group name,
+    record index and first repeat, so results can be mapped back to prompts
+    regardless of the order the provider returns them in,
+  * per-request sampling parameters are translated to the provider's names,
+  * the repeats of a prompt are folded into the provider's `n` field where it
+    has one (and split into several requests beyond its limit), and
+  * files are split to stay within the provider's line count and size limits.
+
+A `custom_ids.jsonl` file next to the request files maps every `custom_id`
+back to its prompt record, and a `batch_manifest.json` describing the files is
+written last.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from generation.corpus import chat_messages as chat_messages_lib
+from generation.corpus import corpus_export
+from generation.corpus import decoding_settings
+from generation.corpus import prompt_records
+
+PROVIDERS = ('generic', 'openai', 'anthropic', 'gemini')
+MANIFEST_NAME = 'batch_manifest.json'
+CUSTOM_IDS_NAME = 'custom_ids.jsonl'
+
+DEFAULT_SAMPLING_PARAMS = {'temperature': 1.0, 'max_tokens': 512}
+
+# The most samples one request can ask for (None for no limit)
+MAX_N = {'generic': None, 'openai': 128, 'anthropic': 1, 'gemini': 8}
+
+# The (requests, bytes) limits of one batch input file
+FILE_LIMITS = {
+    'generic': (50_000, 200 * 2**20),
+    'openai': (50_000, 200 * 2**20),
+    'anthropic': (100_000, 256 * 2**20),
+    'gemini': (None, 2 * 2**30),
+}
+
+# Generic sampling parameter names to each provider's names
+_PARAM_NAMES = {
+    'openai': {
+        'temperature': 'temperature',
+        'max_tokens': 'max_tokens',
+        'top_p': 'top_p',
+        'stop': 'stop',
+        'seed': 'seed',
+    },
+    'anthropic': {
+        'temperature': 'temperature',
+        'max_tokens': 'max_tokens',
+        'top_p': 'top_p',
+        'top_k': 'top_k',
+        'stop': 'stop_sequences',
+    },
+    'gemini': {
+        'temperature': 'temperature',
+        'max_tokens': 'max_output_tokens',
+        'top_p': 'top_p',
+        'top_k': 'top_k',
+        'stop': 'stop_sequences',
+        'seed': 'seed',
+    },
+}
+
+# Custom ids are restricted to these characters and this length by the
+# strictest provider
+_CUSTOM_ID_CHARS = re.compile(r'[^A-Za-z0-9_-]')
+_CUSTOM_ID_MAX_LENGTH = 64
+
+
+def _check_provider(provider):
+  if provider not in PROVIDERS:
+    raise ValueError(
+        f'Unsupported provider: {provider}. Please pick from {PROVIDERS}.'
+    )
+
+
+def custom_id(group, index, first_repeat=0):
+  """Returns the stable custom id of a request.
+
+  Args:
+    group: The prompt group name.
+    index: The record's index within the group.
+    first_repeat: The index of the first repeat the request samples.
+
+  Returns:
+    '<group>-<index>-<first_repeat>', with unsupported characters replaced
+    and, if it is too long, the group name shortened and suffixed with a hash
+    of the original name so that ids stay unique.
+  """
+  suffix = f'-{index:05d}-{first_repeat:04d}'
+  safe_group = _CUSTOM_ID_CHARS.sub('_', group)
+  if (
+      safe_group == group
+      and len(safe_group) + len(suffix) <= _CUSTOM_ID_MAX_LENGTH
+  ):
+    return group + suffix
+  suffix = '-' + hashlib.sha256(group.encode('utf-8')).hexdigest()[:8] + suffix
+  return safe_group[: _CUSTOM_ID_MAX_LENGTH - len(suffix)] + suffix
+
+
+def provider_params(sampling_params, provider):
+  """Translates generic sampling parameters to a provider's names.
+
+  Args:
+    sampling_params: A dict with any of 'temperature', 'max_tokens',
+      'top_p', 'top_k', 'stop' and 'seed'. None values are dropped.
+    provider: One of `PROVIDERS`. 'generic' keeps the names as they are.
+
+  Returns:
+    A dict of the provider's parameters.
+
+  Raises:
+    ValueError: If the provider does not support one of the parameters.
+  """
+  _check_provider(provider)
+  params = {k: v for k, v in sampling_params.items() if v is not None}
+  if provider == 'generic':
+    return params
+  names = _PARAM_NAMES[provider]
+  unsupported = [k for k in params if k not in names]
+  if unsupported:
+    raise ValueError(
+        f'{provider} does not support the sampling parameters {unsupported}.'
+        f' Please pick from {list(names)}.'
+    )
+  return {names[k]: v for k, v in params.items()}
+
+
+def batch_request(provider, request_id, messages, model, sampling_params, n=1):
+  """Builds one line of a provider's batch input file.
+
+  Args:
+    provider: One of `PROVIDERS`.
+    request_id: The request's custom id.
+    messages: Generic chat messages (see `chat_messages.chat_messages`).
+    model: The model name.
+    sampling_params: Generic sampling parameters (see `provider_params`). A
+      'prefill' entry (see `decoding_settings`) is sent as a trailing
+      assistant message that the response continues.
+    n: The number of samples to request. Must be 1 for providers without an
+      `n` field.
+
+  Returns:
+    The request dict.
+
+  Raises:
+    ValueError: If the provider can't sample `n` times in one request.
+  """
+  _check_provider(provider)
+  if MAX_N[provider] is not None and n > MAX_N[provider]:
+    raise ValueError(
+        f'{provider} supports at most {MAX_N[provider]} samples per request.'
+    )
+  sampling_params = dict(sampling_params)
+  prefill = sampling_params.pop('prefill', None)
+  if prefill:
+    messages = messages + [
+        {'role': 'assistant', 'content': prefill, 'cache': False}
+    ]
+  fields = chat_messages_lib.to_backend_request(messages, provider)
+  params = provider_params(sampling_params, provider)
+  if provider == 'generic':
+    return {
+        'custom_id': request_id,
+        'model': model,
+        **fields,
+        'params': params,
+        'n': n,
+    }
+  if provider == 'openai':
+    body = {'model': model, **fields, **params}
+    if n > 1:
+      body['n'] = n
+    return {
+        'custom_id': request_id,
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': body,
+    }
+  if provider == 'anthropic':
+    return {
+        'custom_id': request_id,
+        'params': {'model': model, **fields, **params},
+    }
+  # gemini: the model is set on the batch job rather than on each request
+  if n > 1:
+    params['candidate_count'] = n
+  return {
+      'key': request_id,
+      'request': {**fields, 'generation_config': params},
+  }
+
+
+def record_sampling_params(record, sampling_params=None, decoding=None):
+  """Resolves the sampling parameters of a prompt record.
+
+  Args:
+    record: A prompt record (see `prompt_records.iter_prompt_records`).
+    sampling_params: A dict, or a function mapping the record to a dict, of
+      generic sampling parameters (see `provider_params`).
+    decoding: An optional mode of `decoding_settings.DECODING_MODES`, whose
+      settings for the record's task are applied under `sampling_params`.
+
+  Returns:
+    The parameters applied over `DEFAULT_SAMPLING_PARAMS`.
+  """
+  params = dict(DEFAULT_SAMPLING_PARAMS)
+  if decoding:
+    params.update(decoding_settings.decoding_params(record['task'], decoding))
+  if callable(sampling_params):
+    params.update(sampling_params(record))
+  elif sampling_params:
+    params.update(sampling_params)
+  return params
+
+
+def _iter_record_messages(prompts, use_chat_messages):
+  """Yields (record, messages) for every prompt record."""
+  if not use_chat_messages:
+    for record in prompt_records.iter_prompt_records(prompts):
+      messages = [{'role': 'user', 'content': record['prompt'], 'cache': False}]
+      yield record, messages
+    return
+  for chat_group in chat_messages_lib.iter_chat_groups(prompts):
+    metadata = prompt_records.parse_prompt_name(chat_group['group'])
+    for record in chat_group['records']:
+      messages = chat_messages_lib.chat_messages(
+          chat_group['system'], chat_group['context'], record['user']
+      )
+      yield {'group': chat_group['group'], **record, **metadata}, messages
+
+
+def iter_batch_requests(
+    prompts,
+    model,
+    provider='generic',
+    sampling_params=None,
+    max_n=None,
+    use_chat_messages=False,
+    decoding=None,
+):
+  """Yields the batch requests of a prompt dictionary.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name, as returned by the
+      prompt generators.
+    model: The model name.
+    provider: One of `PROVIDERS`.
+    sampling_params: Generic sampling parameters (see `provider_params`),
+      applied over `DEFAULT_SAMPLING_PARAMS`. Either a dict, or a function
+      mapping a prompt record (see `prompt_records.iter_prompt_records`) to a
+      dict, e.g., to set a larger `max_tokens` for one task.
+    max_n: An optional lower cap on the samples per request than the
+      provider's `MAX_N`.
+    use_chat_messages: Whether to send each prompt as the system, context
+      and user messages of `chat_messages` (so the static parts can be
+      cached) rather than as a single user message.
+    decoding: An optional mode of `decoding_settings.DECODING_MODES` (see
+      `record_sampling_params`). Responses to its requests should be
+      completed with `decoding_settings.complete_response`, given their
+      finish reasons.
+
+  Yields:
+    (custom_id_row, request) tuples, where `custom_id_row` maps the request's
+    `custom_id` back to the record `id`, `group` and `index`, and holds the
+    `first_repeat` and number of samples `n` the request covers.
+  """
+  _check_provider(provider)
+  limits = [m for m in (MAX_N[provider], max_n) if m is not None]
+  max_samples = min(limits) if limits else None
+  for record, messages in _iter_record_messages(prompts, use_chat_messages):
+    params = record_sampling_params(record, sampling_params, decoding)
+    first_repeat = 0
+    while first_repeat < record['repeats']:
+      n = record['repeats'] - first_repeat
+      if max_samples is not None:
+        n = min(n, max_samples)
+      request_id = custom_id(record['group'], record['index'], first_repeat)
+      custom_id_row = {
+          'custom_id': request_id,
+          'id': record['id'],
+          'group': record['group'],
+          'index': record['index'],
+          'first_repeat': first_repeat,
+          'n': n,
+      }
+      yield custom_id_row, batch_request(
+          provider, request_id, messages, model, params, n
+      )
+      first_repeat += n
+
+
+def _request_line(request):
+  return (
+      json.dumps(request, ensure_ascii=False, separators=(',', ':')) + '\n'
+  ).encode('utf-8')
+
+
+def write_batch_requests(
+    prompts,
+    output_dir,
+    model,
+    provider='generic',
+    sampling_params=None,
+    max_n=None,
+    use_chat_messages=False,
+    decoding=None,
+    max_requests_per_file=None,
+    max_bytes_per_file=None,
+):
+  """Writes the batch request files of a prompt dictionary.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+    output_dir: The directory to write 'batch-<num>.jsonl' files, the custom
+      id map and the manifest to. It is created if needed.
+    model: The model name.
+    provider: One of `PROVIDERS`.
+    sampling_params: See `iter_batch_requests`.
+    max_n: See `iter_batch_requests`.
+    use_chat_messages: See `iter_batch_requests`.
+    decoding: See `iter_batch_requests`.
+    max_requests_per_file: The maximum number of requests in a file.
+      Defaults to the provider's `FILE_LIMITS`.
+    max_bytes_per_file: The maximum size of a file. Defaults to the
+      provider's `FILE_LIMITS`.
+
+  Returns:
+    manifest: The manifest dict that was written to `batch_manifest.json`.
+
+  Raises:
+    ValueError: If a single request is larger than `max_bytes_per_file`.
+  """
+  _check_provider(provider)
+  default_requests, default_bytes = FILE_LIMITS[provider]
+  max_requests_per_file = max_requests_per_file or default_requests
+  max_bytes_per_file = max_bytes_per_file or default_bytes
+  os.makedirs(output_dir, exist_ok=True)
+  # A stale manifest would make a partially rewritten batch look complete
+  manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+
+  files = []
+  custom_id_rows = []
+  lines = []
+  lines_bytes = 0
+
+  def flush():
+    file_name = f'batch-{len(files):05d}.jsonl'
+    path = os.path.join(output_dir, file_name)
+    with open(path, 'wb') as f:
+      f.write(b''.join(lines))
+    files.append({
+        'path': file_name,
+        'requests': len(lines),
+        'bytes': lines_bytes,
+        'sha256': hashlib.sha256(b''.join(lines)).hexdigest(),
+    })
+
+  for custom_id_row, request in iter_batch_requests(
+      prompts,
+      model,
+      provider,
+      sampling_params,
+      max_n,
+      use_chat_messages,
+      decoding,
+  ):
+    line = _request_line(request)
+    if len(line) > max_bytes_per_file:
+      raise ValueError(
+          f'Request {custom_id_row["custom_id"]} ({len(line)} bytes) does not'
+          f' fit in a batch file of {max_bytes_per_file} bytes.'
+      )
+    if lines and (
+        lines_bytes + len(line) > max_bytes_per_file
+        or (max_requests_per_file and len(lines) >= max_requests_per_file)
+    ):
+      flush()
+      lines, lines_bytes = [], 0
+    lines.append(line)
+    lines_bytes += len(line)
+    custom_id_row['file'] = len(files)
+    custom_id_rows.append(custom_id_row)
+  if lines:
+    flush()
+
+  corpus_export.write_jsonl(
+      os.path.join(output_dir, CUSTOM_IDS_NAME), custom_id_rows
+  )
+  manifest = {
+      'provider': provider,
+      'model': model,
+      'use_chat_messages': use_chat_messages,
+      'decoding': decoding,
+      'max_requests_per_file': max_requests_per_file,
+      'max_bytes_per_file': max_bytes_per_file,
+      'counts': {
+          'groups': len({row['group'] for row in custom_id_rows}),
+          'records': len({row['id'] for row in custom_id_rows}),
+          'prompts': sum(row['n'] for row in custom_id_rows),
+          'requests': len(custom_id_rows),
+      },
+      'files': files,
+  }
+  with open(manifest_path, 'w') as f:
+    json.dump(manifest, f, indent=2, default=str)
+  return manifest
+
+
+def read_custom_ids(output_dir):
+  """Reads the custom id map of a batch directory, keyed by custom id."""
+  return {
+      row['custom_id']: row
+      for row in corpus_export.read_jsonl(
+          os.path.join(output_dir, CUSTOM_IDS_NAME)
+      )
+  }
@@ -0,0 +1,226 @@
+"""Structured chat-message rendering of prompt groups.
+
+All prompt templates share the same layout of '## ' sections: a static
+instruction ("## You are an expert on statistics..."), the context (few-shot
+examples and the distribution description), and the question or sampling
+instruction last. This module renders each prompt as chat messages:
+
+  * a static system message with the instruction,
+  * a context message with the part of the remaining sections that every
+    prompt of the group shares, and
+  * a short per-target user message with the rest.
+
+The last static message carries a cache breakpoint. Backends with explicit
+prompt caching markers get them in their own format; backends that cache
+prefixes automatically only benefit from the static parts coming first.
+"""
+
+import os
+import re
+
+from generation.corpus import corpus_export
+from generation.corpus import prompt_records
+
+BACKENDS = ('generic', 'openai', 'anthropic', 'gemini')
+
+_SECTION = re.compile(r'^## ', re.MULTILINE)
+
+
+def _system_end(prompt):
+  """Returns where the first section (the instruction) ends."""
+  starts = [match.start() for match in _SECTION.finditer(prompt)]
+  return starts[1] if len(starts) > 1 else 0
+
+
+def split_group(group_prompts):
+  """Splits the prompts of one group into static and per-prompt parts.
+
+  Args:
+    group_prompts: The prompts of a group. They are expected to be rendered
+      from the same template, so they share the instruction section.
+
+  Returns:
+    A tuple (system, context, user_messages), where `system` is the
+    instruction section, `context` holds the sections after it that all
+    prompts share, and `user_messages` lists the remaining part of each
+    prompt, starting at the first section in which the prompts differ (or at
+    the last section if they don't differ at all).
+  """
+  system_end = _system_end(group_prompts[0])
+  shared = os.path.commonprefix(list(group_prompts))
+  context_end = shared.rfind('\n## ') + 1
+  if context_end <= system_end:
+    context_end = system_end
+  system = group_prompts[0][:system_end].strip()
+  context = group_prompts[0][system_end:context_end].strip()
+  return (
+      system,
+      context,
+      [prompt[context_end:].strip() for prompt in group_prompts],
+  )
+
+
+def chat_messages(system, context, user):
+  """Builds the generic chat messages of one prompt.
+
+  Args:
+    system: The static instruction.
+    context: The group-shared context, possibly empty.
+    user: The per-prompt user message.
+
+  Returns:
+    A list of {'role', 'content', 'cache'} dicts, skipping empty parts, where
+    `cache` marks the last static message as a cache breakpoint.
+  """
+  messages = []
+  if system:
+    messages.append({'role': 'system', 'content': system, 'cache': False})
+  if context:
+    messages.append({'role': 'user', 'content': context, 'cache': False})
+  if messages:
+    messages[-1]['cache'] = True
+  messages.append({'role': 'user', 'content': user, 'cache': False})
+  return messages
+
+
+def to_backend_request(messages, backend='generic'):
+  """Converts generic chat messages into a backend's request fields.
+
+  Args:
+    messages: Messages from `chat_messages`, optionally followed by an
+      'assistant' message that prefills the response.
+    backend: One of 'generic' (the messages as they are), 'openai' (cached
+      automatically by prefix, so no markers), 'anthropic' (with
+      `cache_control` breakpoints) or 'gemini' (whose context caching is a
+      separate API, so no markers).
+
+  Returns:
+    A dict with the message fields of the backend's request body.
+
+  Raises:
+    ValueError: If the backend is not supported, or can't prefill.
+  """
+  if backend == 'generic':
+    return {'messages': messages}
+  system = [m for m in messages if m['role'] == 'system']
+  user = [m for m in messages if m['role'] == 'user']
+  prefill = [m for m in messages if m['role'] == 'assistant']
+  if backend == 'openai':
+    if prefill:
+      raise ValueError('openai does not support prefilled responses.')
+    return {
+        'messages': [
+            {'role': m['role'], 'content': m['content']} for m in messages
+        ]
+    }
+  if backend == 'anthropic':
+
+    def block(message):
+      text_block = {'type': 'text', 'text': message['content']}
+      if message['cache']:
+        text_block['cache_control'] = {'type': 'ephemeral'}
+      return text_block
+
+    request = {'messages': [{'role': 'user', 'content': list(map(block, user))}]}
+    if prefill:
+      request['messages'].append(
+          {'role': 'assistant', 'content': prefill[0]['content']}
+      )
+    if system:
+      request['system'] = [block(m) for m in system]
+    return request
+  if backend == 'gemini':
+    request = {
+        'contents': [
+            {'role': 'user', 'parts': [{'text': m['content']} for m in user]}
+        ]
+    }
+    if prefill:
+      request['contents'].append(
+          {'role': 'model', 'parts': [{'text': prefill[0]['content']}]}
+      )
+    if system:
+      request['system_instruction'] = {
+          'parts': [{'text': m['content']} for m in system]
+      }
+    return request
+  raise ValueError(
+      f'Unsupported backend: {backend}. Please pick from {BACKENDS}.'
+  )
+
+
+def iter_chat_groups(prompts):
+  """Yields the chat rendering of each prompt group.
+
+  The static parts are kept once per group rather than once per prompt.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+
+  Yields:
+    Dicts with the `group`, its `parse_prompt_name` metadata, the `system`
+    and `context` messages, and `records` (see
+    `prompt_records.iter_prompt_records`) with a `user` message instead of
+    the prompt text.
+  """
+  for group, group_prompts in prompts.items():
+    records = list(prompt_records.iter_prompt_records({group: group_prompts}))
+    if not records:
+      continue
+    system, context, user_messages = split_group(
+        [record['prompt'] for record in records]
+    )
+    chat_group = {
+        'group': group,
+        **prompt_records.parse_prompt_name(group),
+        'system': system,
+        'context': context,
+        'records': [],
+    }
+    for record, user in zip(records, user_messages):
+      chat_group['records'].append({
+          'id': record['id'],
+          'index': record['index'],
+          'repeats': record['repeats'],
+          'user': user,
+      })
+    yield chat_group
+
+
+def iter_chat_requests(chat_groups, backend='generic'):
+  """Expands chat groups into one backend request per record.
+
+  Args:
+    chat_groups: Groups from `iter_chat_groups` or `load_chat_groups`.
+    backend: See `to_backend_request`.
+
+  Yields:
+    (record, request) tuples.
+  """
+  for chat_group in chat_groups:
+    for record in chat_group['records']:
+      messages = chat_messages(
+          chat_group['system'], chat_group['context'], record['user']
+      )
+      yield record, to_backend_request(messages, backend)
+
+
+def export_chat_messages(prompts, output_path):
+  """Writes the chat rendering of a prompt dictionary as JSONL.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+    output_path: The file to write, one line per group. Paths ending in
+      '.zst' are zstd-compressed, which requires the `zstandard` package.
+
+  Returns:
+    The number of groups written.
+  """
+  chat_groups = list(iter_chat_groups(prompts))
+  corpus_export.write_jsonl(output_path, chat_groups)
+  return len(chat_groups)
+
+
+def load_chat_groups(path):
+  """Reads the chat groups written by `export_chat_messages`."""
+  return corpus_export.read_jsonl(path)
@@ -0,0 +1,372 @@
+"""Sharded, compressed export of generated prompt corpora.
+
+A corpus directory holds two tables, each split into size-bounded shards:
+
+  * `texts`: one row per distinct prompt text, keyed by the SHA-256 of the
+    text (`text_hash`), with the total number of times it is requested
+    (`repeats`) and its token count (`tokens`). These shards are the unit of
+    work for batch inference.
+  * `records`: one row per prompt record (see `prompt_records`), pointing to
+    its text by hash. These map inference results back to prompt groups.
+
+Every shard is written as zstd-compressed JSONL and/or zstd-compressed
+Parquet, and a `manifest.json` with counts, shard hashes and the generation
+parameters is written last, so a directory without a manifest is incomplete.
+The `zstandard` and `pyarrow` packages are only needed for the respective
+formats.
+"""
+
+import hashlib
+import json
+import os
+
+from generation.corpus import dedup_index as dedup_index_lib
+from generation.corpus import prompt_records
+from generation.corpus import token_accounting
+
+MANIFEST_NAME = 'manifest.json'
+FORMAT_VERSION = 1
+FORMATS = ('jsonl.zst', 'parquet')
+
+
+def text_hash(text):
+  """Returns the content address of a prompt text."""
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _json_line(row):
+  return (
+      json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n'
+  ).encode('utf-8')
+
+
+def _split_shards(rows, max_shard_bytes):
+  """Splits rows into lists whose JSONL encoding stays within the bound.
+
+  A single row larger than the bound gets a shard of its own.
+  """
+  shard, shard_bytes = [], 0
+  for row in rows:
+    row_bytes = len(_json_line(row))
+    if shard and shard_bytes + row_bytes > max_shard_bytes:
+      yield shard
+      shard, shard_bytes = [], 0
+    shard.append(row)
+    shard_bytes += row_bytes
+  if shard:
+    yield shard
+
+
+def _write_jsonl_zst(path, rows, compression_level):
+  import zstandard
+
+  data = b''.join(_json_line(row) for row in rows)
+  with open(path, 'wb') as f:
+    f.write(zstandard.ZstdCompressor(level=compression_level).compress(data))
+  return len(data)
+
+
+def _write_parquet(path, rows, compression_level):
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  table = pa.Table.from_pylist(rows)
+  pq.write_table(
+      table, path, compression='zstd', compression_level=compression_level
+  )
+  return table.nbytes
+
+
+_WRITERS = {'jsonl.zst': _write_jsonl_zst, 'parquet': _write_parquet}
+
+
+def write_jsonl(path, rows, compression_level=10):
+  """Writes rows as JSONL, zstd-compressed if the path ends in '.zst'.
+
+  Args:
+    path: The file to write.
+    rows: An iterable of JSON-serializable dicts.
+    compression_level: The zstd compression level.
+
+  Returns:
+    The number of uncompressed bytes written.
+  """
+  if path.endswith('.zst'):
+    return _write_jsonl_zst(path, rows, compression_level)
+  data = b''.join(_json_line(row) for row in rows)
+  with open(path, 'wb') as f:
+    f.write(data)
+  return len(data)
+
+
+def read_jsonl(path):
+  """Reads rows from a (possibly zstd-compressed) JSONL file."""
+  with open(path, 'rb') as f:
+    if path.endswith('.zst'):
+      import zstandard
+
+      data = zstandard.ZstdDecompressor().stream_reader(f).read()
+    else:
+      data = f.read()
+  # Splits on newlines only: rows may hold raw line separators such as
+  # U+2028, which str.splitlines would also split on
+  return [json.loads(line) for line in data.split(b'\n') if line.strip()]
+
+
+def _file_sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def _write_table(
+    output_dir, table, rows, formats, max_shard_bytes, compression_level
+):
+  """Writes one table as shards in every format and describes them."""
+  shards = []
+  for shard_num, shard_rows in enumerate(_split_shards(rows, max_shard_bytes)):
+    for file_format in formats:
+      file_name = f'{table}-{shard_num:05d}.{file_format}'
+      path = os.path.join(output_dir, file_name)
+      raw_bytes = _WRITERS[file_format](path, shard_rows, compression_level)
+      shards.append({
+          'table': table,
+          'shard': shard_num,
+          'format': file_format,
+          'path': file_name,
+          'rows': len(shard_rows),
+          'raw_bytes': raw_bytes,
+          'bytes': os.path.getsize(path),
+          'sha256': _file_sha256(path),
+      })
+  return shards
+
+
+def export_prompt_corpus(
+    prompts,
+    output_dir,
+    formats=FORMATS,
+    max_shard_bytes=64 * 2**20,
+    generation_params=None,
+    compression_level=10,
+    tokenizer=None,
+    dedup_index_dir=None,
+):
+  """Exports a prompt dictionary as a sharded, deduplicated corpus.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name, as returned by the
+      prompt generators.
+    output_dir: The directory to write the shards and manifest to. It is
+      created if needed; existing shards with the same names are overwritten.
+    formats: The shard formats to write, any of 'jsonl.zst' and 'parquet'.
+    max_shard_bytes: The maximum uncompressed JSONL size of a shard.
+    generation_params: An optional JSON-serializable dict of the parameters
+      the prompts were generated with (e.g., seed, shot list, sample count),
+      recorded in the manifest.
+    compression_level: The zstd compression level.
+    tokenizer: The tokenizer to count prompt tokens with (see
+      `token_accounting.get_token_counter`). Defaults to the offline
+      estimate.
+    dedup_index_dir: An optional global `dedup_index` directory shared
+      across exports. Records then carry the `canonical_id` of their text,
+      and the texts table only holds the texts that are new to the index,
+      so that texts exported (and sent to a model) before are not repeated.
+
+  Returns:
+    manifest: The manifest dict that was written to `manifest.json`.
+
+  Raises:
+    ValueError: If an unsupported format is requested.
+  """
+  unknown = [f for f in formats if f not in _WRITERS]
+  if unknown or not formats:
+    raise ValueError(
+        f'Unsupported corpus formats: {unknown}. Please pick from {FORMATS}.'
+    )
+  os.makedirs(output_dir, exist_ok=True)
+  # A stale manifest would make a partially rewritten corpus look complete
+  manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+
+  count_tokens = token_accounting.get_token_counter(tokenizer)
+  dedup_index = None
+  if dedup_index_dir is not None:
+    dedup_index = dedup_index_lib.open_index(dedup_index_dir)
+  texts = {}
+  new_text_hashes = set()
+  records = []
+  groups = {}
+  corpus_digest = hashlib.sha256()
+  for record in prompt_records.iter_prompt_records(prompts, dedup_index):
+    prompt = record.pop('prompt')
+    record['text_hash'] = text_hash(prompt)
+    if record.pop('new', True):
+      new_text_hashes.add(record['text_hash'])
+    if record['text_hash'] in texts:
+      texts[record['text_hash']]['repeats'] += record['repeats']
+    else:
+      texts[record['text_hash']] = {
+          'text_hash': record['text_hash'],
+          'prompt': prompt,
+          'repeats': record['repeats'],
+          'tokens': count_tokens(prompt),
+      }
+      if dedup_index is not None:
+        texts[record['text_hash']]['canonical_id'] = record['canonical_id']
+    record['tokens'] = texts[record['text_hash']]['tokens']
+    records.append(record)
+    group = groups.setdefault(
+        record['group'], {'records': 0, 'prompts': 0, 'tokens': 0}
+    )
+    group['records'] += 1
+    group['prompts'] += record['repeats']
+    group['tokens'] += record['tokens'] * record['repeats']
+    corpus_digest.update(
+        f'{record["id"]}\t{record["text_hash"]}\t{record["repeats"]}\n'.encode()
+    )
+
+  if dedup_index is not None:
+    dedup_index_lib.close_index(dedup_index)
+
+  shards = _write_table(
+      output_dir,
+      'texts',
+      [text for key, text in texts.items() if key in new_text_hashes],
+      formats,
+      max_shard_bytes,
+      compression_level,
+  )
+  shards += _write_table(
+      output_dir,
+      'records',
+      records,
+      formats,
+      max_shard_bytes,
+      compression_level,
+  )
+
+  manifest = {
+      'format_version': FORMAT_VERSION,
+      'corpus_sha256': corpus_digest.hexdigest(),
+      'generation_params': generation_params or {},
+      'formats': list(formats),
+      'max_shard_bytes': max_shard_bytes,
+      'compression': {'codec': 'zstd', 'level': compression_level},
+      'tokenizer': token_accounting.tokenizer_name(tokenizer),
+      'dedup_index': dedup_index_dir,
+      'counts': {
+          'groups': len(groups),
+          'records': len(records),
+          'prompts': sum(group['prompts'] for group in groups.values()),
+          'unique_texts': len(texts),
+          'new_texts': len(new_text_hashes),
+          'text_bytes': sum(
+              len(text['prompt'].encode('utf-8')) for text in texts.values()
+          ),
+          'prompt_bytes': sum(
+              len(text['prompt'].encode('utf-8')) * text['repeats']
+              for text in texts.values()
+          ),
+          'unique_text_tokens': sum(text['tokens'] for text in texts.values()),
+          'prompt_tokens': sum(group['tokens'] for group in groups.values()),
+          'max_prompt_tokens': max(
+              (text['tokens'] for text in texts.values()), default=0
+          ),
+      },
+      'groups': groups,
+      'shards': shards,
+  }
+  with open(manifest_path, 'w') as f:
+    json.dump(manifest, f, indent=2, default=str)
+  return manifest
+
+
+def read_manifest(corpus_dir):
+  """Reads the manifest of an exported corpus."""
+  with open(os.path.join(corpus_dir, MANIFEST_NAME)) as f:
+    return json.load(f)
+
+
+def list_shards(manifest, table, file_format=None):
+  """Lists the manifest entries of one table's shards, in shard order.
+
+  Args:
+    manifest: A manifest from `read_manifest`.
+    table: 'texts' or 'records'.
+    file_format: The shard format to list. Defaults to the first format the
+      corpus was written in.
+
+  Returns:
+    A list of shard entries.
+  """
+  file_format = file_format or manifest['formats'][0]
+  return [
+      shard
+      for shard in manifest['shards']
+      if shard['table'] == table and shard['format'] == file_format
+  ]
+
+
+def read_shard(corpus_dir, shard, verify=True):
+  """Reads the rows of one shard.
+
+  Args:
+    corpus_dir: The corpus directory.
+    shard: A shard entry from the manifest.
+    verify: Whether to check the file against the manifest's SHA-256.
+
+  Returns:
+    A list of row dicts.
+
+  Raises:
+    ValueError: If verification fails.
+  """
+  path = os.path.join(corpus_dir, shard['path'])
+  if verify and _file_sha256(path) != shard['sha256']:
+    raise ValueError(f'Shard {shard["path"]} does not match its manifest hash.')
+  if shard['format'] == 'parquet':
+    import pyarrow.parquet as pq
+
+    return pq.read_table(path).to_pylist()
+  return read_jsonl(path)
+
+
+def load_prompt_corpus(corpus_dir, file_format=None, verify=True):
+  """Loads an exported corpus back into a prompt dictionary.
+
+  Args:
+    corpus_dir: The corpus directory.
+    file_format: The shard format to read. Defaults to the first format the
+      corpus was written in.
+    verify: Whether to check every shard against the manifest's SHA-256.
+
+  Returns:
+    prompts: A dict of prompt lists keyed by group name, equal to the one
+      that was exported.
+  """
+  manifest = read_manifest(corpus_dir)
+  texts = {}
+  for shard in list_shards(manifest, 'texts', file_format):
+    for row in read_shard(corpus_dir, shard, verify):
+      texts[row['text_hash']] = row['prompt']
+  records = []
+  for shard in list_shards(manifest, 'records', file_format):
+    records.extend(read_shard(corpus_dir, shard, verify))
+
+  dedup_index = None
+  if any(record['text_hash'] not in texts for record in records):
+    # Texts that were already known to the dedup index live in the index
+    dedup_index = dedup_index_lib.open_index(manifest['dedup_index'])
+  for record in records:
+    if record['text_hash'] not in texts:
+      texts[record['text_hash']] = dedup_index_lib.get_text(
+          dedup_index, record['canonical_id']
+      )
+    record['prompt'] = texts[record['text_hash']]
+  if dedup_index is not None:
+    dedup_index_lib.close_index(dedup_index)
+  return prompt_records.expand_prompt_records(records)
@@ -0,0 +1,114 @@
+"""Decoding settings derived from each prompt's task.
+
+Every template asks for the final answer inside `<answer>` and `</answer>`
+tags, so nothing the model generates after `</answer>` is used. The settings
+here bound generation to what the answer needs:
+
+  * a `</answer>` stop sequence,
+  * a per-task `max_tokens` budget derived from the longest expected answer
+    (a percentile in [0, 100], a probability in [0, 1], or a sample), plus
+    a short allowance for text before the answer, and
+  * optionally, an answer-only mode that prefills the response with
+    `<answer>`, so the model writes just the number and the closing tag.
+
+The settings are generic sampling parameters (see
+`batch_requests.provider_params`) with an extra 'prefill' entry, which
+`batch_requests.batch_request` sends as a trailing assistant message. Since
+providers leave the prefill and the stop sequence out of their responses,
+`complete_response` puts them back before responses are stored: the stop
+sequence only when the provider reports stopping at it, so that answers cut
+off by `max_tokens` stay visibly unclosed.
+"""
+
+from generation.corpus import token_accounting
+
+DECODING_MODES = ('stop', 'answer_only')
+
+ANSWER_OPEN = '<answer>'
+ANSWER_CLOSE = '</answer>'
+
+# The longest expected answer of each task
+_ANSWER_FORMATS = {
+    'percentiles': '100.000',
+    'probabilities': '0.0001',
+    'sampling': '-1234567.891',
+}
+
+# Allowance for whitespace and tokenizers that split numbers more finely than
+# `token_accounting.estimate_tokens`
+_ANSWER_SLACK_TOKENS = 8
+
+# Allowance for a short lead-in before the answer tags, without a prefill
+DEFAULT_PREAMBLE_TOKENS = 48
+
+
+def answer_tokens(task):
+  """Returns the token budget of a task's answer and closing tag."""
+  if task not in _ANSWER_FORMATS:
+    raise ValueError(
+        f'Unsupported task: {task}. Please pick from {list(_ANSWER_FORMATS)}.'
+    )
+  answer = _ANSWER_FORMATS[task] + ANSWER_CLOSE
+  return token_accounting.estimate_tokens(answer) + _ANSWER_SLACK_TOKENS
+
+
+def decoding_params(
+    task, mode='stop', preamble_tokens=DEFAULT_PREAMBLE_TOKENS
+):
+  """Returns the decoding settings of a task.
+
+  Args:
+    task: The prompts' task ('percentiles', 'probabilities' or 'sampling').
+    mode: One of `DECODING_MODES`: 'stop' for the stop sequence and token
+      budget, or 'answer_only' to also prefill the response with `<answer>`.
+    preamble_tokens: The budget for text before the answer tags, without a
+      prefill.
+
+  Returns:
+    A dict of generic sampling parameters, with the 'prefill' text in
+    'answer_only' mode.
+
+  Raises:
+    ValueError: If the task or mode is not supported.
+  """
+  if mode not in DECODING_MODES:
+    raise ValueError(
+        f'Unsupported decoding mode: {mode}. Please pick from'
+        f' {DECODING_MODES}.'
+    )
+  params = {'stop': [ANSWER_CLOSE], 'max_tokens': answer_tokens(task)}
+  if mode == 'answer_only':
+    params['prefill'] = ANSWER_OPEN
+  else:
+    params['max_tokens'] += (
+        token_accounting.estimate_tokens(ANSWER_OPEN) + preamble_tokens
+    )
+  return params
+
+
+def complete_response(response, params, finish_reason=None):
+  """Restores the prefill and the stop sequence a provider left out.
+
+  The closing tag is restored when the response stopped at it inside an
+  answer. Responses that ended otherwise (e.g., cut off by `max_tokens`, or
+  with an unknown finish reason) keep their unclosed answer.
+
+  Args:
+    response: A response text, or None.
+    params: The generic sampling parameters it was requested with.
+    finish_reason: The response's finish reason (see `backends`), 'stop' if
+      it stopped at a stop sequence.
+
+  Returns:
+    The completed response, or None.
+  """
+  if response is None:
+    return None
+  response = (params.get('prefill') or '') + response
+  if (
+      finish_reason == 'stop'
+      and ANSWER_CLOSE in (params.get('stop') or ())
+      and response.rfind(ANSWER_OPEN) > response.rfind(ANSWER_CLOSE)
+  ):
+    response += ANSWER_CLOSE
+  return response
@@ -0,0 +1,313 @@
+"""A global, on-disk prompt deduplication index.
+
+Many prompts are identical across configurations (e.g., the 0-shot groups
+do not depend on the shot mode, and zero-shot prompts repeat per sample), and
+across runs. The index maps the hash of every prompt text it has seen to a
+canonical id (a dense integer, in order of first appearance) and stores each
+text once, so that it only needs to be sent to a model once and its
+responses can be fanned back out to every record that uses it.
+
+An index directory holds:
+
+  * `table.bin`: an open-addressing hash table of (16-byte text hash,
+    canonical id) slots with linear probing, memory-mapped and doubled in
+    size when it gets 70% full,
+  * `entries.bin`: the (offset, length) of each canonical id's text, and
+  * `texts.bin`: the texts, appended in canonical id order.
+
+The texts and entries are the source of truth: the table is rebuilt from them
+if it is missing, behind, or was not closed (e.g., after an interrupted run).
+Texts and entries are flushed before a slot points at them, and the first
+change to an open table marks its header count as unsaved until
+`close_index` writes it back.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+
+_MAGIC = b'PDIX'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIQQ')  # magic, version, capacity, count
+_SLOT = struct.Struct('<16sQ')  # text hash, canonical id
+_ENTRY = struct.Struct('<QQ')  # text offset, text length
+_EMPTY_KEY = bytes(16)
+# The header count of a table with unsaved changes
+_UNSAVED_COUNT = 2**64 - 1
+_MIN_CAPACITY = 1024
+_MAX_LOAD = 0.7
+
+TABLE_NAME = 'table.bin'
+ENTRIES_NAME = 'entries.bin'
+TEXTS_NAME = 'texts.bin'
+
+
+def text_key(text):
+  """Returns the 16-byte table key of a prompt text."""
+  key = hashlib.sha256(text.encode('utf-8')).digest()[:16]
+  # The all-zero key marks empty slots
+  return key if key != _EMPTY_KEY else b'\x01' + key[1:]
+
+
+def _slot_position(capacity, key):
+  return int.from_bytes(key[:8], 'little') % capacity
+
+
+def _create_table(path, capacity, keys_and_ids):
+  """Writes a new table file holding the given (key, id) pairs."""
+  slots = bytearray(capacity * _SLOT.size)
+  count = 0
+  for key, canonical_id in keys_and_ids:
+    position = _slot_position(capacity, key)
+    offset = position * _SLOT.size
+    while slots[offset:offset + 16] != _EMPTY_KEY:
+      position = (position + 1) % capacity
+      offset = position * _SLOT.size
+    _SLOT.pack_into(slots, offset, key, canonical_id)
+    count += 1
+  with open(path + '.tmp', 'wb') as f:
+    f.write(_HEADER.pack(_MAGIC, _VERSION, capacity, count))
+    f.write(slots)
+  os.replace(path + '.tmp', path)
+
+
+def _map_table(index):
+  """(Re)opens the memory map of the index's table file."""
+  if index.get('table') is not None:
+    index['table'].close()
+    index['table_file'].close()
+  index['table_file'] = open(os.path.join(index['dir'], TABLE_NAME), 'r+b')
+  index['table'] = mmap.mmap(index['table_file'].fileno(), 0)
+  magic, version, capacity, count = _HEADER.unpack_from(index['table'])
+  if magic != _MAGIC or version != _VERSION:
+    raise ValueError(f'{index["dir"]} is not a prompt dedup index.')
+  index['capacity'] = capacity
+  index['table_count'] = count
+  index['unsaved'] = count == _UNSAVED_COUNT
+
+
+def _mark_unsaved(index):
+  """Marks the table's header as behind until `close_index`."""
+  if not index['unsaved']:
+    _HEADER.pack_into(
+        index['table'],
+        0,
+        _MAGIC,
+        _VERSION,
+        index['capacity'],
+        _UNSAVED_COUNT,
+    )
+    index['unsaved'] = True
+
+
+def _iter_stored_keys(index):
+  """Yields the (key, id) pair of every stored text, in id order."""
+  for canonical_id in range(index['count']):
+    yield text_key(get_text(index, canonical_id)), canonical_id
+
+
+def _iter_table_slots(index):
+  """Yields the (key, id) pair of every occupied table slot."""
+  slots = memoryview(index['table'])[_HEADER.size:]
+  try:
+    for slot_key, canonical_id in _SLOT.iter_unpack(slots):
+      if slot_key != _EMPTY_KEY:
+        yield slot_key, canonical_id
+  finally:
+    slots.release()
+
+
+def _rebuild_table(index, capacity, keys_and_ids=None):
+  """Rebuilds the table with the given capacity.
+
+  Args:
+    index: The index handle.
+    capacity: The new number of slots.
+    keys_and_ids: The (key, id) pairs to hold. Defaults to rehashing every
+      stored text.
+  """
+  if keys_and_ids is None:
+    keys_and_ids = _iter_stored_keys(index)
+  _create_table(
+      os.path.join(index['dir'], TABLE_NAME), capacity, list(keys_and_ids)
+  )
+  _map_table(index)
+
+
+def open_index(index_dir):
+  """Opens (or creates) a dedup index.
+
+  Args:
+    index_dir: The index directory.
+
+  Returns:
+    index: A handle to pass to the other functions. Call `close_index` when
+      done to make its header durable.
+  """
+  os.makedirs(index_dir, exist_ok=True)
+  index = {'dir': index_dir, 'table': None}
+  index['entries_file'] = open(os.path.join(index_dir, ENTRIES_NAME), 'a+b')
+  index['texts_file'] = open(os.path.join(index_dir, TEXTS_NAME), 'a+b')
+  index['entries_file'].seek(0, os.SEEK_END)
+  index['count'] = index['entries_file'].tell() // _ENTRY.size
+  # Drops a partly written entry, so that the next one is aligned
+  index['entries_file'].truncate(index['count'] * _ENTRY.size)
+  index['texts_file'].seek(0, os.SEEK_END)
+  index['texts_size'] = index['texts_file'].tell()
+
+  table_path = os.path.join(index_dir, TABLE_NAME)
+  if not os.path.exists(table_path):
+    _create_table(table_path, _MIN_CAPACITY, [])
+  _map_table(index)
+  if index['table_count'] != index['count'] or any(
+      canonical_id >= index['count']
+      for _, canonical_id in _iter_table_slots(index)
+  ):
+    capacity = index['capacity']
+    while index['count'] > capacity * _MAX_LOAD:
+      capacity *= 2
+    _rebuild_table(index, capacity)
+  return index
+
+
+def close_index(index):
+  """Flushes and closes a dedup index."""
+  # Texts first, so that entries never point past the written texts, and
+  # the header count last, once everything it covers is written
+  index['texts_file'].flush()
+  index['entries_file'].flush()
+  index['table'].flush()
+  _HEADER.pack_into(
+      index['table'], 0, _MAGIC, _VERSION, index['capacity'], index['count']
+  )
+  index['table'].flush()
+  index['table'].close()
+  index['table_file'].close()
+  index['entries_file'].close()
+  index['texts_file'].close()
+
+
+def _find_slot(index, key):
+  """Returns (position, canonical id or None) of a key's slot."""
+  table = index['table']
+  capacity = index['capacity']
+  position = _slot_position(capacity, key)
+  while True:
+    offset = _HEADER.size + position * _SLOT.size
+    slot_key, canonical_id = _SLOT.unpack_from(table, offset)
+    if slot_key == _EMPTY_KEY:
+      return position, None
+    if slot_key == key:
+      return position, canonical_id
+    position = (position + 1) % capacity
+
+
+def lookup(index, text):
+  """Returns the canonical id of a text, or None if it is not indexed."""
+  return _find_slot(index, text_key(text))[1]
+
+
+def add(index, text):
+  """Adds a text to the index if it is new.
+
+  Args:
+    index: A handle from `open_index`.
+    text: The prompt text.
+
+  Returns:
+    A tuple (canonical_id, is_new).
+  """
+  key = text_key(text)
+  position, canonical_id = _find_slot(index, key)
+  if canonical_id is not None:
+    return canonical_id, False
+
+  if index['count'] + 1 > index['capacity'] * _MAX_LOAD:
+    _rebuild_table(index, index['capacity'] * 2, _iter_table_slots(index))
+    position, _ = _find_slot(index, key)
+
+  data = text.encode('utf-8')
+  canonical_id = index['count']
+  _mark_unsaved(index)
+  # Entries only ever point at stored texts, and slots at stored entries
+  index['texts_file'].write(data)
+  index['texts_file'].flush()
+  index['entries_file'].write(_ENTRY.pack(index['texts_size'], len(data)))
+  index['entries_file'].flush()
+  index['texts_size'] += len(data)
+  index['count'] += 1
+  _SLOT.pack_into(
+      index['table'], _HEADER.size + position * _SLOT.size, key, canonical_id
+  )
+  return canonical_id, True
+
+
+def get_text(index, canonical_id):
+  """Returns the stored text of a canonical id."""
+  # Positioned reads leave the files' (appending) positions alone
+  offset, length = _ENTRY.unpack(
+      os.pread(
+          index['entries_file'].fileno(),
+          _ENTRY.size,
+          canonical_id * _ENTRY.size,
+      )
+  )
+  return os.pread(index['texts_file'].fileno(), length, offset).decode(
+      'utf-8'
+  )
+
+
+def register_prompts(index, prompts):
+  """Adds every prompt of a prompt dictionary to the index.
+
+  Args:
+    index: A handle from `open_index`.
+    prompts: A dict of prompt lists keyed by group name.
+
+  Returns:
+    A tuple (canonical_ids, new_ids), where `canonical_ids` maps each group
+    to the canonical ids of its prompts, and `new_ids` lists the ids of the
+    texts that were new to the index, in order.
+  """
+  canonical_ids = {}
+  new_ids = []
+  for group, group_prompts in prompts.items():
+    canonical_ids[group] = []
+    previous = None
+    for prompt in group_prompts:
+      # Repeated prompts are consecutive, so most lookups can be skipped
+      if previous is None or prompt != previous[0]:
+        canonical_id, is_new = add(index, prompt)
+        if is_new:
+          new_ids.append(canonical_id)
+        previous = (prompt, canonical_id)
+      canonical_ids[group].append(previous[1])
+  return canonical_ids, new_ids
+
+
+def fan_out_responses(canonical_ids, responses):
+  """Fans responses for canonical ids back out to every prompt using them.
+
+  Args:
+    canonical_ids: A dict of per-prompt canonical id lists keyed by group, as
+      returned by `register_prompts`.
+    responses: A dict mapping canonical ids to lists of responses (e.g., the
+      model's answers to repeated requests of that text).
+
+  Returns:
+    A dict of per-prompt response lists keyed by group. The k-th occurrence
+    of a canonical id within a group gets its k-th response (cycling when
+    there are fewer), so that repeated prompts receive distinct samples.
+    Prompts without responses get None.
+  """
+  fanned_out = {}
+  for group, group_ids in canonical_ids.items():
+    seen = {}
+    fanned_out[group] = []
+    for canonical_id in group_ids:
+      id_responses = responses.get(canonical_id) or [None]
+      k = seen.get(canonical_id, 0)
+      seen[canonical_id] = k + 1
+      fanned_out[group].append(id_responses[k % len(id_responses)])
+  return fanned_out
@@ -0,0 +1,148 @@
+"""Manifest-backed storage for incremental prompt regeneration.
+
+An incremental directory keeps the prompts of every group in its own file,
+next to a `manifest.json` that maps each group name to a hash of the group's
+inputs (its distribution summary, examples or drawn values, template text,
+shot count, sample count and seed). On a rerun, groups whose input hash is
+unchanged are read back from their file, and only the others are regenerated
+and rewritten.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from generation.corpus import corpus_export
+from generation.corpus import prompt_records
+
+MANIFEST_NAME = 'manifest.json'
+GROUPS_DIR = 'groups'
+
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def _sha256(*parts):
+  return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _digest(value, memo):
+  """Hashes a value as a Merkle tree, memoizing containers by identity.
+
+  Group specs of the same distribution share their (large) summaries and
+  example pools, so memoizing lets each one be hashed once per run.
+  """
+  is_container = isinstance(value, (dict, list, tuple)) or (
+      hasattr(value, 'tobytes') and hasattr(value, 'dtype')
+  )
+  if is_container and id(value) in memo:
+    return memo[id(value)][1]
+
+  if isinstance(value, dict):
+    digest = _sha256(
+        'dict',
+        *sorted(
+            _sha256(_digest(key, memo), _digest(item, memo))
+            for key, item in value.items()
+        ),
+    )
+  elif isinstance(value, (list, tuple)):
+    digest = _sha256(
+        type(value).__name__, *(_digest(item, memo) for item in value)
+    )
+  elif is_container:
+    # numpy arrays and scalars
+    digest = _sha256(
+        'array',
+        str(value.dtype),
+        str(getattr(value, 'shape', ())),
+        hashlib.sha256(value.tobytes()).hexdigest(),
+    )
+  else:
+    digest = _sha256(type(value).__name__, repr(value))
+
+  if is_container:
+    # Keeps the value alive, so that its id can't be reused during the run
+    memo[id(value)] = (value, digest)
+  return digest
+
+
+def hash_inputs(inputs, memo=None):
+  """Hashes a (nested) structure of group inputs.
+
+  Args:
+    inputs: Any nesting of dicts, lists, tuples, numpy arrays and scalars.
+      Dict order does not matter.
+    memo: An optional dict to share between calls on inputs that share
+      (unmodified) containers, so that those are only hashed once.
+
+  Returns:
+    A hex SHA-256 digest.
+  """
+  return _digest(inputs, {} if memo is None else memo)
+
+
+def load_manifest(incremental_dir):
+  """Loads the manifest of an incremental directory (empty if new)."""
+  path = os.path.join(incremental_dir, MANIFEST_NAME)
+  if not os.path.exists(path):
+    return {'groups': {}}
+  with open(path) as f:
+    return json.load(f)
+
+
+def save_manifest(incremental_dir, manifest):
+  """Atomically writes the manifest of an incremental directory."""
+  os.makedirs(incremental_dir, exist_ok=True)
+  path = os.path.join(incremental_dir, MANIFEST_NAME)
+  with open(path + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.replace(path + '.tmp', path)
+
+
+def is_current(incremental_dir, manifest, group, input_hash):
+  """Returns whether a group's stored prompts match its input hash."""
+  entry = manifest['groups'].get(group)
+  return (
+      entry is not None
+      and entry['hash'] == input_hash
+      and os.path.exists(os.path.join(incremental_dir, entry['path']))
+  )
+
+
+def write_group(incremental_dir, manifest, group, input_hash, group_prompts):
+  """Writes a group's prompts and records them in the manifest.
+
+  The manifest itself is only updated in memory; call `save_manifest` once
+  all groups are written.
+
+  Args:
+    incremental_dir: The incremental directory.
+    manifest: The manifest from `load_manifest`.
+    group: The group name.
+    input_hash: The hash of the group's inputs.
+    group_prompts: The group's list of prompts.
+  """
+  path = os.path.join(GROUPS_DIR, _UNSAFE_CHARS.sub('_', group) + '.jsonl')
+  full_path = os.path.join(incremental_dir, path)
+  os.makedirs(os.path.dirname(full_path), exist_ok=True)
+  records = [
+      {'prompt': record['prompt'], 'repeats': record['repeats']}
+      for record in prompt_records.iter_prompt_records({group: group_prompts})
+  ]
+  corpus_export.write_jsonl(full_path + '.tmp', records)
+  os.replace(full_path + '.tmp', full_path)
+  manifest['groups'][group] = {
+      'hash': input_hash,
+      'path': path,
+      'prompts': len(group_prompts),
+  }
+
+
+def read_group(incremental_dir, manifest, group):
+  """Reads a group's stored prompts."""
+  path = os.path.join(incremental_dir, manifest['groups'][group]['path'])
+  group_prompts = []
+  for record in corpus_export.read_jsonl(path):
+    group_prompts.extend([record['prompt']] * record['repeats'])
+  return group_prompts
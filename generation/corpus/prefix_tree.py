@@ -0,0 +1,194 @@
+"""Prefix-tree export of prompt groups for prefix (KV) caching.
+
+Inference servers with prefix caching (e.g., vLLM, the llama.cpp server or
+provider-side prompt caching) only reuse work for byte-identical prompt
+prefixes. Within a prompt group, every prompt shares everything up to the
+question (percentiles and probabilities), or up to the few-shot examples
+(sampling with the `shared_prefix` layout), and groups of the same task share
+the task instruction. This module arranges the groups of a prompt dictionary
+into a tree of shared text segments, so that a runner can send (or warm) each
+segment once, and records the shared-prefix length of every group.
+
+Prefixes are cut at line boundaries by default, since tokenizers may merge
+characters across an arbitrary cut, which would break the cache match.
+"""
+
+import os
+
+from generation.corpus import corpus_export
+from generation.corpus import prompt_records
+
+
+def shared_prefix(texts, boundary='\n'):
+  """Returns the longest common prefix of texts, cut after a boundary.
+
+  Args:
+    texts: A non-empty list of strings.
+    boundary: The prefix is shortened to end right after the last occurrence
+      of this string in it. Pass None or '' to keep the raw common prefix.
+
+  Returns:
+    The shared prefix.
+  """
+  prefix = os.path.commonprefix(list(texts))
+  if boundary and len(set(texts)) > 1:
+    end = prefix.rfind(boundary)
+    prefix = prefix[: end + len(boundary)] if end >= 0 else ''
+  return prefix
+
+
+def _segments(text, boundary):
+  """Splits text into segments ending right after each boundary."""
+  if not boundary:
+    return [text] if text else []
+  parts = text.split(boundary)
+  segments = [part + boundary for part in parts[:-1]]
+  if parts[-1]:
+    segments.append(parts[-1])
+  return segments
+
+
+def build_prefix_tree(prompts, boundary='\n'):
+  """Arranges prompt groups into a tree of shared prefixes.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+    boundary: See `shared_prefix`.
+
+  Returns:
+    A dict with:
+      nodes: A list of nodes in depth-first order, each with an `id`, its
+        `parent` id (None for the root), its own `text` segment, and
+        `prefix_chars`, the length of the full prefix ending at the node.
+      groups: A dict keyed by group name with the `node` holding the group's
+        full shared prefix, its `prefix_chars`, and its `records` (see
+        `prompt_records.iter_prompt_records`), where `suffix` replaces the
+        prompt text and is the part after the shared prefix.
+      stats: The total prompt characters and the characters left to send
+        when each tree node is sent once.
+  """
+  records_by_group = {}
+  for record in prompt_records.iter_prompt_records(prompts):
+    records_by_group.setdefault(record['group'], []).append(record)
+
+  # A trie over the prefix segments of each group
+  root = {'children': {}, 'groups': []}
+  for group, records in records_by_group.items():
+    prefix = shared_prefix([record['prompt'] for record in records], boundary)
+    node = root
+    for segment in _segments(prefix, boundary):
+      node = node['children'].setdefault(
+          segment, {'children': {}, 'groups': []}
+      )
+    node['groups'].append(group)
+
+  nodes = []
+  groups = {}
+
+  def add_node(text, trie_node, parent, prefix_chars):
+    # Collapse chains of single-child nodes that hold no groups
+    while len(trie_node['children']) == 1 and not trie_node['groups']:
+      (segment, trie_node), = trie_node['children'].items()
+      text += segment
+    prefix_chars += len(text)
+    node_id = len(nodes)
+    nodes.append({
+        'id': node_id,
+        'parent': parent,
+        'text': text,
+        'prefix_chars': prefix_chars,
+    })
+    for group in trie_node['groups']:
+      groups[group] = {'node': node_id, 'prefix_chars': prefix_chars}
+    for segment, child in trie_node['children'].items():
+      add_node(segment, child, node_id, prefix_chars)
+
+  root_id = len(nodes)
+  nodes.append({'id': root_id, 'parent': None, 'text': '', 'prefix_chars': 0})
+  for group in root['groups']:
+    groups[group] = {'node': root_id, 'prefix_chars': 0}
+  for segment, child in root['children'].items():
+    add_node(segment, child, root_id, 0)
+
+  total_chars = 0
+  suffix_chars = 0
+  for group, records in records_by_group.items():
+    prefix_chars = groups[group]['prefix_chars']
+    groups[group]['records'] = []
+    for record in records:
+      prompt = record.pop('prompt')
+      record['suffix'] = prompt[prefix_chars:]
+      groups[group]['records'].append(record)
+      total_chars += len(prompt) * record['repeats']
+      suffix_chars += len(record['suffix']) * record['repeats']
+
+  return {
+      'nodes': nodes,
+      'groups': {group: groups[group] for group in records_by_group},
+      'stats': {
+          'prompt_chars': total_chars,
+          'unshared_chars': suffix_chars + sum(len(n['text']) for n in nodes),
+      },
+  }
+
+
+def node_prefix(tree, node_id):
+  """Reconstructs the full prefix text ending at a node."""
+  segments = []
+  while node_id is not None:
+    node = tree['nodes'][node_id]
+    segments.append(node['text'])
+    node_id = node['parent']
+  return ''.join(reversed(segments))
+
+
+def expand_prefix_tree(tree):
+  """Rebuilds the prompt dictionary from a prefix tree."""
+  prompts = {}
+  for group, group_info in tree['groups'].items():
+    prefix = node_prefix(tree, group_info['node'])
+    prompts[group] = []
+    for record in group_info['records']:
+      prompts[group].extend([prefix + record['suffix']] * record['repeats'])
+  return prompts
+
+
+def export_prefix_tree(prompts, output_path, boundary='\n'):
+  """Writes the prefix tree of a prompt dictionary as JSONL.
+
+  The first line holds the `stats`, followed by one line per node (with
+  `"type": "node"`, parents before children) and one line per group (with
+  `"type": "group"`). Paths ending in '.zst' are zstd-compressed, which
+  requires the `zstandard` package.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+    output_path: The file to write.
+    boundary: See `shared_prefix`.
+
+  Returns:
+    tree: The tree from `build_prefix_tree`.
+  """
+  tree = build_prefix_tree(prompts, boundary)
+  lines = [{'type': 'stats', **tree['stats']}]
+  lines += [{'type': 'node', **node} for node in tree['nodes']]
+  lines += [
+      {'type': 'group', 'group': group, **group_info}
+      for group, group_info in tree['groups'].items()
+  ]
+  corpus_export.write_jsonl(output_path, lines)
+  return tree
+
+
+def load_prefix_tree(path):
+  """Reads a prefix tree written by `export_prefix_tree`."""
+  tree = {'nodes': [], 'groups': {}, 'stats': {}}
+  for row in corpus_export.read_jsonl(path):
+    row_type = row.pop('type')
+    if row_type == 'stats':
+      tree['stats'] = row
+    elif row_type == 'node':
+      tree['nodes'].append(row)
+    else:
+      tree['groups'][row.pop('group')] = row
+  return tree
@@ -0,0 +1,255 @@
+"""Parses the distribution and the question back out of a prompt's text.
+
+This inverts the idealized and real-world templates, so that a prompt's true
+answer can be computed from its text alone: the exact percentile of its
+target value, its exact range probability, or its distribution to compare
+samples to. The simulated backend answers from it and the streaming scorer
+scores against it.
+"""
+
+import math
+import re
+
+import numpy as np
+import scipy.stats
+
+from generation.idealized_generation import idealized_distributions
+
+# Prompt description labels to the generation configs' parameter names
+_PARAM_LABELS = {
+    'Mean': 'mean',
+    'Standard Deviation': 'std',
+    'Log Mean (mu)': 'log_mean',
+    'Log Sigma (sigma)': 'sigma',
+    'Rate': 'rate',
+    'Alpha': 'alpha',
+    'Xmin': 'xmin',
+    'Min': 'a',
+    'Max': 'b',
+    'Shape': 'shape',
+    'Scale': 'scale',
+    'Location': 'location',
+    'Skew': 'skew',
+    'Lambda': 'lam',
+    'Probability of Success': 'p',
+    'Trials': 'n',
+    'Probabilities': 'probs',
+    'Means': 'means',
+    'Standard Deviations': 'stds',
+}
+
+_SECTION = re.compile(r'^## ', re.MULTILINE)
+_NUMBER = r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?'
+_FIELD = re.compile(r'^\s*([A-Z][A-Za-z ()]*?):\s*(.+?)\s*$', re.MULTILINE)
+_DESCRIBED_TYPE = re.compile(r'describe an? (.+?) distribution')
+_NUMPY_SCALAR = re.compile(r'np\.\w+\(')
+_OUTCOME = re.compile(r'outcome (\d+)')
+_APPEARS = re.compile(rf'appears ({_NUMBER}) times')
+_PERCENTILE_TARGET = re.compile(rf'percentile of [^\d-]*({_NUMBER})')
+_RANGE = re.compile(rf'between ({_NUMBER}) and ({_NUMBER})\?')
+
+# Distributions built by `cached_distribution`, keyed by their description
+_DISTRIBUTIONS = {}
+
+
+def _type_name(text):
+  """Maps a distribution type like 'Skew-Normal Distribution' to a name."""
+  text = text.lower().replace(' distribution', '').strip()
+  return text.replace('-', '_').replace(' ', '_')
+
+
+def _field_value(value):
+  if value.startswith('['):
+    value = _NUMPY_SCALAR.sub('', value)
+    return [float(v) for v in re.findall(_NUMBER, value)]
+  match = re.match(_NUMBER, value)
+  return float(match.group()) if match else value
+
+
+def parse_prompt(prompt):
+  """Parses the distribution and question out of a prompt's text.
+
+  Args:
+    prompt: A prompt as rendered from the idealized or real-world templates.
+
+  Returns:
+    A dict with the `task`, the `dist_name`, the described `params` (named as
+    in the generation configs, or 'mean' and 'std' when only the moments are
+    described), the `outcome_num` (None unless multinomial), and the
+    question's `target` (percentiles) or `lower` and `upper` bounds
+    (probabilities). None if the prompt can't be parsed.
+  """
+  sections = [s for s in _SECTION.split(prompt) if s.strip()]
+  if not sections:
+    return None
+  instruction = sections[0]
+  if 'estimate the percentile' in instruction:
+    task = 'percentiles'
+  elif 'sample a number' in instruction:
+    task = 'sampling'
+  elif 'probability of being in a range' in instruction:
+    task = 'probabilities'
+  else:
+    return None
+  descriptions = [
+      s for s in sections
+      if s.startswith(('Consider the following', 'Note that the following'))
+  ]
+  if not descriptions:
+    return None
+  heading, _, description = descriptions[0].partition('\n')
+  fields = {
+      label: _field_value(value)
+      for label, value in _FIELD.findall(description)
+  }
+  if 'Distribution Type' in fields:
+    dist_name = _type_name(fields['Distribution Type'])
+  elif _DESCRIBED_TYPE.search(heading):
+    dist_name = _type_name(_DESCRIBED_TYPE.search(heading).group(1))
+  else:
+    return None
+  if dist_name.startswith('normal_(for_each_outcome)'):
+    dist_name = 'multinomial'
+  params = {
+      _PARAM_LABELS[label]: value
+      for label, value in fields.items()
+      if label in _PARAM_LABELS
+  }
+  if 'log_mean' in params:
+    params['mean'] = params.pop('log_mean')
+  if dist_name == 'gumbel' and 'location' in params:
+    params['loc'] = params.pop('location')
+
+  question = sections[-1]
+  outcome = _OUTCOME.search(question)
+  parsed = {
+      'task': task,
+      'dist_name': dist_name,
+      'params': params,
+      'outcome_num': int(outcome.group(1)) if outcome else None,
+  }
+  if task == 'percentiles':
+    target = _APPEARS.search(question) or _PERCENTILE_TARGET.search(question)
+    if not target:
+      return None
+    parsed['target'] = float(target.group(1))
+  elif task == 'probabilities':
+    bounds = _RANGE.search(question)
+    if not bounds:
+      return None
+    parsed['lower'] = float(bounds.group(1))
+    parsed['upper'] = float(bounds.group(2))
+  return parsed
+
+
+def _moment_matched(dist_name, mean, std):
+  """Returns a distribution of the named family with the given moments."""
+  if dist_name == 'log_normal':
+    variance_ratio = 1 + (std / mean) ** 2
+    return scipy.stats.lognorm(
+        math.sqrt(math.log(variance_ratio)),
+        scale=mean / math.sqrt(variance_ratio),
+    )
+  if dist_name == 'gumbel':
+    scale = std * math.sqrt(6) / math.pi
+    return scipy.stats.gumbel_r(mean - np.euler_gamma * scale, scale)
+  if dist_name == 'exponential':
+    return scipy.stats.expon(scale=mean)
+  return scipy.stats.norm(mean, std)
+
+
+def prompt_distribution(parsed):
+  """Returns the frozen scipy.stats distribution a parsed prompt describes.
+
+  Distributions described by their parameters are rebuilt exactly (see
+  `idealized_distributions.scipy_distribution`). Those described only by
+  their mean and standard deviation (the normal approximations and the
+  real-world templates) are moment-matched within their family where it
+  has two parameters or fewer, and taken as normal otherwise.
+  """
+  params = parsed['params']
+  outcome_num = parsed['outcome_num']
+  if 'means' in params:
+    return scipy.stats.norm(
+        params['means'][outcome_num - 1], params['stds'][outcome_num - 1]
+    )
+  try:
+    return idealized_distributions.scipy_distribution(
+        parsed['dist_name'], params, outcome_num
+    )
+  except (KeyError, ValueError):
+    pass
+  if 'mean' in params and 'std' in params:
+    return _moment_matched(parsed['dist_name'], params['mean'], params['std'])
+  raise ValueError(f'Unsupported distribution description: {parsed}')
+
+
+def distribution_key(parsed):
+  """Returns a hashable key of the distribution a parsed prompt describes."""
+  return (
+      parsed['dist_name'],
+      repr(sorted(parsed['params'].items())),
+      parsed['outcome_num'],
+  )
+
+
+def cached_distribution(parsed):
+  """Returns `prompt_distribution(parsed)`, built once per description.
+
+  Prompts of a group differ in their examples and questions but share a
+  handful of distributions, so this caches far fewer entries than prompts.
+  """
+  key = distribution_key(parsed)
+  if key not in _DISTRIBUTIONS:
+    _DISTRIBUTIONS[key] = prompt_distribution(parsed)
+  return _DISTRIBUTIONS[key]
+
+
+def _is_discrete(dist):
+  return isinstance(dist.dist, scipy.stats.rv_discrete)
+
+
+def cdf_below(dist, x):
+  """Returns P(X < x), for a value or an array of values."""
+  if _is_discrete(dist):
+    return dist.cdf(np.ceil(x) - 1)
+  return dist.cdf(x)
+
+
+def range_probability(dist, lower, upper):
+  """Returns P(lower <= X <= upper) among values within the 1st and 99th.
+
+  This mirrors `idealized_distributions.calculate_probability_within_range`
+  on the exact distribution.
+  """
+  low = dist.ppf(0.01)
+  high = dist.ppf(0.99)
+  lower = max(lower, low)
+  upper = min(upper, high)
+  if upper < lower:
+    return 0.0
+  return float(
+      (dist.cdf(upper) - cdf_below(dist, lower))
+      / (dist.cdf(high) - cdf_below(dist, low))
+  )
+
+
+def true_answer(parsed, dist=None):
+  """Returns the exact answer to a parsed percentile or probability prompt.
+
+  Args:
+    parsed: A dict from `parse_prompt`.
+    dist: The prompt's distribution, if already built by
+      `prompt_distribution`.
+
+  Returns:
+    The percentile of the target value (in [0, 100]) or the probability of
+    the range (in [0, 1]), or None for sampling prompts, whose answers are
+    compared to the distribution itself.
+  """
+  if parsed['task'] == 'sampling':
+    return None
+  dist = dist or prompt_distribution(parsed)
+  if parsed['task'] == 'percentiles':
+    return 100 * float(dist.cdf(parsed['target']))
+  return range_probability(dist, parsed['lower'], parsed['upper'])
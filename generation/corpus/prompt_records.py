@@ -0,0 +1,129 @@
+"""Flat, self-describing records for the prompt dictionaries.
+
+The prompt generators return `{prompt_name: [prompt, ...]}`, where each
+prompt is repeated once per requested sample (only few-shot sampling prompts
+differ between samples). The functions here turn that dictionary into one
+record per distinct consecutive prompt, carrying its repeat count and the
+metadata encoded in the prompt name, and back.
+"""
+
+import re
+
+from generation.corpus import dedup_index as dedup_index_lib
+
+_IDEALIZED_NAME = re.compile(
+    r'^(?P<task>percentiles|sampling|probabilities)_(?P<num_shots>\d+)_shots_'
+    r'(?P<dist_name>.+?)(?:_outcome_(?P<outcome>\d+))?'
+    r'_(?P<sample_count>\d+)_samples$'
+)
+_REAL_WORLD_NAME = re.compile(
+    r'^(?P<task>percentiles)_zero_shot_'
+    r'(?P<context>real_world_normal_approx|real_world|idealized'
+    r'|true_NA|distnameandstats|synthetic)_'
+    r'(?P<dist_name>.+)_(?P<sample_count>\d+)_samples$'
+)
+
+# The real-world template families' names in `sample_results_from_paper/`
+_CONTEXT_ALIASES = {
+    'true_NA': 'real_world_normal_approx',
+    'distnameandstats': 'real_world',
+    'synthetic': 'idealized',
+}
+
+
+def parse_prompt_name(prompt_name):
+  """Parses the metadata out of a prompt group name.
+
+  Args:
+    prompt_name: A group name as produced by the idealized or real-world
+      prompt generators, e.g., 'percentiles_3_shots_normal_10_samples' or
+      'percentiles_zero_shot_real_world_average_step_count_10_samples'. The
+      names of the sample results' real-world groups (e.g.,
+      'percentiles_zero_shot_true_NA_...') are recognized too.
+
+  Returns:
+    A dict with the `task`, `num_shots`, `dist_name`, `outcome` (None unless
+    multinomial), `sample_count` and `context` (None for idealized groups, or
+    the real-world template family).
+
+  Raises:
+    ValueError: If the name does not follow either naming scheme.
+  """
+  match = _REAL_WORLD_NAME.match(prompt_name)
+  if match:
+    return {
+        'task': match['task'],
+        'num_shots': 0,
+        'dist_name': match['dist_name'],
+        'outcome': None,
+        'sample_count': int(match['sample_count']),
+        'context': _CONTEXT_ALIASES.get(match['context'], match['context']),
+    }
+  match = _IDEALIZED_NAME.match(prompt_name)
+  if match:
+    return {
+        'task': match['task'],
+        'num_shots': int(match['num_shots']),
+        'dist_name': match['dist_name'],
+        'outcome': int(match['outcome']) if match['outcome'] else None,
+        'sample_count': int(match['sample_count']),
+        'context': None,
+    }
+  raise ValueError(f'Unrecognized prompt group name: {prompt_name}')
+
+
+def iter_prompt_records(prompts, dedup_index=None):
+  """Yields one record per run of identical consecutive prompts.
+
+  Args:
+    prompts: A dict of prompt lists, keyed by group name.
+    dedup_index: An optional open `dedup_index` to register the prompts in.
+
+  Yields:
+    Dicts with a stable `id` ('<group>/<index>'), the `group`, the record's
+    `index` within the group, the `prompt` text, the number of `repeats` and
+    the fields from `parse_prompt_name`. With a dedup index, records also
+    carry the prompt's `canonical_id` and whether it was `new` to the index.
+  """
+  for group, group_prompts in prompts.items():
+    metadata = parse_prompt_name(group)
+    index = 0
+    position = 0
+    while position < len(group_prompts):
+      prompt = group_prompts[position]
+      end = position + 1
+      while end < len(group_prompts) and group_prompts[end] == prompt:
+        end += 1
+      record = {
+          'id': f'{group}/{index:05d}',
+          'group': group,
+          'index': index,
+          'prompt': prompt,
+          'repeats': end - position,
+          **metadata,
+      }
+      if dedup_index is not None:
+        record['canonical_id'], record['new'] = dedup_index_lib.add(
+            dedup_index, prompt
+        )
+      yield record
+      index += 1
+      position = end
+
+
+def expand_prompt_records(records):
+  """Rebuilds the prompt dictionary from records.
+
+  Args:
+    records: An iterable of records as yielded by `iter_prompt_records`,
+      ordered by group and index.
+
+  Returns:
+    A dict of prompt lists, keyed by group name.
+  """
+  prompts = {}
+  for record in records:
+    prompts.setdefault(record['group'], []).extend(
+        [record['prompt']] * record['repeats']
+    )
+  return prompts
@@ -0,0 +1,231 @@
+"""Token accounting and token-budget packing for generated prompts.
+
+Prompt length grows linearly with the number of few-shot examples (each one
+repeats a full distribution description) and varies a lot by family, so the
+cost and latency of a job are best predicted from token counts before it is
+submitted. This module provides:
+
+  * a fast offline token estimator that needs no tokenizer files,
+  * pluggable exact tokenizers ('tiktoken:<encoding or model>',
+    'hf:<model name>', any registered name, or any callable),
+  * per-prompt token counts and per-group summaries, and
+  * packing of few-shot example blocks into a token budget.
+"""
+
+import functools
+import math
+import re
+
+ESTIMATE = 'estimate'
+
+# Approximates the pre-tokenization of common BPE vocabularies: words with
+# their leading space, numbers in runs of up to three digits, punctuation runs
+# and whitespace.
+_PRETOKEN = re.compile(
+    r"'(?:[sdmt]|ll|ve|re)| ?[A-Za-z]+|\d{1,3}| ?[^\sA-Za-z\d]+|\s+(?!\S)|\s+"
+)
+# Letters per token in words too long to be a single vocabulary entry
+_LETTERS_PER_TOKEN = 8
+
+_EXAMPLE_BLOCK = re.compile(r'(?=\nExample \d+:\n)')
+
+_TOKENIZERS = {}
+
+
+def estimate_tokens(text):
+  """Estimates the number of tokens in text without a tokenizer.
+
+  This is a rough estimate for budgeting, tuned for English text with many
+  numbers; use an exact tokenizer where the count has to match the model.
+
+  Args:
+    text: The text to estimate.
+
+  Returns:
+    The estimated token count.
+  """
+  count = 0
+  for pretoken in _PRETOKEN.findall(text):
+    letters = len(pretoken.strip())
+    if letters > _LETTERS_PER_TOKEN and pretoken.strip().isalpha():
+      count += math.ceil(letters / _LETTERS_PER_TOKEN)
+    else:
+      count += 1
+  return count
+
+
+def register_tokenizer(name, count_tokens):
+  """Registers an exact token counter under a name.
+
+  Args:
+    name: The name to refer to the tokenizer by, e.g., in `tokenizer=`.
+    count_tokens: A function mapping a text to its token count.
+  """
+  _TOKENIZERS[name] = count_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def _load_tokenizer(name):
+  """Loads a tokenizer by name, importing its package lazily."""
+  if name in _TOKENIZERS:
+    return _TOKENIZERS[name]
+  if name.startswith('tiktoken:'):
+    import tiktoken
+
+    encoding_name = name.split(':', 1)[1]
+    try:
+      encoding = tiktoken.get_encoding(encoding_name)
+    except ValueError:
+      encoding = tiktoken.encoding_for_model(encoding_name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+  if name.startswith('hf:'):
+    import transformers
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(name.split(':', 1)[1])
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+  raise ValueError(
+      f'Unknown tokenizer: {name}. Please pick from {ESTIMATE!r}, a registered'
+      " tokenizer, 'tiktoken:<encoding or model>' or 'hf:<model name>'."
+  )
+
+
+def get_token_counter(tokenizer=None):
+  """Returns a function that counts the tokens of a text.
+
+  Args:
+    tokenizer: None or 'estimate' for `estimate_tokens`, a tokenizer name
+      (see `_load_tokenizer`), or a function mapping a text to its token
+      count.
+
+  Returns:
+    A function mapping a text to its token count.
+  """
+  if tokenizer is None or tokenizer == ESTIMATE:
+    return estimate_tokens
+  if callable(tokenizer):
+    return tokenizer
+  return _load_tokenizer(tokenizer)
+
+
+def tokenizer_name(tokenizer=None):
+  """Returns a printable name for a tokenizer argument."""
+  if tokenizer is None:
+    return ESTIMATE
+  if callable(tokenizer):
+    return getattr(tokenizer, '__name__', repr(tokenizer))
+  return tokenizer
+
+
+def count_prompt_tokens(prompts, tokenizer=None):
+  """Counts the tokens of every prompt.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+    tokenizer: See `get_token_counter`.
+
+  Returns:
+    A dict of per-prompt token count lists, keyed by group name. Repeated
+    prompts are only tokenized once.
+  """
+  count_tokens = get_token_counter(tokenizer)
+  counts = {}
+  token_counts = {}
+  for group, group_prompts in prompts.items():
+    token_counts[group] = []
+    for prompt in group_prompts:
+      if prompt not in counts:
+        counts[prompt] = count_tokens(prompt)
+      token_counts[group].append(counts[prompt])
+  return token_counts
+
+
+def summarize_token_counts(prompts, tokenizer=None):
+  """Summarizes the input tokens of a prompt dictionary.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+    tokenizer: See `get_token_counter`.
+
+  Returns:
+    A dict with the `tokenizer` name, the total `prompts` and `tokens`, the
+    `max_prompt_tokens`, and a `groups` dict with the same figures per group.
+  """
+  groups = {}
+  for group, counts in count_prompt_tokens(prompts, tokenizer).items():
+    groups[group] = {
+        'prompts': len(counts),
+        'tokens': sum(counts),
+        'max_prompt_tokens': max(counts, default=0),
+    }
+  return {
+      'tokenizer': tokenizer_name(tokenizer),
+      'prompts': sum(group['prompts'] for group in groups.values()),
+      'tokens': sum(group['tokens'] for group in groups.values()),
+      'max_prompt_tokens': max(
+          (group['max_prompt_tokens'] for group in groups.values()), default=0
+      ),
+      'groups': groups,
+  }
+
+
+def split_few_shot_examples(few_shot_examples):
+  """Splits a few-shot examples string into its 'Example N:' blocks."""
+  return [block for block in _EXAMPLE_BLOCK.split(few_shot_examples) if block]
+
+
+def pack_few_shot_examples(few_shot_examples, max_tokens, tokenizer=None):
+  """Keeps the leading few-shot example blocks that fit a token budget.
+
+  Examples are kept in order (and so keep their numbering) until the next
+  one would exceed the budget.
+
+  Args:
+    few_shot_examples: A few-shot examples string, as rendered by the
+      prompt generators.
+    max_tokens: The token budget for the examples.
+    tokenizer: See `get_token_counter`.
+
+  Returns:
+    The packed few-shot examples string.
+  """
+  count_tokens = get_token_counter(tokenizer)
+  packed = ''
+  used = 0
+  for block in split_few_shot_examples(few_shot_examples):
+    block_tokens = count_tokens(block)
+    if used + block_tokens > max_tokens:
+      break
+    packed += block
+    used += block_tokens
+  return packed
+
+
+def few_shot_token_budget(
+    fixed_prompts, max_prompt_tokens=None, max_group_tokens=None,
+    group_size=1, tokenizer=None
+):
+  """Computes how many tokens the few-shot examples of a prompt may use.
+
+  Args:
+    fixed_prompts: The prompts rendered without few-shot examples. The budget
+      is set by the longest one, so that all prompts of a group can share the
+      same examples.
+    max_prompt_tokens: An optional budget per prompt.
+    max_group_tokens: An optional budget per group (batch) of prompts, split
+      evenly over its `group_size` prompts.
+    group_size: The number of prompts in the group.
+    tokenizer: See `get_token_counter`.
+
+  Returns:
+    The example token budget (at least 0), or None if there is no budget.
+  """
+  limits = []
+  if max_prompt_tokens is not None:
+    limits.append(max_prompt_tokens)
+  if max_group_tokens is not None:
+    limits.append(max_group_tokens // max(group_size, 1))
+  if not limits:
+    return None
+  count_tokens = get_token_counter(tokenizer)
+  fixed_tokens = max(count_tokens(prompt) for prompt in fixed_prompts)
+  return max(min(limits) - fixed_tokens, 0)
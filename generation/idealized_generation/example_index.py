@@ -0,0 +1,161 @@
+"""Sorted lookup indexes over distribution summaries and example pools.
+
+Few-shot selection repeatedly looks up the entry of a distribution summary that
+is closest to a target (e.g., the range whose probability is closest to 0.5),
+and the nearest-shot experiments look up the pool examples whose parameters are
+closest to the question distribution. The functions here build the sorted
+arrays once per distribution, so that each lookup is a vectorized binary search
+(or, for example pools, a single vectorized distance computation).
+"""
+
+import numpy as np
+
+
+def build_probability_index(target_ranges):
+  """Builds an index over a {probability: (lower, upper)} dict.
+
+  The keys of a target ranges dict are the realized probabilities of each
+  range and are not guaranteed to be in ascending order, so they are sorted
+  here once.
+
+  Args:
+    target_ranges: A dict mapping probabilities to (lower, upper) ranges.
+
+  Returns:
+    A dict with the probability `keys` in ascending order and the matching
+    `probabilities`, `lower` and `upper` arrays.
+  """
+  keys = sorted(target_ranges)
+  return {
+      'keys': keys,
+      'probabilities': np.array(keys, dtype=float),
+      'lower': np.array([target_ranges[key][0] for key in keys], dtype=float),
+      'upper': np.array([target_ranges[key][1] for key in keys], dtype=float),
+  }
+
+
+def _nearest_positions(sorted_values, targets):
+  """Finds the position of the nearest sorted value for each target.
+
+  Ties go to the smaller value, matching the bisect-based lookup this
+  replaces.
+
+  Args:
+    sorted_values: A 1-D array sorted in ascending order.
+    targets: The values to look up.
+
+  Returns:
+    An integer array of positions into `sorted_values`.
+  """
+  targets = np.asarray(targets, dtype=float)
+  positions = np.searchsorted(sorted_values, targets, side='left')
+  after = np.clip(positions, 0, len(sorted_values) - 1)
+  before = np.clip(positions - 1, 0, len(sorted_values) - 1)
+  take_after = (sorted_values[after] - targets) < (
+      targets - sorted_values[before]
+  )
+  return np.where(take_after, after, before)
+
+
+def closest_probabilities(probability_index, target_probabilities):
+  """Finds the indexed probability closest to each target probability.
+
+  Args:
+    probability_index: An index from `build_probability_index`.
+    target_probabilities: The probabilities to look up.
+
+  Returns:
+    A list with the closest original probability key for each target.
+  """
+  positions = _nearest_positions(
+      probability_index['probabilities'], target_probabilities
+  )
+  return [probability_index['keys'][position] for position in positions]
+
+
+def parameter_vector(params):
+  """Flattens a distribution's parameters into a vector, ordered by name.
+
+  Args:
+    params: A dict of distribution parameters. Sequence-valued parameters
+      (e.g., multinomial 'probs') are flattened in place.
+
+  Returns:
+    A 1-D float array.
+  """
+  return np.concatenate(
+      [np.ravel(np.asarray(params[key], dtype=float)) for key in sorted(params)]
+  )
+
+
+def build_parameter_index(params_list):
+  """Builds an index for nearest-parameter search over an example pool.
+
+  Args:
+    params_list: A list of parameter dicts, one per example, sharing the same
+      keys.
+
+  Returns:
+    A dict with the stacked parameter `vectors` and the per-dimension `scale`
+    used to normalize distances, so that parameters with large ranges (e.g.,
+    'n') do not drown out small ones (e.g., 'p').
+  """
+  vectors = np.stack([parameter_vector(params) for params in params_list])
+  scale = vectors.std(axis=0)
+  scale[scale == 0] = 1.0
+  return {'vectors': vectors, 'scale': scale}
+
+
+def nearest_examples(parameter_index, params, k):
+  """Finds the k pool examples nearest to the given parameters.
+
+  Args:
+    parameter_index: An index from `build_parameter_index`.
+    params: The parameter dict to search around.
+    k: The number of examples to return.
+
+  Returns:
+    An integer array of up to k example positions, nearest first.
+  """
+  vectors = parameter_index['vectors']
+  k = min(k, len(vectors))
+  if k <= 0:
+    return np.array([], dtype=np.int64)
+  distances = np.linalg.norm(
+      (vectors - parameter_vector(params)) / parameter_index['scale'], axis=1
+  )
+  nearest = np.argpartition(distances, k - 1)[:k]
+  return nearest[np.argsort(distances[nearest], kind='stable')]
+
+
+def _index_table(table, build_index):
+  """Indexes a summary table, per outcome for multinomial tables."""
+  if table and isinstance(next(iter(table)), str):
+    return {outcome: build_index(values) for outcome, values in table.items()}
+  return {None: build_index(table)}
+
+
+def build_example_index(dist_info):
+  """Builds the reusable lookup index for one entry of `distributions_info`.
+
+  Args:
+    dist_info: A dict as produced by `generate_distributions_and_examples`
+      for a single distribution.
+
+  Returns:
+    A dict holding, for every range table present in `dist_info`, its index
+    keyed by outcome (None for non-multinomial distributions), and under
+    'examples' a parameter index over the example pool when the examples carry
+    their parameters.
+  """
+  index = {}
+  for field in ('target_ranges', 'target_intermediate_ranges'):
+    if dist_info.get(field):
+      index[field] = _index_table(dist_info[field], build_probability_index)
+
+  examples = dist_info.get('examples', [])
+  if examples and all('params' in example for example in examples):
+    index['examples'] = build_parameter_index(
+        [example['params'] for example in examples]
+    )
+  return index
@@ -1407,3 +1407,51 @@ def multinomial_distribution(
         f'Unsupported task: {task}. Please pick from percentiles, sampling, or'
         ' probabilities.'
     )
+
+
+def scipy_distribution(dist_name, params, outcome_num=None):
+  """Returns the frozen scipy.stats distribution that samples are drawn from.
+
+  Args:
+    dist_name: The distribution name, as in the generation configs (e.g.,
+      'normal', 'power_law', 'multinomial').
+    params: The distribution's parameters, as passed to its function above.
+    outcome_num: The (1-based) outcome of a multinomial distribution, whose
+      count is binomially distributed.
+
+  Returns:
+    A frozen scipy.stats distribution.
+
+  Raises:
+    ValueError: If the distribution is not supported.
+  """
+  if dist_name == 'normal':
+    return scipy.stats.norm(params['mean'], params['std'])
+  if dist_name == 'log_normal':
+    return scipy.stats.lognorm(params['sigma'], scale=np.exp(params['mean']))
+  if dist_name == 'exponential':
+    return scipy.stats.expon(scale=1 / params['rate'])
+  if dist_name == 'power_law':
+    # Samples are xmin * (1 - U)^(-1 / (alpha - 1)), a Pareto distribution
+    return scipy.stats.pareto(params['alpha'] - 1, scale=params['xmin'])
+  if dist_name == 'uniform':
+    return scipy.stats.uniform(params['a'], params['b'] - params['a'])
+  if dist_name == 'gamma':
+    return scipy.stats.gamma(params['shape'], scale=params['scale'])
+  if dist_name == 'skew_normal':
+    return scipy.stats.skewnorm(
+        params['skew'], loc=params['location'], scale=params['scale']
+    )
+  if dist_name == 'gumbel':
+    return scipy.stats.gumbel_r(params['loc'], params['scale'])
+  if dist_name == 'poisson':
+    return scipy.stats.poisson(params['lam'])
+  if dist_name == 'geometric':
+    return scipy.stats.geom(params['p'])
+  if dist_name == 'binomial':
+    return scipy.stats.binom(params['n'], params['p'])
+  if dist_name == 'multinomial':
+    if outcome_num is None:
+      raise ValueError('Please pass the outcome_num of a multinomial.')
+    return scipy.stats.binom(params['n'], params['probs'][outcome_num - 1])
+  raise ValueError(f'Unsupported distribution: {dist_name}.')
@@ -336,6 +336,7 @@ def generate_distributions_and_examples(
       raise ValueError('Unexpected number of return values from the function')
     distributions_info[config['name']] = {
         'description': description,
+        'params': config['params'],
         'examples': [],
     }
     if task == 'percentiles':
@@ -377,16 +378,19 @@ def generate_distributions_and_examples(
         if task == 'percentiles':
           examples.append({
               'description': description,
+              'params': params,
               'target_percentile_values': output,
           })
         elif task == 'sampling':
           examples.append({
               'description': description,
+              'params': params,
               'samples': output,
           })
         elif task == 'probabilities':
           examples.append({
               'description': description,
+              'params': params,
               'target_ranges': output,
           })
 
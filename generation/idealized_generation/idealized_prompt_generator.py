@@ -1,16 +1,354 @@
 """General library for prompt generation.
 """
 
-import bisect
+import concurrent.futures
+import functools
+import hashlib
 import random
+import numpy as np
+from generation.corpus import incremental
+from generation.corpus import token_accounting
+from generation.idealized_generation import example_index
 from templates.idealized_distributions import idealized
 
+# Bump when the rendering code changes, to invalidate incremental outputs.
+_INCREMENTAL_VERSION = 1
+
+
+def make_group_rng(seed, task, dist_name, outcome, num_shots):
+  """Creates an independent random generator for a single prompt group.
+
+  The stream only depends on `seed` and the group's identity, never on which
+  other groups were generated before it, so groups can be generated in any
+  order (or on their own) and still come out identical.
+
+  Args:
+    seed: The base seed for the prompt corpus.
+    task: The task name (e.g., 'percentiles').
+    dist_name: The name of the distribution.
+    outcome: The multinomial outcome (e.g., 'Outcome 1'), or None.
+    num_shots: The number of few-shot examples in the group.
+
+  Returns:
+    A `numpy.random.Generator` for the group.
+  """
+  group_key = f'{task}/{dist_name}/{outcome}/{num_shots}'.encode('utf-8')
+  group_digest = hashlib.sha256(group_key).digest()
+  return np.random.default_rng(
+      [seed, int.from_bytes(group_digest[:8], 'little')]
+  )
+
+
+def _select_group_rng(rng, seed, task, dist_name, outcome, num_shots):
+  """Returns the generator a group should draw from, or None for `random`."""
+  if seed is not None:
+    return make_group_rng(seed, task, dist_name, outcome, num_shots)
+  return rng
+
+
+def _check_rng_and_seed(rng, seed):
+  """Raises a ValueError if both an rng and a seed were provided."""
+  if rng is not None and seed is not None:
+    raise ValueError('Only one of rng and seed can be provided.')
+
+
+def _choice(sequence, rng=None):
+  """Picks one element, from `rng` if given and otherwise from `random`."""
+  if rng is None:
+    return random.choice(sequence)
+  return sequence[rng.integers(len(sequence))]
+
+
+def _sample(population, k, rng=None):
+  """Picks k distinct elements, from `rng` if given and otherwise `random`."""
+  if rng is None:
+    return random.sample(population, k)
+  return [population[i] for i in rng.choice(len(population), k, replace=False)]
+
+
+def _check_workers(seed, workers):
+  """Raises a ValueError if parallel generation was requested without a seed."""
+  if workers is not None and workers > 1 and seed is None:
+    raise ValueError(
+        'Generating prompts on more than one worker requires a seed.'
+    )
+
+
+def _check_incremental(seed, incremental_dir):
+  """Raises a ValueError if incremental generation lacks a seed."""
+  if incremental_dir is not None and seed is None:
+    raise ValueError('Incremental prompt generation requires a seed.')
+
+
+def _render_seeded_group(render_group, seed, spec):
+  """Renders one group spec on a worker process from its own seeded stream."""
+  return render_group(
+      spec,
+      make_group_rng(
+          seed,
+          spec['task'],
+          spec['dist_name'],
+          spec['outcome'],
+          spec['num_shots'],
+      ),
+  )
+
+
+def _tokenizer_key(tokenizer):
+  """Returns an identifier of a tokenizer argument that is stable across runs.
+
+  Raises:
+    ValueError: If the tokenizer is a function without a stable identity
+      (e.g., a lambda, a nested function or a `functools.partial`).
+  """
+  if not callable(tokenizer):
+    return tokenizer
+  module = getattr(tokenizer, '__module__', None)
+  qualname = getattr(tokenizer, '__qualname__', None)
+  if module is None or qualname is None or '<' in qualname:
+    raise ValueError(
+        'Incremental prompt generation requires a tokenizer name or a'
+        f' module-level tokenizer function, not {tokenizer!r}.'
+    )
+  return f'{module}.{qualname}'
+
+
+def _group_input_hash(spec, seed, memo):
+  """Hashes everything a group's prompts are rendered from.
+
+  The spec already holds the group's distribution summary, the examples (or
+  the drawn few-shot values) it selects from, its shot and sample counts and
+  its options. The template is hashed by its text, so that editing a template
+  only invalidates the groups that use it. The example index is derived from
+  the summaries and is left out.
+  """
+  inputs = {key: value for key, value in spec.items() if key != 'example_index'}
+  if spec.get('token_budget') is not None:
+    # A function's repr holds its address, which changes on every run
+    inputs['token_budget'] = dict(
+        spec['token_budget'],
+        tokenizer=_tokenizer_key(spec['token_budget']['tokenizer']),
+    )
+  inputs['template_text'] = getattr(idealized, spec['template'])
+  inputs['seed'] = seed
+  inputs['version'] = _INCREMENTAL_VERSION
+  return incremental.hash_inputs(inputs, memo)
+
+
+def _render_groups_incrementally(
+    render_group, group_specs, seed, workers, incremental_dir
+):
+  """Renders only the group specs whose inputs changed since the last run.
+
+  See `_render_groups`. Groups with an unchanged input hash are read back
+  from `incremental_dir`; the others are rendered, and written there along
+  with the updated manifest.
+  """
+  manifest = incremental.load_manifest(incremental_dir)
+  group_specs = list(group_specs)
+  memo = {}
+  input_hashes = {
+      spec['prompt_name']: _group_input_hash(spec, seed, memo)
+      for spec in group_specs
+  }
+  stale_specs = [
+      spec
+      for spec in group_specs
+      if not incremental.is_current(
+          incremental_dir,
+          manifest,
+          spec['prompt_name'],
+          input_hashes[spec['prompt_name']],
+      )
+  ]
+  rendered = _render_groups(render_group, stale_specs, None, seed, workers)
+  for prompt_name, group_prompts in rendered.items():
+    incremental.write_group(
+        incremental_dir,
+        manifest,
+        prompt_name,
+        input_hashes[prompt_name],
+        group_prompts,
+    )
+  manifest['last_run'] = {
+      'regenerated': list(rendered),
+      'reused': len(group_specs) - len(rendered),
+  }
+  incremental.save_manifest(incremental_dir, manifest)
+
+  prompts = {}
+  for spec in group_specs:
+    prompt_name = spec['prompt_name']
+    if prompt_name in rendered:
+      prompts[prompt_name] = rendered[prompt_name]
+    else:
+      prompts[prompt_name] = incremental.read_group(
+          incremental_dir, manifest, prompt_name
+      )
+  return prompts
+
+
+def _render_groups(
+    render_group, group_specs, rng, seed, workers, incremental_dir=None
+):
+  """Renders prompt group specs, optionally on a pool of worker processes.
+
+  Args:
+    render_group: A module-level function taking a group spec and the group's
+      generator (or None) and returning the group's list of prompts.
+    group_specs: An iterable of group specs, in output order.
+    rng: The shared `numpy.random.Generator`, or None.
+    seed: The base seed for per-group generators, or None.
+    workers: The number of worker processes, or None to render in-process.
+    incremental_dir: An optional directory to render incrementally in (see
+      `_render_groups_incrementally`). Requires `seed`.
+
+  Returns:
+    prompts: A dictionary of prompts keyed by the specs' prompt names, in the
+    order of `group_specs` regardless of which worker finished first.
+  """
+  _check_workers(seed, workers)
+  _check_incremental(seed, incremental_dir)
+  if incremental_dir is not None:
+    return _render_groups_incrementally(
+        render_group, group_specs, seed, workers, incremental_dir
+    )
+  prompts = {}
+
+  if workers is not None and workers > 1:
+    group_specs = list(group_specs)
+    chunksize = max(1, len(group_specs) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers
+    ) as executor:
+      rendered_groups = executor.map(
+          functools.partial(_render_seeded_group, render_group, seed),
+          group_specs,
+          chunksize=chunksize,
+      )
+      for spec, group_prompts in zip(group_specs, rendered_groups):
+        prompts[spec['prompt_name']] = group_prompts
+    return prompts
+
+  for spec in group_specs:
+    group_rng = _select_group_rng(
+        rng,
+        seed,
+        spec['task'],
+        spec['dist_name'],
+        spec['outcome'],
+        spec['num_shots'],
+    )
+    prompts[spec['prompt_name']] = render_group(spec, group_rng)
+  return prompts
+
+
+def _check_nearest_examples(dist_name, dist_info, dist_index):
+  """Raises a ValueError if a distribution can't do nearest example lookup."""
+  if 'examples' not in dist_index or dist_info.get('params') is None:
+    raise ValueError(
+        f'Nearest example selection for {dist_name} requires the parameters'
+        ' of the distribution and of all of its examples.'
+    )
+
+
+def _group_examples(spec):
+  """Returns the example pool a group selects its few-shot examples from.
+
+  With nearest example selection, the pool is narrowed down to the
+  `num_shots` examples closest to the group's distribution by parameter
+  distance.
+  """
+  if not spec['use_nearest_examples']:
+    return spec['examples']
+  nearest = example_index.nearest_examples(
+      spec['example_index']['examples'], spec['params'], spec['num_shots']
+  )
+  return [spec['examples'][position] for position in nearest]
+
+
+def _token_budget(max_prompt_tokens, max_group_tokens, tokenizer):
+  """Bundles the token budget options, or returns None without a budget."""
+  if max_prompt_tokens is None and max_group_tokens is None:
+    return None
+  return {
+      'max_prompt_tokens': max_prompt_tokens,
+      'max_group_tokens': max_group_tokens,
+      'tokenizer': tokenizer,
+  }
+
+
+def _with_token_budget(group_specs, token_budget):
+  """Attaches the token budget to every group spec."""
+  for spec in group_specs:
+    spec['token_budget'] = token_budget
+    yield spec
+
+
+def _fit_token_budget(
+    few_shot_examples, template, format_kwargs_list, group_size, token_budget
+):
+  """Drops trailing few-shot examples until the prompts fit the budget.
+
+  Args:
+    few_shot_examples: The few-shot examples string shared by the prompts.
+    template: The prompt template.
+    format_kwargs_list: The template arguments (other than the examples) of
+      each distinct prompt sharing the examples.
+    group_size: The number of prompts in the group, for group budgets.
+    token_budget: A budget from `_token_budget`, or None.
+
+  Returns:
+    The few-shot examples string, packed to the budget.
+  """
+  if token_budget is None or not few_shot_examples:
+    return few_shot_examples
+  budget = token_accounting.few_shot_token_budget(
+      [
+          template.format(few_shot_examples='', **format_kwargs)
+          for format_kwargs in format_kwargs_list
+      ],
+      max_prompt_tokens=token_budget['max_prompt_tokens'],
+      max_group_tokens=token_budget['max_group_tokens'],
+      group_size=group_size,
+      tokenizer=token_budget['tokenizer'],
+  )
+  return token_accounting.pack_few_shot_examples(
+      few_shot_examples, budget, token_budget['tokenizer']
+  )
+
+
+def _check_compact_examples(compact_examples, use_stats, use_nearest_shot=False):
+  """Raises a ValueError if compact examples can't be used."""
+  if not compact_examples:
+    return
+  if not use_stats:
+    raise ValueError(
+        'Compact examples require distribution (or intermediate) stats shot'
+        ' examples.'
+    )
+  if use_nearest_shot:
+    raise ValueError('Compact examples are not supported for nearest shot.')
+
+
+def _compact_example(example_number, question, answer):
+  """Renders a single few-shot example as a short question/answer pair."""
+  return f"""
+Example {example_number}:
+Question: {question}
+Answer: <answer>{answer}</answer>
+"""
+
 
 def generate_distribution_percentiles_stats_examples(
     distribution_description, target_percentile_values, num_shots,
-    selected_outcome=None
+    selected_outcome=None, compact=False
 ):
-  """Generates few-shot examples using distribution stats."""
+  """Generates few-shot examples using distribution stats.
+
+  With `compact`, the examples only list short question/answer pairs, since
+  the distribution is stated once in the compact prompt templates.
+  """
   few_shot_examples = ''
   percentiles_map = {
       1: [50.0],
@@ -33,7 +371,15 @@ def generate_distribution_percentiles_stats_examples(
       target_number = values.get(percentile)
       if target_number is not None:
         outcome_num = int(selected_outcome.split()[-1])
-        few_shot_examples += f"""
+        if compact:
+          few_shot_examples += _compact_example(
+              example_number,
+              f'If outcome {outcome_num} appears {target_number} times,'
+              ' what is its percentile?',
+              percentile,
+          )
+        else:
+          few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -47,7 +393,14 @@ Answer:
       # Non-multinomial case
       target_number = target_percentile_values.get(percentile)
       if target_number is not None:
-        few_shot_examples += f"""
+        if compact:
+          few_shot_examples += _compact_example(
+              example_number,
+              f'What is the percentile of {target_number}?',
+              percentile,
+          )
+        else:
+          few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -63,9 +416,13 @@ Answer:
 
 def generate_intermediate_percentiles_stats_examples(
     distribution_description, intermediate_stats, num_shots,
-    selected_outcome=None
+    selected_outcome=None, compact=False
 ):
-  """Generates few-shot examples using intermediate stats."""
+  """Generates few-shot examples using intermediate stats.
+
+  With `compact`, the examples only list short question/answer pairs, since
+  the distribution is stated once in the compact prompt templates.
+  """
   few_shot_examples = ''
   percentiles_map = {
       1: [55.0],
@@ -88,7 +445,15 @@ def generate_intermediate_percentiles_stats_examples(
       target_number = values.get(percentile)
       if target_number is not None:
         outcome_num = int(selected_outcome.split()[-1])
-        few_shot_examples += f"""
+        if compact:
+          few_shot_examples += _compact_example(
+              example_number,
+              f'If outcome {outcome_num} appears {target_number} times,'
+              ' what is its percentile?',
+              percentile,
+          )
+        else:
+          few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -102,7 +467,14 @@ Answer:
       # Non-multinomial case
       target_number = intermediate_stats.get(percentile)
       if target_number is not None:
-        few_shot_examples += f"""
+        if compact:
+          few_shot_examples += _compact_example(
+              example_number,
+              f'What is the percentile of {target_number}?',
+              percentile,
+          )
+        else:
+          few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -117,11 +489,11 @@ Answer:
 
 
 def generate_few_shot_percentile_examples(
-    examples, num_shots, _, selected_outcome=None
+    examples, num_shots, _, selected_outcome=None, rng=None
 ):
   """Generates few-shot examples for the percentiles task."""
   few_shot_examples = ''
-  sampled_examples = random.sample(examples, min(num_shots, len(examples)))
+  sampled_examples = _sample(examples, min(num_shots, len(examples)), rng)
   example_number = 1
 
   for _, example in enumerate(sampled_examples):
@@ -130,12 +502,12 @@ def generate_few_shot_percentile_examples(
 
     if selected_outcome is not None:
       # Randomly select an outcome from the sampled example
-      outcome = random.choice(list(target_percentile_values.keys()))
+      outcome = _choice(list(target_percentile_values.keys()), rng)
       outcome_num = int(
           outcome.split()[-1]
       )  # Extract the number from 'Outcome X'
       values = target_percentile_values[outcome]
-      percentile, target_number = random.choice(list(values.items()))
+      percentile, target_number = _choice(list(values.items()), rng)
       few_shot_examples += f"""
 Example {example_number}:
 Distribution:
@@ -146,8 +518,8 @@ Answer:
 <answer>{percentile}</answer>
 """
     else:
-      percentile, target_number = random.choice(
-          list(target_percentile_values.items())
+      percentile, target_number = _choice(
+          list(target_percentile_values.items()), rng
       )
       few_shot_examples += f"""
 Example {example_number}:
@@ -163,13 +535,163 @@ Answer:
   return few_shot_examples
 
 
+def _percentiles_group_specs(
+    distributions_info,
+    sample_count,
+    shot_list,
+    use_distribution_stats,
+    use_intermediate_stats,
+    use_nearest_shot,
+    use_nearest_examples,
+    compact_examples,
+):
+  """Yields one self-contained spec per percentiles prompt group, in order."""
+  for dist_name, dist_info in distributions_info.items():
+    target_percentile_values = dist_info.get('target_percentile_values', {})
+    # Only the summaries are kept, so specs stay cheap to send to workers
+    examples = [
+        {
+            'description': example['description'],
+            'target_percentile_values': example['target_percentile_values'],
+        }
+        for example in dist_info.get('examples', [])
+    ]
+    dist_index = example_index.build_example_index(dist_info)
+    if use_nearest_examples:
+      _check_nearest_examples(dist_name, dist_info, dist_index)
+
+    if dist_name == 'multinomial':
+      outcomes = list(target_percentile_values.keys())
+    else:
+      outcomes = [None]
+
+    for outcome in outcomes:
+      for num_shots in shot_list:
+        if outcome is not None:
+          prompt_name = (
+              f'percentiles_{num_shots}_shots_{dist_name}_outcome_'
+              f'{int(outcome.split()[-1])}_{sample_count}_samples'
+          )
+          template = (
+              'nearest_shot_multinomial_distribution_percentile_prompt'
+              if use_nearest_shot
+              else 'multinomial_distribution_percentile_prompt'
+          )
+        else:
+          prompt_name = (
+              f'percentiles_{num_shots}_shots_{dist_name}_{sample_count}_'
+              'samples'
+          )
+          template = (
+              'nearest_shot_distribution_percentile_prompt'
+              if use_nearest_shot
+              else 'distribution_percentile_prompt'
+          )
+        if compact_examples:
+          template = f'compact_{template}'
+        yield {
+            'prompt_name': prompt_name,
+            'task': 'percentiles',
+            'dist_name': dist_name,
+            'outcome': outcome,
+            'num_shots': num_shots,
+            'sample_count': sample_count,
+            'template': template,
+            'description': dist_info['description'],
+            'examples': examples,
+            'target_percentile_values': target_percentile_values,
+            'intermediate_stats': dist_info.get(
+                'target_intermediate_percentile_values', {}
+            ),
+            'params': dist_info.get('params'),
+            'example_index': dist_index,
+            'use_distribution_stats': use_distribution_stats,
+            'use_intermediate_stats': use_intermediate_stats,
+            'use_nearest_examples': use_nearest_examples,
+            'compact_examples': compact_examples,
+        }
+
+
+def _render_percentiles_group(spec, rng):
+  """Renders the prompts of one percentiles group spec."""
+  outcome = spec['outcome']
+  if spec['use_distribution_stats']:
+    few_shot_examples = generate_distribution_percentiles_stats_examples(
+        spec['description'],
+        spec['target_percentile_values'],
+        spec['num_shots'],
+        selected_outcome=outcome,
+        compact=spec['compact_examples'],
+    )
+  elif spec['use_intermediate_stats']:
+    few_shot_examples = generate_intermediate_percentiles_stats_examples(
+        spec['description'],
+        spec['intermediate_stats'],
+        spec['num_shots'],
+        selected_outcome=outcome,
+        compact=spec['compact_examples'],
+    )
+  else:
+    few_shot_examples = generate_few_shot_percentile_examples(
+        _group_examples(spec),
+        spec['num_shots'],
+        spec['dist_name'],
+        selected_outcome=outcome,
+        rng=rng,
+    )
+
+  template = getattr(idealized, spec['template'])
+  if outcome is not None:
+    target_numbers = spec['target_percentile_values'][outcome].values()
+    outcome_kwargs = {'outcome_num': int(outcome.split()[-1])}
+  else:
+    target_numbers = spec['target_percentile_values'].values()
+    outcome_kwargs = {}
+
+  few_shot_examples = _fit_token_budget(
+      few_shot_examples,
+      template,
+      [
+          {
+              'distribution_description': spec['description'],
+              'target_number': target_number,
+              **outcome_kwargs,
+          }
+          for target_number in target_numbers
+      ],
+      len(target_numbers) * spec['sample_count'],
+      spec.get('token_budget'),
+  )
+
+  prompts = []
+  for target_number in target_numbers:
+    prompt = template.format(
+        few_shot_examples=few_shot_examples,
+        distribution_description=spec['description'],
+        target_number=target_number,
+        **outcome_kwargs,
+    )
+    # Repeat prompt based on SAMPLE_COUNT
+    prompts.extend([prompt] * spec['sample_count'])
+  return prompts
+
+
 def generate_percentiles_prompts(
     distributions_info,
     sample_count=10,
     shot_list=(0, 1, 3, 5, 7, 9),
     use_distribution_stats=False,
     use_intermediate_stats=False,
-    use_nearest_shot=False
+    use_nearest_shot=False,
+    use_nearest_examples=False,
+    compact_examples=False,
+    max_prompt_tokens=None,
+    max_group_tokens=None,
+    tokenizer=None,
+    rng=None,
+    seed=None,
+    workers=None,
+    incremental_dir=None,
 ):
   """Generates prompts for the percentiles task.
 
@@ -180,113 +702,89 @@ def generate_percentiles_prompts(
     shot_list: List of shot counts to generate prompts for.
     use_distribution_stats: Use distribution stats as shot examples.
     use_intermediate_stats: Use intermediate stats as shot examples.
+    use_nearest_shot: Ask for the nearest example's answer instead.
+    use_nearest_examples: Use the pool examples nearest to the distribution by
+      parameter distance as shot examples, instead of random ones.
+    compact_examples: Use the compact templates, which state the distribution
+      once and list the stats shot examples as short question/answer pairs.
+      Requires `use_distribution_stats` or `use_intermediate_stats`.
+    max_prompt_tokens: An optional token budget per prompt. Trailing few-shot
+      examples are dropped until the prompts fit it.
+    max_group_tokens: An optional token budget per group of prompts, split
+      evenly over its prompts and applied like `max_prompt_tokens`.
+    tokenizer: The tokenizer to count tokens for the budgets with (see
+      `token_accounting.get_token_counter`). Defaults to the offline
+      estimate. With workers, it must be a name or a picklable function,
+      and with `incremental_dir`, a name or a module-level function.
+    rng: An optional `numpy.random.Generator` to select few-shot examples with
+      instead of the global `random` module.
+    seed: An optional seed. If provided, every (distribution, outcome, shot
+      count) group draws from its own independent generator (see
+      `make_group_rng`). Mutually exclusive with `rng`.
+    workers: The number of worker processes to build groups on. More than one
+      worker requires `seed`.
+    incremental_dir: An optional directory that keeps each group's prompts
+      keyed by a hash of the group's inputs (see `incremental`). On a rerun,
+      only groups whose inputs changed (e.g., after editing a template or a
+      family config) are regenerated and rewritten. Requires `seed`.
 
   Returns:
     prompts: A dictionary of prompts grouped by shot count and sample count.
   """
-  prompts = {}
-
-  for dist_name, dist_info in distributions_info.items():
-    distribution_description = dist_info['description']
-    examples = dist_info.get('examples', [])
-    target_percentile_values = dist_info.get('target_percentile_values', {})
-    intermediate_stats = dist_info.get(
-        'target_intermediate_percentile_values', {}
-    )
-
-    if dist_name == 'multinomial':
-      for outcome in target_percentile_values.keys():
-        for num_shots in shot_list:
-          if use_distribution_stats:
-            few_shot_examples = (
-                generate_distribution_percentiles_stats_examples(
-                    distribution_description,
-                    target_percentile_values,
-                    num_shots,
-                    selected_outcome=outcome,
-                )
-            )
-          elif use_intermediate_stats:
-            few_shot_examples = (
-                generate_intermediate_percentiles_stats_examples(
-                    distribution_description,
-                    intermediate_stats,
-                    num_shots,
-                    selected_outcome=outcome,
-                )
-            )
-          else:
-            few_shot_examples = generate_few_shot_percentile_examples(
-                examples, num_shots, dist_name, selected_outcome=outcome
-            )
-
-          for _, target_number in target_percentile_values[outcome].items():
-            if use_nearest_shot:
-              prompt = (
-                  idealized.nearest_shot_multinomial_distribution_percentile_prompt.format(
-                      few_shot_examples=few_shot_examples,
-                      distribution_description=distribution_description,
-                      target_number=target_number,
-                      outcome_num=int(outcome.split()[-1]),
-                  )
-              )
-            else:
-              prompt = (
-                  idealized.multinomial_distribution_percentile_prompt.format(
-                      few_shot_examples=few_shot_examples,
-                      distribution_description=distribution_description,
-                      target_number=target_number,
-                      outcome_num=int(outcome.split()[-1]),
-                  )
-              )
-            prompt_name = (
-                f'percentiles_{num_shots}_shots_{dist_name}_outcome_'
-                f'{int(outcome.split()[-1])}_{sample_count}_samples'
-            )
-            if prompt_name not in prompts:
-              prompts[prompt_name] = []
-            # Repeat prompt based on SAMPLE_COUNT
-            prompts[prompt_name].extend([prompt] * sample_count)
-    else:
-      for num_shots in shot_list:
-        if use_distribution_stats:
-          few_shot_examples = generate_distribution_percentiles_stats_examples(
-              distribution_description, target_percentile_values, num_shots
-          )
-        elif use_intermediate_stats:
-          few_shot_examples = generate_intermediate_percentiles_stats_examples(
-              distribution_description, intermediate_stats, num_shots
-          )
-        else:
-          few_shot_examples = generate_few_shot_percentile_examples(
-              examples, num_shots, dist_name, selected_outcome=None
-          )
-
-        for _, target_number in target_percentile_values.items():
-          if use_nearest_shot:
-            prompt = (
-                idealized.nearest_shot_distribution_percentile_prompt.format(
-                    few_shot_examples=few_shot_examples,
-                    distribution_description=distribution_description,
-                    target_number=target_number,
-                )
-            )
-          else:
-            prompt = idealized.distribution_percentile_prompt.format(
-                few_shot_examples=few_shot_examples,
-                distribution_description=distribution_description,
-                target_number=target_number,
-            )
-          prompt_name = (
-              f'percentiles_{num_shots}_shots_{dist_name}_{sample_count}_'
-              'samples'
-          )
-          if prompt_name not in prompts:
-            prompts[prompt_name] = []
-          # Repeat prompt based on SAMPLE_COUNT
-          prompts[prompt_name].extend([prompt] * sample_count)
-
-  return prompts
+  _check_rng_and_seed(rng, seed)
+  _check_compact_examples(
+      compact_examples,
+      use_distribution_stats or use_intermediate_stats,
+      use_nearest_shot,
+  )
+  group_specs = _percentiles_group_specs(
+      distributions_info,
+      sample_count,
+      shot_list,
+      use_distribution_stats,
+      use_intermediate_stats,
+      use_nearest_shot,
+      use_nearest_examples,
+      compact_examples,
+  )
+  group_specs = _with_token_budget(
+      group_specs,
+      _token_budget(max_prompt_tokens, max_group_tokens, tokenizer),
+  )
+  return _render_groups(
+      _render_percentiles_group,
+      group_specs,
+      rng,
+      seed,
+      workers,
+      incremental_dir,
+  )
+
+
+def _sampling_example(example_number, description, sample_value,
+                      outcome_num=None, compact=False):
+  """Renders a single few-shot example for the sampling task."""
+  if compact:
+    return _compact_example(example_number, 'Sample a number.', sample_value)
+  if outcome_num is not None:
+    return f"""
+Example {example_number}:
+Distribution:
+{description}
+Question:
+Sample a number from the outcome {outcome_num} distribution and output only the numerical value.
+Answer:
+<answer>{sample_value}</answer>
+"""
+  return f"""
+Example {example_number}:
+Distribution:
+{description}
+Question:
+Sample a number from the provided distribution and output only the numerical value.
+Answer:
+<answer>{sample_value}</answer>
+"""
 
 
 def generate_few_shot_sampling_examples(examples, num_shots, dist_name):
@@ -304,33 +802,168 @@ def generate_few_shot_sampling_examples(examples, num_shots, dist_name):
       outcome_num = int(outcome.split()[-1])  # Extract the number from 'Outcome X'
       outcome_samples = samples[outcome]
       sample_value = random.choice(outcome_samples)
-      few_shot_examples += f"""
-Example {i + 1}:
-Distribution:
-{example_description}
-Question:
-Sample a number from the outcome {outcome_num} distribution and output only the numerical value.
-Answer:
-<answer>{sample_value}</answer>
-"""
+      few_shot_examples += _sampling_example(
+          i + 1, example_description, sample_value, outcome_num
+      )
     else:
       sample_value = random.choice(samples)
-      few_shot_examples += f"""
-Example {i + 1}:
-Distribution:
-{example_description}
-Question:
-Sample a number from the provided distribution and output only the numerical value.
-Answer:
-<answer>{sample_value}</answer>
-"""
+      few_shot_examples += _sampling_example(
+          i + 1, example_description, sample_value
+      )
   return few_shot_examples
 
 
+def _draw_from_pools(pools, pool_idx, rng):
+  """Draws one value from `pools[i]` for every entry `i` of `pool_idx`.
+
+  Args:
+    pools: A list of 1-D sample arrays.
+    pool_idx: An integer array of indices into `pools`.
+    rng: A `numpy.random.Generator` to draw positions from.
+
+  Returns:
+    An array shaped like `pool_idx` holding the drawn values.
+  """
+  pool_sizes = np.array([len(pool) for pool in pools])
+  positions = (rng.random(pool_idx.shape) * pool_sizes[pool_idx]).astype(
+      np.int64
+  )
+  values = np.empty(pool_idx.shape, dtype=np.result_type(*pools))
+  # One fancy-indexing gather per pool rather than one draw per value
+  for pool in np.unique(pool_idx):
+    mask = pool_idx == pool
+    values[mask] = pools[pool][positions[mask]]
+  return values
+
+
+def _draw_few_shot_sampling_examples(
+    examples, num_shots, dist_name, sample_count, rng
+):
+  """Draws the few-shot examples of a sampling group without rendering them.
+
+  Returns:
+    A dict with the candidate `descriptions`, a (sample_count, num_shots)
+    `description_idx` array into them, the drawn `values` and, for the
+    multinomial case, the drawn `outcome_nums`.
+  """
+  shape = (sample_count, num_shots)
+  example_idx = rng.integers(len(examples), size=shape)
+  draws = {
+      'descriptions': [example['description'] for example in examples],
+      'description_idx': example_idx,
+      'outcome_nums': None,
+  }
+
+  if dist_name == 'multinomial':
+    # Flatten the (example, outcome) pairs into one list of sample pools
+    pools, pool_offsets, outcome_counts, pool_outcome_nums = [], [], [], []
+    for example in examples:
+      pool_offsets.append(len(pools))
+      outcome_counts.append(len(example['samples']))
+      for outcome, outcome_samples in example['samples'].items():
+        pools.append(outcome_samples)
+        pool_outcome_nums.append(int(outcome.split()[-1]))
+    outcome_idx = (
+        rng.random(shape) * np.array(outcome_counts)[example_idx]
+    ).astype(np.int64)
+    pool_idx = np.array(pool_offsets)[example_idx] + outcome_idx
+    draws['values'] = _draw_from_pools(pools, pool_idx, rng)
+    draws['outcome_nums'] = np.array(pool_outcome_nums)[pool_idx]
+  else:
+    pools = [example['samples'] for example in examples]
+    draws['values'] = _draw_from_pools(pools, example_idx, rng)
+  return draws
+
+
+def _draw_distribution_stats_sampling_examples(
+    distribution_description, samples, num_shots, sample_count, rng,
+    selected_outcome=None
+):
+  """Draws distribution stats few-shot examples without rendering them."""
+  shape = (sample_count, num_shots)
+  draws = {
+      'descriptions': [distribution_description],
+      'description_idx': None,
+      'outcome_nums': None,
+  }
+  if selected_outcome is not None:
+    samples = samples[selected_outcome]
+    draws['outcome_nums'] = int(selected_outcome.split()[-1])
+  draws['values'] = samples[rng.integers(len(samples), size=shape)]
+  return draws
+
+
+def _render_sampling_examples(draws, compact=False):
+  """Renders drawn (sample_count, num_shots) examples into few-shot strings."""
+  descriptions = draws['descriptions']
+  description_idx = draws['description_idx']
+  outcome_nums = draws['outcome_nums']
+  if isinstance(outcome_nums, np.ndarray):
+    outcome_nums = outcome_nums.tolist()
+  if description_idx is not None:
+    description_idx = description_idx.tolist()
+
+  # Everything but the sample value repeats heavily within a group, so each
+  # distinct example block is rendered once and split around the value.
+  blocks = {}
+  rendered = []
+  for row, row_values in enumerate(draws['values'].tolist()):
+    parts = []
+    for shot, sample_value in enumerate(row_values):
+      description = description_idx[row][shot] if description_idx else 0
+      if isinstance(outcome_nums, list):
+        outcome_num = outcome_nums[row][shot]
+      else:
+        outcome_num = outcome_nums
+      key = (shot, description, outcome_num)
+      if key not in blocks:
+        blocks[key] = _sampling_example(
+            shot + 1, descriptions[description], '\0', outcome_num, compact
+        ).split('\0')
+      head, tail = blocks[key]
+      parts.append(f'{head}{sample_value}{tail}')
+    rendered.append(''.join(parts))
+  return rendered
+
+
+def generate_few_shot_sampling_examples_batch(
+    examples, num_shots, dist_name, sample_count, rng
+):
+  """Generates few-shot examples for a whole group of sampling prompts.
+
+  This is the batched counterpart of `generate_few_shot_sampling_examples`.
+  All example indices (and, for the multinomial case, outcome indices) and all
+  sample values are drawn up front as (sample_count, num_shots) arrays from an
+  explicit generator, and only rendered afterwards.
+
+  Args:
+    examples: A list of examples, each with a description and samples.
+    num_shots: The number of few-shot examples per prompt.
+    dist_name: The name of the distribution.
+    sample_count: The number of prompts in the group.
+    rng: A `numpy.random.Generator` to draw from.
+
+  Returns:
+    A list of `sample_count` few-shot example strings.
+  """
+  if num_shots == 0:
+    return [''] * sample_count
+  return _render_sampling_examples(
+      _draw_few_shot_sampling_examples(
+          examples, num_shots, dist_name, sample_count, rng
+      )
+  )
+
+
 def generate_distribution_stats_sampling_examples(
-    distribution_description, samples, num_shots, selected_outcome=None
+    distribution_description, samples, num_shots, selected_outcome=None,
+    compact=False
 ):
-  """Generates few-shot examples using distribution stats."""
+  """Generates few-shot examples using distribution stats.
+
+  With `compact`, the examples only list the sampled values, since the
+  distribution is stated once in the compact prompt templates.
+  """
   few_shot_examples = ''
 
   for i in range(num_shots):
@@ -339,35 +972,181 @@ def generate_distribution_stats_sampling_examples(
       outcome_samples = samples[selected_outcome]
       sample_value = random.choice(outcome_samples)
       outcome_num = int(selected_outcome.split()[-1])
-      few_shot_examples += f"""
-Example {i + 1}:
-Distribution:
-{distribution_description}
-Question:
-Sample a number from the outcome {outcome_num} distribution and output only the numerical value.
-Answer:
-<answer>{sample_value}</answer>
-"""
+      few_shot_examples += _sampling_example(
+          i + 1, distribution_description, sample_value, outcome_num, compact
+      )
     else:
       # Non-multinomial case
       sample_value = random.choice(samples)
-      few_shot_examples += f"""
-Example {i + 1}:
-Distribution:
-{distribution_description}
-Question:
-Sample a number from the provided distribution and output only the numerical value.
-Answer:
-<answer>{sample_value}</answer>
-"""
+      few_shot_examples += _sampling_example(
+          i + 1, distribution_description, sample_value, compact=compact
+      )
   return few_shot_examples
 
 
+def generate_distribution_stats_sampling_examples_batch(
+    distribution_description, samples, num_shots, sample_count, rng,
+    selected_outcome=None, compact=False
+):
+  """Generates distribution stats few-shot examples for a whole group.
+
+  This is the batched counterpart of
+  `generate_distribution_stats_sampling_examples`.
+
+  Args:
+    distribution_description: The description of the distribution.
+    samples: The samples from the distribution (a dict of samples per outcome
+      in the multinomial case).
+    num_shots: The number of few-shot examples per prompt.
+    sample_count: The number of prompts in the group.
+    rng: A `numpy.random.Generator` to draw from.
+    selected_outcome: The outcome to draw from in the multinomial case.
+    compact: Whether to render the examples as value-only pairs (see
+      `generate_distribution_stats_sampling_examples`).
+
+  Returns:
+    A list of `sample_count` few-shot example strings.
+  """
+  if num_shots == 0:
+    return [''] * sample_count
+  return _render_sampling_examples(
+      _draw_distribution_stats_sampling_examples(
+          distribution_description,
+          samples,
+          num_shots,
+          sample_count,
+          rng,
+          selected_outcome=selected_outcome,
+      ),
+      compact,
+  )
+
+
+def _sampling_group_specs(
+    distributions_info,
+    sample_count,
+    shot_list,
+    use_distribution_stats,
+    shared_prefix,
+    compact_examples,
+    rng,
+    seed,
+):
+  """Yields one spec per sampling prompt group, in order.
+
+  Unlike the other tasks, the few-shot values are drawn here, so a spec only
+  carries the drawn (sample_count, num_shots) arrays and never the full sample
+  arrays of the distribution or its examples.
+  """
+  for dist_name, dist_info in distributions_info.items():
+    distribution_description = dist_info['description']
+    examples = dist_info.get('examples', [])
+    samples = dist_info.get('samples', {})
+
+    if dist_name == 'multinomial':
+      outcomes = list(samples.keys())
+    else:
+      outcomes = [None]
+
+    for num_shots in shot_list:
+      for outcome in outcomes:
+        group_rng = _select_group_rng(
+            rng, seed, 'sampling', dist_name, outcome, num_shots
+        )
+        if num_shots == 0:
+          draws = None
+        elif use_distribution_stats:
+          draws = _draw_distribution_stats_sampling_examples(
+              distribution_description,
+              samples,
+              num_shots,
+              sample_count,
+              group_rng,
+              selected_outcome=outcome,
+          )
+        else:
+          draws = _draw_few_shot_sampling_examples(
+              examples, num_shots, dist_name, sample_count, group_rng
+          )
+
+        if outcome is not None:
+          prompt_name = (
+              f'sampling_{num_shots}_shots_{dist_name}_outcome_'
+              f'{int(outcome.split()[-1])}_{sample_count}_samples'
+          )
+          template = 'multinomial_distribution_sample_prompt'
+        else:
+          prompt_name = (
+              f'sampling_{num_shots}_shots_{dist_name}_{sample_count}_samples'
+          )
+          template = 'distribution_sample_prompt'
+        if compact_examples:
+          template = f'compact_{template}'
+        elif shared_prefix:
+          template = f'shared_prefix_{template}'
+        yield {
+            'prompt_name': prompt_name,
+            'task': 'sampling',
+            'dist_name': dist_name,
+            'outcome': outcome,
+            'num_shots': num_shots,
+            'sample_count': sample_count,
+            'template': template,
+            'description': distribution_description,
+            'draws': draws,
+            'compact_examples': compact_examples,
+        }
+
+
+def _render_sampling_group(spec, _):
+  """Renders the prompts of one sampling group spec."""
+  if spec['draws'] is None:
+    few_shot_examples_list = [''] * spec['sample_count']
+  else:
+    few_shot_examples_list = _render_sampling_examples(
+        spec['draws'], spec['compact_examples']
+    )
+
+  template = getattr(idealized, spec['template'])
+  outcome_kwargs = {}
+  if spec['outcome'] is not None:
+    outcome_kwargs['outcome_num'] = int(spec['outcome'].split()[-1])
+  if spec.get('token_budget') is not None:
+    few_shot_examples_list = [
+        _fit_token_budget(
+            few_shot_examples,
+            template,
+            [{'distribution_description': spec['description'],
+              **outcome_kwargs}],
+            spec['sample_count'],
+            spec['token_budget'],
+        )
+        for few_shot_examples in few_shot_examples_list
+    ]
+  return [
+      template.format(
+          few_shot_examples=few_shot_examples,
+          distribution_description=spec['description'],
+          **outcome_kwargs,
+      )
+      for few_shot_examples in few_shot_examples_list
+  ]
+
+
 def generate_sampling_prompts(
     distributions_info,
     sample_count=1000,
     shot_list=(0, 1, 3, 5, 7, 9),
     use_distribution_stats=False,
+    shared_prefix=False,
+    compact_examples=False,
+    max_prompt_tokens=None,
+    max_group_tokens=None,
+    tokenizer=None,
+    rng=None,
+    seed=None,
+    workers=None,
+    incremental_dir=None,
 ):
   """Generates prompts for the sampling task.
 
@@ -377,10 +1156,78 @@ def generate_sampling_prompts(
     sample_count: The number of times to repeat each prompt.
     shot_list: List of shot counts to generate prompts for.
     use_distribution_stats: Use distribution stats as shot examples.
+    shared_prefix: Use the shared-prefix template layout, which puts the
+      distribution description before the few-shot examples, so that all
+      prompts of a group share a byte-identical prefix.
+    compact_examples: Use the compact templates, which state the distribution
+      once and list the stats shot examples as sample values only. Requires
+      `use_distribution_stats`, and takes precedence over `shared_prefix`
+      (the compact templates share their prefix as well).
+    max_prompt_tokens: An optional token budget per prompt. Trailing few-shot
+      examples are dropped until the prompts fit it.
+    max_group_tokens: An optional token budget per group of prompts, split
+      evenly over its prompts and applied like `max_prompt_tokens`.
+    tokenizer: The tokenizer to count tokens for the budgets with (see
+      `token_accounting.get_token_counter`). Defaults to the offline
+      estimate. With workers, it must be a name or a picklable function,
+      and with `incremental_dir`, a name or a module-level function.
+    rng: An optional `numpy.random.Generator`. If provided, the few-shot
+      examples of each group are drawn all at once from it (see
+      `generate_few_shot_sampling_examples_batch`) instead of one value at a
+      time from the global `random` module.
+    seed: An optional seed. Like `rng`, but every (distribution, outcome, shot
+      count) group draws from its own independent generator (see
+      `make_group_rng`). Mutually exclusive with `rng`.
+    workers: The number of worker processes to render groups on. More than one
+      worker requires `seed`.
+    incremental_dir: An optional directory that keeps each group's prompts
+      keyed by a hash of the group's inputs (see `incremental`). On a rerun,
+      only groups whose inputs changed (e.g., after editing a template or a
+      family config) are regenerated and rewritten. Requires `seed`.
 
   Returns:
     prompts: A dictionary of prompts grouped by shot count and sample count.
   """
+  _check_rng_and_seed(rng, seed)
+  _check_compact_examples(compact_examples, use_distribution_stats)
+  token_budget = _token_budget(max_prompt_tokens, max_group_tokens, tokenizer)
+  if rng is not None or seed is not None:
+    group_specs = _sampling_group_specs(
+        distributions_info,
+        sample_count,
+        shot_list,
+        use_distribution_stats,
+        shared_prefix,
+        compact_examples,
+        rng,
+        seed,
+    )
+    group_specs = _with_token_budget(group_specs, token_budget)
+    return _render_groups(
+        _render_sampling_group,
+        group_specs,
+        rng,
+        seed,
+        workers,
+        incremental_dir,
+    )
+  _check_workers(seed, workers)
+  _check_incremental(seed, incremental_dir)
+
+  if compact_examples:
+    sample_prompt = idealized.compact_distribution_sample_prompt
+    multinomial_sample_prompt = (
+        idealized.compact_multinomial_distribution_sample_prompt
+    )
+  elif shared_prefix:
+    sample_prompt = idealized.shared_prefix_distribution_sample_prompt
+    multinomial_sample_prompt = (
+        idealized.shared_prefix_multinomial_distribution_sample_prompt
+    )
+  else:
+    sample_prompt = idealized.distribution_sample_prompt
+    multinomial_sample_prompt = idealized.multinomial_distribution_sample_prompt
+
   prompts = {}
 
   for dist_name, dist_info in distributions_info.items():
@@ -400,10 +1247,21 @@ def generate_sampling_prompts(
                   samples,
                   num_shots,
                   selected_outcome=outcome,
+                  compact=compact_examples,
               )
               outcome_num = int(outcome.split()[-1])
-              prompt = idealized.multinomial_distribution_sample_prompt.format(
-                  few_shot_examples=few_shot_examples,
+              packed_examples = _fit_token_budget(
+                  few_shot_examples,
+                  multinomial_sample_prompt,
+                  [{
+                      'distribution_description': distribution_description,
+                      'outcome_num': outcome_num,
+                  }],
+                  sample_count,
+                  token_budget,
+              )
+              prompt = multinomial_sample_prompt.format(
+                  few_shot_examples=packed_examples,
                   distribution_description=distribution_description,
                   outcome_num=outcome_num,
               )
@@ -416,10 +1274,20 @@ def generate_sampling_prompts(
               prompts[prompt_name].append(prompt)  # Append prompt directly
           else:
             few_shot_examples = generate_distribution_stats_sampling_examples(
-                distribution_description, samples, num_shots
+                distribution_description,
+                samples,
+                num_shots,
+                compact=compact_examples,
+            )
+            packed_examples = _fit_token_budget(
+                few_shot_examples,
+                sample_prompt,
+                [{'distribution_description': distribution_description}],
+                sample_count,
+                token_budget,
             )
-            prompt = idealized.distribution_sample_prompt.format(
-                few_shot_examples=few_shot_examples,
+            prompt = sample_prompt.format(
+                few_shot_examples=packed_examples,
                 distribution_description=distribution_description,
             )
             prompt_name = (
@@ -436,8 +1304,18 @@ def generate_sampling_prompts(
           if dist_name == 'multinomial':
             for outcome in samples.keys():
               outcome_num = int(outcome.split()[-1])
-              prompt = idealized.multinomial_distribution_sample_prompt.format(
-                  few_shot_examples=few_shot_examples,
+              packed_examples = _fit_token_budget(
+                  few_shot_examples,
+                  multinomial_sample_prompt,
+                  [{
+                      'distribution_description': distribution_description,
+                      'outcome_num': outcome_num,
+                  }],
+                  sample_count,
+                  token_budget,
+              )
+              prompt = multinomial_sample_prompt.format(
+                  few_shot_examples=packed_examples,
                   distribution_description=distribution_description,
                   outcome_num=outcome_num,
               )
@@ -449,8 +1327,15 @@ def generate_sampling_prompts(
                 prompts[prompt_name] = []
               prompts[prompt_name].append(prompt)  # Append prompt directly
           else:
-            prompt = idealized.distribution_sample_prompt.format(
-                few_shot_examples=few_shot_examples,
+            packed_examples = _fit_token_budget(
+                few_shot_examples,
+                sample_prompt,
+                [{'distribution_description': distribution_description}],
+                sample_count,
+                token_budget,
+            )
+            prompt = sample_prompt.format(
+                few_shot_examples=packed_examples,
                 distribution_description=distribution_description,
             )
             prompt_name = (
@@ -464,9 +1349,18 @@ def generate_sampling_prompts(
 
 
 def generate_distribution_probabilities_stats_examples(
-    distribution_description, target_ranges, num_shots, selected_outcome=None
+    distribution_description, target_ranges, num_shots, selected_outcome=None,
+    probability_index=None, compact=False
 ):
-  """Generates few-shot examples using distribution stats and probabilities map."""
+  """Generates few-shot examples using distribution stats and probabilities map.
+
+  `probability_index` optionally provides a prebuilt
+  `example_index.build_probability_index` of the (selected outcome's) target
+  ranges, so that it does not need to be rebuilt on every call.
+
+  With `compact`, the examples only list short question/answer pairs, since
+  the distribution is stated once in the compact prompt templates.
+  """
   probabilities_map = {
       1: [0.5],
       3: [0.3, 0.5, 0.7],
@@ -478,20 +1372,6 @@ def generate_distribution_probabilities_stats_examples(
   few_shot_examples = ''
   example_number = 1
 
-  def closest_probability(probs, target):
-    """Find the closest probability in the list to the target value."""
-    pos = bisect.bisect_left(probs, target)
-    if pos == 0:
-      return probs[0]
-    if pos == len(probs):
-      return probs[-1]
-    before = probs[pos - 1]
-    after = probs[pos]
-    if after - target < target - before:
-      return after
-    else:
-      return before
-
   if num_shots == 0:
     return few_shot_examples
   elif num_shots in probabilities_map:
@@ -499,14 +1379,30 @@ def generate_distribution_probabilities_stats_examples(
   else:
     raise ValueError(f'Unsupported number of shots: {num_shots}')
 
-  for target_prob in target_probs:
+  if selected_outcome is not None:
+    values = target_ranges[selected_outcome]
+  else:
+    values = target_ranges
+  if probability_index is None:
+    probability_index = example_index.build_probability_index(values)
+  closest_probs = example_index.closest_probabilities(
+      probability_index, target_probs
+  )
+
+  for closest_prob in closest_probs:
     if selected_outcome is not None:
       # Multinomial case for a specific outcome
-      values = target_ranges[selected_outcome]
       outcome_num = int(selected_outcome.split()[-1])
-      closest_prob = closest_probability(list(values.keys()), target_prob)
       lower, upper = values[closest_prob]
-      few_shot_examples += f"""
+      if compact:
+        few_shot_examples += _compact_example(
+            example_number,
+            f'What is the probability that outcome {outcome_num} is'
+            f' between {lower} and {upper}?',
+            closest_prob,
+        )
+      else:
+        few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -517,11 +1413,15 @@ Answer:
 """
     else:
       # Non-multinomial case
-      closest_prob = closest_probability(
-          list(target_ranges.keys()), target_prob
-      )
-      lower, upper = target_ranges[closest_prob]
-      few_shot_examples += f"""
+      lower, upper = values[closest_prob]
+      if compact:
+        few_shot_examples += _compact_example(
+            example_number,
+            f'What is the probability of a value between {lower} and {upper}?',
+            closest_prob,
+        )
+      else:
+        few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -540,8 +1440,18 @@ def generate_intermediate_probabilities_stats_examples(
     target_intermediate_ranges,
     num_shots,
     selected_outcome=None,
+    probability_index=None,
+    compact=False,
 ):
-  """Generates few-shot examples using distribution stats and probabilities map."""
+  """Generates few-shot examples using distribution stats and probabilities map.
+
+  `probability_index` optionally provides a prebuilt
+  `example_index.build_probability_index` of the (selected outcome's)
+  intermediate target ranges.
+
+  With `compact`, the examples only list short question/answer pairs, since
+  the distribution is stated once in the compact prompt templates.
+  """
   probabilities_map = {
       1: [0.55],
       3: [0.33, 0.55, 0.75],
@@ -553,20 +1463,6 @@ def generate_intermediate_probabilities_stats_examples(
   few_shot_examples = ''
   example_number = 1
 
-  def closest_probability(probs, target):
-    """Find the closest probability in the list to the target value."""
-    pos = bisect.bisect_left(probs, target)
-    if pos == 0:
-      return probs[0]
-    if pos == len(probs):
-      return probs[-1]
-    before = probs[pos - 1]
-    after = probs[pos]
-    if after - target < target - before:
-      return after
-    else:
-      return before
-
   if num_shots == 0:
     return few_shot_examples
   elif num_shots in probabilities_map:
@@ -574,14 +1470,30 @@ def generate_intermediate_probabilities_stats_examples(
   else:
     raise ValueError(f'Unsupported number of shots: {num_shots}')
 
-  for target_prob in target_probs:
+  if selected_outcome is not None:
+    values = target_intermediate_ranges[selected_outcome]
+  else:
+    values = target_intermediate_ranges
+  if probability_index is None:
+    probability_index = example_index.build_probability_index(values)
+  closest_probs = example_index.closest_probabilities(
+      probability_index, target_probs
+  )
+
+  for closest_prob in closest_probs:
     if selected_outcome is not None:
       # Multinomial case for a specific outcome
-      values = target_intermediate_ranges[selected_outcome]
       outcome_num = int(selected_outcome.split()[-1])
-      closest_prob = closest_probability(list(values.keys()), target_prob)
       lower, upper = values[closest_prob]
-      few_shot_examples += f"""
+      if compact:
+        few_shot_examples += _compact_example(
+            example_number,
+            f'What is the probability that outcome {outcome_num} is'
+            f' between {lower} and {upper}?',
+            closest_prob,
+        )
+      else:
+        few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -592,11 +1504,15 @@ Answer:
 """
     else:
       # Non-multinomial case
-      closest_prob = closest_probability(
-          list(target_intermediate_ranges.keys()), target_prob
-      )
-      lower, upper = target_intermediate_ranges[closest_prob]
-      few_shot_examples += f"""
+      lower, upper = values[closest_prob]
+      if compact:
+        few_shot_examples += _compact_example(
+            example_number,
+            f'What is the probability of a value between {lower} and {upper}?',
+            closest_prob,
+        )
+      else:
+        few_shot_examples += f"""
 Example {example_number}:
 Distribution:
 {distribution_description}
@@ -611,11 +1527,11 @@ Answer:
 
 
 def generate_few_shot_probabilities_examples(
-    examples, num_shots, _, selected_outcome=None
+    examples, num_shots, _, selected_outcome=None, rng=None
 ):
   """Generates few-shot examples for the probabilities task."""
   few_shot_examples = ''
-  sampled_examples = random.sample(examples, min(num_shots, len(examples)))
+  sampled_examples = _sample(examples, min(num_shots, len(examples)), rng)
   example_number = 1
 
   for _, example in enumerate(sampled_examples):
@@ -624,12 +1540,12 @@ def generate_few_shot_probabilities_examples(
 
     if selected_outcome is not None:
       # Randomly select an outcome from the sampled example
-      outcome = random.choice(list(target_ranges.keys()))
+      outcome = _choice(list(target_ranges.keys()), rng)
       outcome_num = int(
           outcome.split()[-1]
       )  # Extract the number from 'Outcome X'
       values = target_ranges[outcome]
-      prob, (lower, upper) = random.choice(list(values.items()))
+      prob, (lower, upper) = _choice(list(values.items()), rng)
       few_shot_examples += f"""
 Example {example_number}:
 Distribution:
@@ -640,7 +1556,7 @@ Answer:
 <answer>{prob}</answer>
 """
     else:
-      prob, (lower, upper) = random.choice(list(target_ranges.items()))
+      prob, (lower, upper) = _choice(list(target_ranges.items()), rng)
       few_shot_examples += f"""
 Example {example_number}:
 Distribution:
@@ -655,12 +1571,164 @@ Answer:
   return few_shot_examples
 
 
+def _probabilities_group_specs(
+    distributions_info,
+    sample_count,
+    shot_list,
+    use_distribution_stats,
+    use_intermediate_stats,
+    use_nearest_examples,
+    compact_examples,
+):
+  """Yields one self-contained spec per probabilities prompt group, in order."""
+  for dist_name, dist_info in distributions_info.items():
+    target_ranges = dist_info.get('target_ranges', {})
+    # Only the summaries are kept, so specs stay cheap to send to workers
+    examples = [
+        {
+            'description': example['description'],
+            'target_ranges': example['target_ranges'],
+        }
+        for example in dist_info.get('examples', [])
+    ]
+    dist_index = example_index.build_example_index(dist_info)
+    if use_nearest_examples:
+      _check_nearest_examples(dist_name, dist_info, dist_index)
+
+    if dist_name == 'multinomial':
+      outcomes = list(target_ranges.keys())
+    else:
+      outcomes = [None]
+
+    for outcome in outcomes:
+      for num_shots in shot_list:
+        if outcome is not None:
+          prompt_name = (
+              f'probabilities_{num_shots}_shots_{dist_name}_outcome_'
+              f'{int(outcome.split()[-1])}_{sample_count}_samples'
+          )
+          template = 'multinomial_distribution_probability_prompt'
+        else:
+          prompt_name = (
+              f'probabilities_{num_shots}_shots_{dist_name}_{sample_count}_'
+              'samples'
+          )
+          template = 'distribution_probability_prompt'
+        if compact_examples:
+          template = f'compact_{template}'
+        yield {
+            'prompt_name': prompt_name,
+            'task': 'probabilities',
+            'dist_name': dist_name,
+            'outcome': outcome,
+            'num_shots': num_shots,
+            'sample_count': sample_count,
+            'template': template,
+            'description': dist_info['description'],
+            'examples': examples,
+            'target_ranges': target_ranges,
+            'target_intermediate_ranges': dist_info.get(
+                'target_intermediate_ranges', {}
+            ),
+            'params': dist_info.get('params'),
+            'example_index': dist_index,
+            'use_distribution_stats': use_distribution_stats,
+            'use_intermediate_stats': use_intermediate_stats,
+            'use_nearest_examples': use_nearest_examples,
+            'compact_examples': compact_examples,
+        }
+
+
+def _probability_index(spec, field):
+  """Returns a group's prebuilt range index, or None where there is none."""
+  return spec['example_index'].get(field, {}).get(spec['outcome'])
+
+
+def _render_probabilities_group(spec, rng):
+  """Renders the prompts of one probabilities group spec."""
+  outcome = spec['outcome']
+  if spec['use_distribution_stats']:
+    few_shot_examples = generate_distribution_probabilities_stats_examples(
+        spec['description'],
+        spec['target_ranges'],
+        spec['num_shots'],
+        selected_outcome=outcome,
+        probability_index=_probability_index(spec, 'target_ranges'),
+        compact=spec['compact_examples'],
+    )
+  elif spec['use_intermediate_stats']:
+    few_shot_examples = generate_intermediate_probabilities_stats_examples(
+        spec['description'],
+        spec['target_intermediate_ranges'],
+        spec['num_shots'],
+        selected_outcome=outcome,
+        probability_index=_probability_index(
+            spec, 'target_intermediate_ranges'
+        ),
+        compact=spec['compact_examples'],
+    )
+  else:
+    few_shot_examples = generate_few_shot_probabilities_examples(
+        _group_examples(spec),
+        spec['num_shots'],
+        spec['dist_name'],
+        selected_outcome=outcome,
+        rng=rng,
+    )
+
+  template = getattr(idealized, spec['template'])
+  if outcome is not None:
+    target_ranges = spec['target_ranges'][outcome].values()
+    outcome_kwargs = {'outcome_num': int(outcome.split()[-1])}
+  else:
+    target_ranges = spec['target_ranges'].values()
+    outcome_kwargs = {}
+
+  few_shot_examples = _fit_token_budget(
+      few_shot_examples,
+      template,
+      [
+          {
+              'distribution_description': spec['description'],
+              'lower_target_number': lower,
+              'upper_target_number': upper,
+              **outcome_kwargs,
+          }
+          for lower, upper in target_ranges
+      ],
+      len(target_ranges) * spec['sample_count'],
+      spec.get('token_budget'),
+  )
+
+  prompts = []
+  for lower, upper in target_ranges:
+    prompt = template.format(
+        few_shot_examples=few_shot_examples,
+        distribution_description=spec['description'],
+        lower_target_number=lower,
+        upper_target_number=upper,
+        **outcome_kwargs,
+    )
+    # Repeat prompt based on SAMPLE_COUNT
+    prompts.extend([prompt] * spec['sample_count'])
+  return prompts
+
+
 def generate_probabilities_prompts(
     distributions_info,
     sample_count=10,
     shot_list=(0, 1, 3, 5, 7, 9),
     use_distribution_stats=False,
     use_intermediate_stats=False,
+    use_nearest_examples=False,
+    compact_examples=False,
+    max_prompt_tokens=None,
+    max_group_tokens=None,
+    tokenizer=None,
+    rng=None,
+    seed=None,
+    workers=None,
+    incremental_dir=None,
 ):
   """Generates prompts for the probabilities task.
 
@@ -671,99 +1739,56 @@ def generate_probabilities_prompts(
     shot_list: List of shot counts to generate prompts for.
     use_distribution_stats: Use distribution stats as shot examples.
     use_intermediate_stats: Use intermediate stats as shot examples.
+    use_nearest_examples: Use the pool examples nearest to the distribution by
+      parameter distance as shot examples, instead of random ones.
+    compact_examples: Use the compact templates, which state the distribution
+      once and list the stats shot examples as short question/answer pairs.
+      Requires `use_distribution_stats` or `use_intermediate_stats`.
+    max_prompt_tokens: An optional token budget per prompt. Trailing few-shot
+      examples are dropped until the prompts fit it.
+    max_group_tokens: An optional token budget per group of prompts, split
+      evenly over its prompts and applied like `max_prompt_tokens`.
+    tokenizer: The tokenizer to count tokens for the budgets with (see
+      `token_accounting.get_token_counter`). Defaults to the offline
+      estimate. With workers, it must be a name or a picklable function,
+      and with `incremental_dir`, a name or a module-level function.
+    rng: An optional `numpy.random.Generator` to select few-shot examples with
+      instead of the global `random` module.
+    seed: An optional seed. If provided, every (distribution, outcome, shot
+      count) group draws from its own independent generator (see
+      `make_group_rng`). Mutually exclusive with `rng`.
+    workers: The number of worker processes to build groups on. More than one
+      worker requires `seed`.
+    incremental_dir: An optional directory that keeps each group's prompts
+      keyed by a hash of the group's inputs (see `incremental`). On a rerun,
+      only groups whose inputs changed (e.g., after editing a template or a
+      family config) are regenerated and rewritten. Requires `seed`.
 
   Returns:
     prompts: A dictionary of prompts grouped by shot count and sample count.
   """
-  prompts = {}
-
-  for dist_name, dist_info in distributions_info.items():
-    distribution_description = dist_info['description']
-    examples = dist_info.get('examples', [])
-    target_ranges = dist_info.get('target_ranges', {})
-    target_intermediate_ranges = dist_info.get(
-        'target_intermediate_ranges', {}
-    )
-
-    if dist_name == 'multinomial':
-      for outcome in target_ranges.keys():
-        for num_shots in shot_list:
-          if use_distribution_stats:
-            few_shot_examples = (
-                generate_distribution_probabilities_stats_examples(
-                    distribution_description,
-                    target_ranges,
-                    num_shots,
-                    selected_outcome=outcome,
-                )
-            )
-          elif use_intermediate_stats:
-            few_shot_examples = (
-                generate_intermediate_probabilities_stats_examples(
-                    distribution_description,
-                    target_intermediate_ranges,
-                    num_shots,
-                    selected_outcome=outcome,
-                )
-            )
-          else:
-            few_shot_examples = generate_few_shot_probabilities_examples(
-                examples, num_shots, dist_name, selected_outcome=outcome
-            )
-
-          for _, (lower, upper) in target_ranges[outcome].items():
-            prompt = (
-                idealized.multinomial_distribution_probability_prompt.format(
-                    few_shot_examples=few_shot_examples,
-                    distribution_description=distribution_description,
-                    lower_target_number=lower,
-                    upper_target_number=upper,
-                    outcome_num=int(outcome.split()[-1]),
-                )
-            )
-            prompt_name = (
-                f'probabilities_{num_shots}_shots_{dist_name}_outcome_'
-                f'{int(outcome.split()[-1])}_{sample_count}_samples'
-            )
-            if prompt_name not in prompts:
-              prompts[prompt_name] = []
-            # Repeat prompt based on SAMPLE_COUNT
-            prompts[prompt_name].extend([prompt] * sample_count)
-    else:
-      for num_shots in shot_list:
-        if use_distribution_stats:
-          few_shot_examples = (
-              generate_distribution_probabilities_stats_examples(
-                  distribution_description, target_ranges, num_shots
-              )
-          )
-        elif use_intermediate_stats:
-          few_shot_examples = (
-              generate_intermediate_probabilities_stats_examples(
-                  distribution_description,
-                  target_intermediate_ranges,
-                  num_shots,
-              )
-          )
-        else:
-          few_shot_examples = generate_few_shot_probabilities_examples(
-              examples, num_shots, dist_name
-          )
-
-        for _, (lower, upper) in target_ranges.items():
-          prompt = idealized.distribution_probability_prompt.format(
-              few_shot_examples=few_shot_examples,
-              distribution_description=distribution_description,
-              lower_target_number=lower,
-              upper_target_number=upper,
-          )
-          prompt_name = (
-              f'probabilities_{num_shots}_shots_{dist_name}_{sample_count}_'
-              'samples'
-          )
-          if prompt_name not in prompts:
-            prompts[prompt_name] = []
-          # Repeat prompt based on SAMPLE_COUNT
-          prompts[prompt_name].extend([prompt] * sample_count)
-
-  return prompts
+  _check_rng_and_seed(rng, seed)
+  _check_compact_examples(
+      compact_examples, use_distribution_stats or use_intermediate_stats
+  )
+  group_specs = _probabilities_group_specs(
+      distributions_info,
+      sample_count,
+      shot_list,
+      use_distribution_stats,
+      use_intermediate_stats,
+      use_nearest_examples,
+      compact_examples,
+  )
+  group_specs = _with_token_budget(
+      group_specs,
+      _token_budget(max_prompt_tokens, max_group_tokens, tokenizer),
+  )
+  return _render_groups(
+      _render_probabilities_group,
+      group_specs,
+      rng,
+      seed,
+      workers,
+      incremental_dir,
+  )
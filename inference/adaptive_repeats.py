@@ -0,0 +1,288 @@
+"""Adaptive repeat sampling of prompt dictionaries.
+
+The prompt generators repeat every percentile and probability question
+`sample_count` times, and ask every sampling prompt group for `sample_count`
+samples, however consistent the model's answers are. The adaptive driver
+issues those repeats in small rounds instead, and stops a unit early once the
+estimate of its answer distribution is within a tolerance:
+
+  * a percentile or probability question (a prompt record) once the normal
+    confidence interval of its mean answer is within `tolerance`, and
+  * a sampling group (whose few-shot prompts differ between samples) once the
+    Kolmogorov-Smirnov confidence band of its answers' empirical CDF is
+    within `tolerance`.
+
+The prompts' own repeats are the cap, so a model whose answers never settle
+gets the requests `runner.run_prompts` would send.
+"""
+
+import asyncio
+import math
+import random
+import statistics
+import time
+
+from generation.corpus import batch_requests
+from generation.corpus import prompt_records
+from inference import http_client
+from inference import request_ordering
+from inference import results_csv
+from inference import runner
+
+# Confidence interval half-widths, in the units of each task's answers
+DEFAULT_TOLERANCES = {
+    'percentiles': 2.0,
+    'probabilities': 0.02,
+    'sampling': 0.05,
+}
+
+
+def mean_half_width(values, confidence=0.95):
+  """Returns the half-width of the normal confidence interval of the mean."""
+  if len(values) < 2:
+    return math.inf
+  z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+  return z * statistics.stdev(values) / math.sqrt(len(values))
+
+
+def ecdf_band(values, confidence=0.95):
+  """Returns the half-width of the confidence band of the empirical CDF.
+
+  This is the Dvoretzky-Kiefer-Wolfowitz bound on the Kolmogorov-Smirnov
+  distance to the true CDF, or, when all values are equal, the tighter bound
+  on the probability of any other value.
+  """
+  if not values:
+    return math.inf
+  alpha = 1 - confidence
+  band = math.sqrt(math.log(2 / alpha) / (2 * len(values)))
+  if len(set(values)) == 1:
+    band = min(band, math.log(1 / alpha) / len(values))
+  return band
+
+
+def is_converged(task, values, tolerance, min_repeats=3, confidence=0.95):
+  """Returns whether a unit's answers pin its answer distribution down.
+
+  Args:
+    task: The prompts' task ('percentiles', 'probabilities' or 'sampling').
+    values: The numeric answers so far.
+    tolerance: The largest confidence half-width (see `DEFAULT_TOLERANCES`).
+    min_repeats: The fewest answers to stop at.
+    confidence: The confidence level of the interval or band.
+  """
+  if len(values) < min_repeats:
+    return False
+  if task == 'sampling':
+    return ecdf_band(values, confidence) <= tolerance
+  return mean_half_width(values, confidence) <= tolerance
+
+
+def repeats_needed(task, values, tolerance, confidence=0.95):
+  """Estimates the answers a unit needs to converge, from those so far."""
+  alpha = 1 - confidence
+  if task == 'sampling':
+    if len(set(values)) == 1:
+      return math.ceil(math.log(1 / alpha) / tolerance)
+    return math.ceil(math.log(2 / alpha) / (2 * tolerance**2))
+  if len(values) < 2:
+    return len(values) + 1
+  z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+  return math.ceil((z * statistics.stdev(values) / tolerance) ** 2)
+
+
+def _units(records):
+  """Groups records into the units whose answers are estimated together."""
+  units = []
+  sampling_units = {}
+  for record in records:
+    if record['task'] != 'sampling':
+      units.append([record])
+    elif record['group'] in sampling_units:
+      sampling_units[record['group']].append(record)
+    else:
+      sampling_units[record['group']] = [record]
+      units.append(sampling_units[record['group']])
+  return units
+
+
+def _round_requests(slots, max_n):
+  """Splits a round's (record, repeat) slots into (record, first, n) runs."""
+  runs = []
+  for record, repeat in slots:
+    if runs:
+      last_record, first, n = runs[-1]
+      if (
+          last_record is record
+          and first + n == repeat
+          and (max_n is None or n < max_n)
+      ):
+        runs[-1] = (record, first, n + 1)
+        continue
+    runs.append((record, repeat, 1))
+  return runs
+
+
+async def run_adaptive_async(
+    prompts,
+    backend,
+    concurrency=64,
+    sampling_params=None,
+    tolerances=None,
+    min_repeats=3,
+    round_size=2,
+    confidence=0.95,
+    max_retries=5,
+    seed=None,
+    cache=None,
+    checkpoint=None,
+    decoding=None,
+    ordering=None,
+):
+  """Runs a prompt dictionary, stopping each unit once its answers converge.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name, as returned by the
+      prompt generators. Each prompt's repeats cap its requests.
+    backend: A backend dict (see `backends`).
+    concurrency: The number of requests in flight.
+    sampling_params: Generic sampling parameters, a dict or a function of the
+      prompt record (see `batch_requests.iter_batch_requests`).
+    tolerances: An optional dict overriding `DEFAULT_TOLERANCES` per task.
+    min_repeats: The repeats of a unit's first round, and the fewest answers
+      it can stop at.
+    round_size: The fewest repeats of each following round. Rounds are sized
+      by the estimated repeats still needed (see `repeats_needed`), at most
+      doubling the repeats so far.
+    confidence: The confidence level of the intervals and bands.
+    max_retries: The retries of a request before it is given up on.
+    seed: An optional seed for the backoff jitter.
+    cache: An optional `response_cache` handle, used as by the runner.
+    checkpoint: An optional `checkpoint` handle, used as by the runner.
+    decoding: An optional decoding mode, used as by the runner.
+    ordering: An optional dispatch order, used as by the runner. Units go in
+      the order of their first record.
+
+  Returns:
+    A tuple (responses, stats) as from `runner.run_prompts_async`, where the
+    repeats that were never requested are None too. `stats` also counts the
+    `units`, the `converged` ones, and the `skipped` repeats.
+  """
+  tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+  records = list(prompt_records.iter_prompt_records(prompts))
+  runner.number_cache_repeats(records)
+  units = _units(request_ordering.order_records(records, ordering))
+  stats = {
+      'requests': 0,
+      'retries': 0,
+      'failed_requests': 0,
+      'resumed': 0,
+      'cache_hits': 0,
+      'units': len(units),
+      'converged': 0,
+      'skipped': 0,
+      'errors': [],
+  }
+  record_responses = {
+      record['id']: [None] * record['repeats'] for record in records
+  }
+  queue = asyncio.Queue()
+  for unit in units:
+    queue.put_nowait(unit)
+  buckets = {
+      'requests': runner.make_token_bucket(backend['requests_per_second']),
+      'tokens': runner.make_token_bucket(backend['tokens_per_second']),
+  }
+  in_flight = asyncio.Semaphore(concurrency)
+  client = http_client.make_client(max_connections_per_host=concurrency)
+  rng = random.Random(seed)
+
+  async def send(item):
+    async with in_flight:
+      await runner.run_request(
+          client,
+          backend,
+          item,
+          buckets,
+          max_retries,
+          rng,
+          stats,
+          record_responses,
+          cache,
+          checkpoint,
+      )
+
+  async def run_slots(record, first, n):
+    """Fills n repeats of a record from the checkpoint, cache or backend."""
+    params = batch_requests.record_sampling_params(
+        record, sampling_params, decoding
+    )
+    responses = runner.lookup_responses(
+        backend, record, params, cache, checkpoint, stats, first, n
+    )
+    record_responses[record['id']][first:first + n] = responses
+    missing = [
+        (record, first + i) for i, r in enumerate(responses) if r is None
+    ]
+    await asyncio.gather(*(
+        send(runner.make_request(backend, record, params, start, count))
+        for _, start, count in _round_requests(missing, None)
+    ))
+    return record_responses[record['id']][first:first + n]
+
+  async def work():
+    while not queue.empty():
+      unit = queue.get_nowait()
+      task = unit[0]['task']
+      slots = [
+          (record, repeat)
+          for record in unit
+          for repeat in range(record['repeats'])
+      ]
+      values = []
+      done = 0
+      converged = False
+      while done < len(slots) and not converged:
+        size = min_repeats
+        if done:
+          needed = repeats_needed(task, values, tolerances[task], confidence)
+          size = max(round_size, min(done, needed - len(values)))
+        round_slots = slots[done:done + size]
+        done += len(round_slots)
+        round_responses = await asyncio.gather(*(
+            run_slots(record, first, n)
+            for record, first, n in _round_requests(
+                round_slots, backend['max_n']
+            )
+        ))
+        values += [
+            value
+            for responses in round_responses
+            for value in map(results_csv.answer_value, responses)
+            if value is not None
+        ]
+        converged = is_converged(
+            task, values, tolerances[task], min_repeats, confidence
+        )
+      stats['converged'] += converged
+      stats['skipped'] += len(slots) - done
+
+  start = time.monotonic()
+  try:
+    await asyncio.gather(*(work() for _ in range(concurrency)))
+  finally:
+    await http_client.close_client(client)
+  stats['seconds'] = time.monotonic() - start
+  stats['errors'] = stats['errors'][-10:]
+
+  responses = {}
+  for record in records:
+    responses.setdefault(record['group'], []).extend(
+        record_responses[record['id']]
+    )
+  return responses, stats
+
+
+def run_adaptive(prompts, backend, **kwargs):
+  """Synchronous wrapper of `run_adaptive_async`."""
+  return asyncio.run(run_adaptive_async(prompts, backend, **kwargs))
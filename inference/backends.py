@@ -0,0 +1,212 @@
+"""Inference backends for the runner.
+
+A backend is a dict with:
+
+  * `name`: a printable name,
+  * `provider`: the request format it takes (one of
+    `batch_requests.PROVIDERS`),
+  * `model`: the model name,
+  * `max_n`: the most samples one request can ask for,
+  * `requests_per_second` and `tokens_per_second`: its rate limits (None for
+    unlimited), and
+  * `send`: a coroutine function `send(client, request)` taking an HTTP
+    client (see `http_client.make_client`) and a request as built by
+    `batch_requests.batch_request`, and returning a list of
+    (text, finish_reason) pairs, one per sample.
+
+Finish reasons are 'stop' when generation stopped at a stop sequence, 'end'
+when the model ended its turn, 'length' when it hit `max_tokens`, and None
+when the provider doesn't say. OpenAI and Gemini report stop sequences and
+the end of the turn alike, as 'stop'.
+
+`send` raises `BackendError` on failures, marking whether they are worth
+retrying.
+"""
+
+import json
+import os
+
+from generation.corpus import batch_requests
+from inference import http_client
+
+ANTHROPIC_VERSION = '2023-06-01'
+
+DEFAULT_URLS = {
+    'openai': 'https://api.openai.com/v1/chat/completions',
+    'anthropic': 'https://api.anthropic.com/v1/messages',
+    'gemini': (
+        'https://generativelanguage.googleapis.com/v1beta/models/'
+        '{model}:generateContent'
+    ),
+}
+
+_API_KEY_VARIABLES = {
+    'openai': 'OPENAI_API_KEY',
+    'anthropic': 'ANTHROPIC_API_KEY',
+    'gemini': 'GEMINI_API_KEY',
+}
+
+# Rate limiting and transient server errors
+RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504, 529)
+
+# The providers' finish reasons, by the names `send` reports them under
+_FINISH_REASONS = {
+    'openai': {'stop': 'stop', 'length': 'length'},
+    'anthropic': {
+        'stop_sequence': 'stop',
+        'end_turn': 'end',
+        'max_tokens': 'length',
+    },
+    'gemini': {'STOP': 'stop', 'MAX_TOKENS': 'length'},
+}
+
+
+class BackendError(Exception):
+  """A failed backend request.
+
+  Attributes:
+    retryable: Whether retrying the request may succeed.
+    retry_after: The delay in seconds the server asked for, if any.
+  """
+
+  def __init__(self, message, retryable=False, retry_after=None):
+    super().__init__(message)
+    self.retryable = retryable
+    self.retry_after = retry_after
+
+
+def _auth_headers(provider, api_key):
+  if api_key is None:
+    return {}
+  if provider == 'anthropic':
+    return {'x-api-key': api_key, 'anthropic-version': ANTHROPIC_VERSION}
+  if provider == 'gemini':
+    return {'x-goog-api-key': api_key}
+  return {'Authorization': f'Bearer {api_key}'}
+
+
+def _payload(provider, request):
+  """Extracts the HTTP body of a request built by `batch_request`."""
+  if provider == 'openai':
+    return request['body']
+  if provider == 'anthropic':
+    return request['params']
+  if provider == 'gemini':
+    return request['request']
+  return {k: v for k, v in request.items() if k != 'custom_id'}
+
+
+def _response_texts(provider, response):
+  """Extracts the (text, finish_reason) pairs of a provider's JSON response.
+
+  'generic' responses may list their `finish_reasons` next to the
+  `responses`, by the names of `_FINISH_REASONS`.
+  """
+  finish_reasons = _FINISH_REASONS.get(provider, {})
+  if provider == 'openai':
+    return [
+        (
+            choice['message']['content'],
+            finish_reasons.get(choice.get('finish_reason')),
+        )
+        for choice in response['choices']
+    ]
+  if provider == 'anthropic':
+    return [(
+        ''.join(
+            block['text'] for block in response['content']
+            if block['type'] == 'text'
+        ),
+        finish_reasons.get(response.get('stop_reason')),
+    )]
+  if provider == 'gemini':
+    return [
+        (
+            ''.join(
+                part.get('text', '') for part in candidate['content']['parts']
+            ),
+            finish_reasons.get(candidate.get('finishReason')),
+        )
+        for candidate in response['candidates']
+    ]
+  texts = response['responses']
+  return list(zip(texts, response.get('finish_reasons') or [None] * len(texts)))
+
+
+def _retry_after(headers):
+  try:
+    return float(headers['retry-after'])
+  except (KeyError, ValueError):
+    return None
+
+
+def http_backend(
+    url=None,
+    model='local',
+    provider='generic',
+    api_key=None,
+    requests_per_second=None,
+    tokens_per_second=None,
+    max_n=None,
+    name=None,
+):
+  """Creates a backend that posts requests to an HTTP API.
+
+  Args:
+    url: The endpoint. Defaults to the provider's public endpoint
+      (`DEFAULT_URLS`); required for 'generic'.
+    model: The model name.
+    provider: The API's request format, one of `batch_requests.PROVIDERS`.
+      'generic' endpoints take `{'model', 'messages', 'params', 'n'}` and
+      return `{'responses': [...]}`, like `local_server`.
+    api_key: The API key. Defaults to the provider's usual environment
+      variable (e.g., OPENAI_API_KEY), if set.
+    requests_per_second: An optional request rate limit.
+    tokens_per_second: An optional token rate limit, counting the estimated
+      prompt tokens and the requested `max_tokens` of each sample.
+    max_n: The most samples per request. Defaults to the provider's
+      `batch_requests.MAX_N`.
+    name: A printable name. Defaults to '<provider>:<model>'.
+
+  Returns:
+    backend: The backend dict.
+
+  Raises:
+    ValueError: If the provider is not supported or no URL is known.
+  """
+  batch_requests.provider_params({}, provider)
+  if url is None:
+    if provider not in DEFAULT_URLS:
+      raise ValueError(f'Please pass the url of the {provider} endpoint.')
+    url = DEFAULT_URLS[provider].format(model=model)
+  if api_key is None and provider in _API_KEY_VARIABLES:
+    api_key = os.environ.get(_API_KEY_VARIABLES[provider])
+  headers = _auth_headers(provider, api_key)
+
+  async def send(client, request):
+    try:
+      status, response_headers, body = await http_client.post_json(
+          client, url, _payload(provider, request), headers
+      )
+    except (OSError, EOFError, TimeoutError) as e:
+      raise BackendError(f'{url}: {e!r}', retryable=True) from e
+    if status != 200:
+      raise BackendError(
+          f'{url} returned {status}: {body[:200]!r}',
+          retryable=status in RETRYABLE_STATUSES,
+          retry_after=_retry_after(response_headers),
+      )
+    try:
+      return _response_texts(provider, json.loads(body))
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+      raise BackendError(f'Malformed response from {url}: {e!r}') from e
+
+  return {
+      'name': name or f'{provider}:{model}',
+      'provider': provider,
+      'model': model,
+      'max_n': max_n or batch_requests.MAX_N[provider],
+      'requests_per_second': requests_per_second,
+      'tokens_per_second': tokens_per_second,
+      'send': send,
+  }
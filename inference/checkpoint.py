@@ -0,0 +1,211 @@
+"""Append-only checkpoints of inference jobs.
+
+A job directory holds one CSV per prompt group in the layout of
+`sample_results_from_paper/` ('<model>_<group>.csv' with
+`prompt,answer,reasoning` rows), to which responses are appended as they
+arrive, and a small completion index per model, '<model>.completed.jsonl',
+so that several models can share a job directory. Each index line is
+written after its rows and records the prompt record id, the prompt's hash,
+the repeat indices of the rows and the CSV's size after them.
+
+On reopening, rows past the last indexed size of a file (written before a
+crash but never indexed) are truncated away, so a restarted job resumes
+exactly the (prompt id, repeat) pairs that are missing. The appended rows
+are in completion order; `results_csv.write_results_csv` writes them in
+prompt order once the job is done.
+"""
+
+import json
+import os
+import time
+
+from generation.corpus import corpus_export
+from inference import results_csv
+
+INDEX_SUFFIX = '.completed.jsonl'
+
+# How often appended data is made durable with fsync, in seconds
+_SYNC_INTERVAL = 5.0
+
+
+def _read_index(index_path):
+  """Reads the complete lines of an index, dropping a torn last line."""
+  if not os.path.exists(index_path):
+    return []
+  entries = []
+  with open(index_path, 'rb') as f:
+    for line in f:
+      if not line.endswith(b'\n'):
+        break
+      entries.append(json.loads(line))
+  return entries
+
+
+def _read_rows(path, size):
+  """Reads the rows in the first `size` bytes of a result CSV."""
+  with open(path, 'rb') as f:
+    return results_csv.decode_rows(f.read(size))[1:]
+
+
+def index_path(job_dir, model_name):
+  """Returns the path of a model's completion index in a job directory."""
+  return os.path.join(job_dir, model_name + INDEX_SUFFIX)
+
+
+def open_checkpoint(job_dir, model_name):
+  """Opens (or creates) a job checkpoint and recovers its completed work.
+
+  Args:
+    job_dir: The job directory.
+    model_name: The result file name prefix, e.g., 'gemini_ultra'.
+
+  Returns:
+    checkpoint: A handle for `completed_responses`, `append_responses` and
+      `close_checkpoint`. Its `completed` dict maps each record id to its
+      prompt hash and its completed {repeat: response}.
+  """
+  os.makedirs(job_dir, exist_ok=True)
+  path_of_index = index_path(job_dir, model_name)
+  entries = _read_index(path_of_index)
+
+  # Keeps the entries whose rows made it to disk, up to the first that didn't
+  sizes = {}
+  ends = {}
+  valid_entries = []
+  for entry in entries:
+    group = entry['group']
+    if group not in sizes:
+      path = results_csv.results_csv_path(job_dir, model_name, group)
+      sizes[group] = os.path.getsize(path) if os.path.exists(path) else 0
+    if entry['end'] > sizes[group]:
+      sizes[group] = -1
+      continue
+    valid_entries.append(entry)
+    ends[group] = entry['end']
+  with open(path_of_index + '.tmp', 'wb') as f:
+    for entry in valid_entries:
+      f.write((json.dumps(entry) + '\n').encode('utf-8'))
+  os.replace(path_of_index + '.tmp', path_of_index)
+
+  # Drops rows that were appended but never indexed. Only this model's own
+  # files are touched; those of groups it never indexed are truncated when
+  # first appended to.
+  for group in sizes:
+    path = results_csv.results_csv_path(job_dir, model_name, group)
+    if group in ends:
+      with open(path, 'ab') as f:
+        f.truncate(ends[group])
+    elif os.path.exists(path):
+      os.remove(path)
+
+  completed = {}
+  rows = {
+      group: iter(_read_rows(
+          results_csv.results_csv_path(job_dir, model_name, group), end
+      ))
+      for group, end in ends.items()
+  }
+  for entry in valid_entries:
+    record = completed.setdefault(
+        entry['id'], {'text_hash': entry['text_hash'], 'responses': {}}
+    )
+    for repeat in entry['repeats']:
+      record['responses'][repeat] = next(rows[entry['group']])[2]
+
+  return {
+      'dir': job_dir,
+      'model_name': model_name,
+      'completed': completed,
+      'ends': ends,
+      'files': {},
+      'index': open(path_of_index, 'ab'),
+      'last_sync': time.monotonic(),
+  }
+
+
+def completed_responses(checkpoint, record):
+  """Returns a record's completed responses (None where missing).
+
+  Completed work of a record whose prompt changed since is ignored.
+  """
+  responses = [None] * record['repeats']
+  completed = checkpoint['completed'].get(record['id'])
+  if completed is None or completed['text_hash'] != corpus_export.text_hash(
+      record['prompt']
+  ):
+    return responses
+  for repeat, response in completed['responses'].items():
+    if repeat < record['repeats']:
+      responses[repeat] = response
+  return responses
+
+
+def _sync(checkpoint, force=False):
+  if not force and time.monotonic() - checkpoint['last_sync'] < _SYNC_INTERVAL:
+    return
+  for f in checkpoint['files'].values():
+    os.fsync(f.fileno())
+  os.fsync(checkpoint['index'].fileno())
+  checkpoint['last_sync'] = time.monotonic()
+
+
+def append_responses(checkpoint, record, first_repeat, responses):
+  """Appends the responses of consecutive repeats of a record.
+
+  Args:
+    checkpoint: A handle from `open_checkpoint`.
+    record: The prompt record (see `prompt_records.iter_prompt_records`).
+    first_repeat: The repeat index of the first response, within the record.
+    responses: The response texts. None entries (failures) are skipped, so
+      they are retried on resume.
+  """
+  repeats = [
+      first_repeat + i
+      for i, response in enumerate(responses)
+      if response is not None
+  ]
+  if not repeats:
+    return
+  group = record['group']
+  if group not in checkpoint['files']:
+    path = results_csv.results_csv_path(
+        checkpoint['dir'], checkpoint['model_name'], group
+    )
+    f = open(path, 'ab')
+    # Rows of a group without indexed rows were never completed
+    f.truncate(checkpoint['ends'].get(group, 0))
+    f.seek(0, os.SEEK_END)
+    if f.tell() == 0:
+      f.write(results_csv.encode_rows([results_csv.CSV_COLUMNS]))
+    checkpoint['files'][group] = f
+  f = checkpoint['files'][group]
+  f.write(
+      results_csv.encode_rows(
+          results_csv.result_row(record['prompt'], responses[r - first_repeat])
+          for r in repeats
+      )
+  )
+  f.flush()
+  entry = {
+      'group': group,
+      'id': record['id'],
+      'text_hash': corpus_export.text_hash(record['prompt']),
+      'repeats': repeats,
+      'end': f.tell(),
+  }
+  checkpoint['index'].write((json.dumps(entry) + '\n').encode('utf-8'))
+  checkpoint['index'].flush()
+  completed = checkpoint['completed'].setdefault(
+      record['id'], {'text_hash': entry['text_hash'], 'responses': {}}
+  )
+  for r in repeats:
+    completed['responses'][r] = responses[r - first_repeat]
+  _sync(checkpoint)
+
+
+def close_checkpoint(checkpoint):
+  """Makes the appended data durable and closes the checkpoint's files."""
+  _sync(checkpoint, force=True)
+  for f in checkpoint['files'].values():
+    f.close()
+  checkpoint['index'].close()
@@ -0,0 +1,235 @@
+"""Runs one prompt dictionary against several backends at once.
+
+Evaluating many models on the same prompts as separate sequential jobs
+repeats the prompt-side work per model and takes as long as all the models
+together. The fan-out scheduler instead expands the prompts into records
+once (their token estimates and cache repeat numbers are shared too) and
+runs every backend's requests concurrently:
+
+  * each backend has its own concurrency limit and rate-limit buckets, so a
+    slow or rate-limited backend only holds its own slots and never stalls
+    the others, and
+  * one dispatcher hands out the shared in-flight budget (`total_concurrency`)
+    by start-time fair queuing: every request is tagged with its backend's
+    virtual start time, advanced by its estimated tokens over the backend's
+    weight, and the lowest tag among backends with a free slot goes next.
+
+A shared `response_cache` and per-backend checkpoints let a rerun skip the
+responses each backend already has.
+"""
+
+import asyncio
+import random
+import time
+
+from generation.corpus import prompt_records
+from inference import http_client
+from inference import request_ordering
+from inference import runner
+
+
+def _backend_state(backend, records, concurrency, weight, kwargs):
+  stats = {
+      'requests': 0,
+      'retries': 0,
+      'failed_requests': 0,
+      'resumed': 0,
+      'cache_hits': 0,
+      'deduplicated': 0,
+      'errors': [],
+  }
+  responses = {}
+  requests = runner.iter_requests(
+      records,
+      backend,
+      kwargs['sampling_params'],
+      kwargs['decoding'],
+      kwargs['cache'],
+      kwargs['checkpoint'],
+      responses,
+      stats,
+      None if kwargs['dedup_index'] is None else set(),
+  )
+  first_request = next(requests, None)
+  if first_request is None:
+    stats['seconds'] = 0.0
+  return {
+      'backend': backend,
+      'requests': requests,
+      'next': first_request,
+      'responses': responses,
+      'stats': stats,
+      'concurrency': concurrency,
+      'weight': weight,
+      'in_flight': 0,
+      'finish_tag': 0.0,
+      'buckets': {
+          'requests': runner.make_token_bucket(backend['requests_per_second']),
+          'tokens': runner.make_token_bucket(backend['tokens_per_second']),
+      },
+      'checkpoint': kwargs['checkpoint'],
+  }
+
+
+async def run_fan_out_async(
+    prompts,
+    backends,
+    concurrency=64,
+    weights=None,
+    total_concurrency=None,
+    sampling_params=None,
+    max_retries=5,
+    seed=None,
+    cache=None,
+    checkpoints=None,
+    decoding=None,
+    ordering=None,
+    dedup_index=None,
+):
+  """Runs every prompt of a prompt dictionary against several backends.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name, as returned by the
+      prompt generators.
+    backends: The backend dicts (see `backends`), with distinct names.
+    concurrency: The requests in flight per backend, an int or a dict keyed
+      by backend name.
+    weights: An optional dict of the backends' shares of the in-flight
+      budget, keyed by backend name (1 by default).
+    total_concurrency: The requests in flight across backends. Defaults to
+      the sum of the backends' concurrency, so that none waits for another.
+    sampling_params: See `runner.run_prompts_async`.
+    max_retries: See `runner.run_prompts_async`.
+    seed: An optional seed for the backoff jitter.
+    cache: An optional `response_cache` handle shared by the backends (its
+      entries are keyed by backend and model).
+    checkpoints: An optional dict of `checkpoint` handles keyed by backend
+      name.
+    decoding: See `runner.run_prompts_async`.
+    ordering: See `runner.run_prompts_async`. Every backend gets the same
+      order.
+    dedup_index: See `runner.run_prompts_async`. Each backend requests each
+      repeat of a text once.
+
+  Returns:
+    A dict mapping each backend name to its (responses, stats) tuple, as
+    from `runner.run_prompts_async`, where `seconds` is the time until that
+    backend's last response.
+
+  Raises:
+    ValueError: If backend names are not distinct.
+  """
+  names = [backend['name'] for backend in backends]
+  if len(set(names)) != len(names):
+    raise ValueError(f'Backend names must be distinct: {names}.')
+  if isinstance(concurrency, int):
+    concurrency = {name: concurrency for name in names}
+  weights = weights or {}
+  checkpoints = checkpoints or {}
+  total_concurrency = total_concurrency or sum(concurrency.values())
+
+  records = list(prompt_records.iter_prompt_records(prompts, dedup_index))
+  runner.number_cache_repeats(records)
+  ordered_records = request_ordering.order_records(records, ordering)
+  states = [
+      _backend_state(
+          backend,
+          ordered_records,
+          concurrency[backend['name']],
+          weights.get(backend['name'], 1.0),
+          {
+              'sampling_params': sampling_params,
+              'decoding': decoding,
+              'cache': cache,
+              'checkpoint': checkpoints.get(backend['name']),
+              'dedup_index': dedup_index,
+          },
+      )
+      for backend in backends
+  ]
+  client = http_client.make_client(max_connections_per_host=total_concurrency)
+  rng = random.Random(seed)
+  wake = asyncio.Event()
+  tasks = set()
+  in_flight = {'total': 0}
+  virtual_time = 0.0
+  start = time.monotonic()
+
+  async def run(state, item):
+    try:
+      await runner.run_request(
+          client,
+          state['backend'],
+          item,
+          state['buckets'],
+          max_retries,
+          rng,
+          state['stats'],
+          state['responses'],
+          cache,
+          state['checkpoint'],
+      )
+    finally:
+      state['in_flight'] -= 1
+      in_flight['total'] -= 1
+      if state['next'] is None and not state['in_flight']:
+        state['stats']['seconds'] = time.monotonic() - start
+      wake.set()
+
+  try:
+    while True:
+      eligible = [
+          state
+          for state in states
+          if state['next'] is not None
+          and state['in_flight'] < state['concurrency']
+      ]
+      if eligible and in_flight['total'] < total_concurrency:
+        state = min(
+            eligible, key=lambda s: max(virtual_time, s['finish_tag'])
+        )
+        item = state['next']
+        record, params, _, n, _ = item
+        start_tag = max(virtual_time, state['finish_tag'])
+        state['finish_tag'] = start_tag + (
+            runner.request_tokens(record, params, n) / state['weight']
+        )
+        virtual_time = start_tag
+        state['in_flight'] += 1
+        in_flight['total'] += 1
+        state['next'] = next(state['requests'], None)
+        task = asyncio.create_task(run(state, item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        continue
+      if not in_flight['total']:
+        break
+      wake.clear()
+      await wake.wait()
+    await asyncio.gather(*tasks)
+  finally:
+    for task in tasks:
+      task.cancel()
+    await http_client.close_client(client)
+
+  results = {}
+  for state in states:
+    stats = state['stats']
+    if dedup_index is not None:
+      runner.fan_out_canonical(
+          records, state['responses'], stats, state['checkpoint']
+      )
+    stats.setdefault('seconds', time.monotonic() - start)
+    stats['errors'] = stats['errors'][-10:]
+    responses = {}
+    for record in records:
+      responses.setdefault(record['group'], []).extend(
+          state['responses'][record['id']]
+      )
+    results[state['backend']['name']] = responses, stats
+  return results
+
+
+def run_fan_out(prompts, backends, **kwargs):
+  """Synchronous wrapper of `run_fan_out_async`."""
+  return asyncio.run(run_fan_out_async(prompts, backends, **kwargs))
@@ -0,0 +1,181 @@
+"""A minimal asyncio HTTP/1.1 client with keep-alive connection pools.
+
+The inference backends only need JSON POST requests, so this implements just
+that on top of asyncio streams: per-host pools of reusable connections with a
+bound on open connections, HTTPS, and Content-Length or chunked responses.
+"""
+
+import asyncio
+import json
+import ssl
+import urllib.parse
+
+
+def make_client(max_connections_per_host=64, timeout=120.0):
+  """Creates a client.
+
+  Args:
+    max_connections_per_host: The maximum number of open connections to one
+      host. Requests beyond it wait for a free connection.
+    timeout: The timeout in seconds of a whole request.
+
+  Returns:
+    client: A handle to pass to `post_json` and `close_client`.
+  """
+  return {
+      'max_connections_per_host': max_connections_per_host,
+      'timeout': timeout,
+      'idle': {},
+      'slots': {},
+  }
+
+
+def _pool_key(url):
+  parts = urllib.parse.urlsplit(url)
+  port = parts.port or (443 if parts.scheme == 'https' else 80)
+  return parts.scheme, parts.hostname, port
+
+
+async def _open_connection(key):
+  scheme, host, port = key
+  ssl_context = ssl.create_default_context() if scheme == 'https' else None
+  return await asyncio.open_connection(host, port, ssl=ssl_context)
+
+
+def _parse_int(text, base, what):
+  """Parses a number of a response, raising ConnectionError if malformed."""
+  try:
+    value = int(text, base)
+  except ValueError:
+    value = -1
+  if value < 0:
+    raise ConnectionError(f'Malformed {what}: {text!r}')
+  return value
+
+
+async def _read_headers(reader):
+  """Reads a status line and headers, returning (status, headers)."""
+  status_line = await reader.readline()
+  if not status_line:
+    raise ConnectionError('Connection closed before the response.')
+  fields = status_line.split()
+  if len(fields) < 2:
+    raise ConnectionError(f'Malformed status line: {status_line!r}')
+  status = _parse_int(fields[1], 10, 'status line')
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      return status, headers
+    name, _, value = line.decode('latin-1').partition(':')
+    headers[name.strip().lower()] = value.strip()
+
+
+async def _read_body(reader, headers):
+  """Reads a response body, returning (body, reusable)."""
+  if headers.get('transfer-encoding', '').lower() == 'chunked':
+    chunks = []
+    while True:
+      header = await reader.readline()
+      size = _parse_int(header.split(b';')[0], 16, 'chunk header')
+      if size == 0:
+        # Skips the (usually empty) trailers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+          pass
+        break
+      chunks.append(await reader.readexactly(size))
+      await reader.readexactly(2)
+    body = b''.join(chunks)
+  elif 'content-length' in headers:
+    body = await reader.readexactly(
+        _parse_int(headers['content-length'], 10, 'Content-Length')
+    )
+  else:
+    return await reader.read(), False
+  return body, headers.get('connection', '').lower() != 'close'
+
+
+async def _send(reader, writer, key, method, path, headers, body):
+  lines = [f'{method} {path} HTTP/1.1', f'Host: {key[1]}']
+  lines += [f'{name}: {value}' for name, value in headers.items()]
+  lines += [f'Content-Length: {len(body)}', '', '']
+  writer.write('\r\n'.join(lines).encode('latin-1') + body)
+  await writer.drain()
+  status, response_headers = await _read_headers(reader)
+  response_body, reusable = await _read_body(reader, response_headers)
+  return status, response_headers, response_body, reusable
+
+
+async def post_json(client, url, payload, headers=None):
+  """Posts a JSON payload, reusing a pooled connection if one is idle.
+
+  Args:
+    client: A handle from `make_client`.
+    url: The full URL to post to.
+    payload: A JSON-serializable request body.
+    headers: Optional extra request headers.
+
+  Returns:
+    A tuple (status, headers, body), with lower-case header names and the
+    raw body bytes.
+
+  Raises:
+    OSError, asyncio.TimeoutError: On connection failures, malformed
+      responses (as ConnectionError) and timeouts.
+  """
+  key = _pool_key(url)
+  parts = urllib.parse.urlsplit(url)
+  path = parts.path or '/'
+  if parts.query:
+    path += '?' + parts.query
+  request_headers = {
+      'Content-Type': 'application/json',
+      'Connection': 'keep-alive',
+      **(headers or {}),
+  }
+  body = json.dumps(payload).encode('utf-8')
+
+  if key not in client['slots']:
+    client['slots'][key] = asyncio.Semaphore(
+        client['max_connections_per_host']
+    )
+    client['idle'][key] = []
+  async with client['slots'][key]:
+    idle = client['idle'][key]
+    while True:
+      reused = bool(idle)
+      reader, writer = idle.pop() if reused else await _open_connection(key)
+      try:
+        status, response_headers, response_body, reusable = (
+            await asyncio.wait_for(
+                _send(reader, writer, key, 'POST', path, request_headers, body),
+                client['timeout'],
+            )
+        )
+      except (OSError, asyncio.IncompleteReadError):
+        writer.close()
+        if reused:
+          # The server may have closed an idle connection; try a fresh one
+          continue
+        raise
+      except asyncio.TimeoutError:
+        writer.close()
+        raise
+      if reusable:
+        idle.append((reader, writer))
+      else:
+        writer.close()
+      return status, response_headers, response_body
+
+
+async def close_client(client):
+  """Closes every idle connection of a client."""
+  for idle in client['idle'].values():
+    for _, writer in idle:
+      writer.close()
+    for _, writer in idle:
+      try:
+        await writer.wait_closed()
+      except OSError:
+        pass
+    idle.clear()
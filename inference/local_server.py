@@ -0,0 +1,201 @@
+"""A local HTTP stand-in for a model API, for testing the runner.
+
+The server speaks the 'generic' request format (see
+`backends.http_backend`): it answers POSTed `{'messages', 'params', 'n'}`
+bodies with `{'responses': [...]}`, after an optional simulated latency, and
+can inject rate-limit and server errors to exercise retries.
+
+The latency can grow with the prompt's tokens, less those found in a
+simulated prefix cache: like the block caches of model servers, it keeps
+hashes of fixed-size prompt prefixes, least recently used first out, so
+prompts sharing a prefix with recent ones are served faster.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import random
+
+from generation.corpus import token_accounting
+
+# Characters per prefix cache block, and per token in sizing the cache
+_BLOCK_CHARS = 64
+_CHARS_PER_TOKEN = 4
+
+
+def _default_respond(request, rng):
+  return [
+      f'<answer>{rng.uniform(0, 100):.2f}</answer>'
+      for _ in range(request.get('n', 1))
+  ]
+
+
+def _prefix_hashes(text):
+  """Returns the hashes of a text's whole-block prefixes, shortest first."""
+  hasher = hashlib.sha256()
+  hashes = []
+  for start in range(0, len(text) - _BLOCK_CHARS + 1, _BLOCK_CHARS):
+    hasher.update(text[start:start + _BLOCK_CHARS].encode('utf-8'))
+    hashes.append(hasher.copy().digest())
+  return hashes
+
+
+def _cached_fraction(prefix_cache, capacity, text):
+  """Looks a prompt up in the prefix cache and adds its blocks to it.
+
+  Returns:
+    The fraction of the text found in the cache.
+  """
+  hashes = _prefix_hashes(text)
+  cached = 0
+  while cached < len(hashes) and hashes[cached] in prefix_cache:
+    cached += 1
+  for block_hash in hashes:
+    prefix_cache[block_hash] = None
+    prefix_cache.move_to_end(block_hash)
+  while len(prefix_cache) > capacity:
+    prefix_cache.popitem(last=False)
+  return cached * _BLOCK_CHARS / len(text) if text else 0.0
+
+
+async def _read_request(reader):
+  """Reads one HTTP request, returning its JSON body (None at EOF)."""
+  request_line = await reader.readline()
+  if not request_line:
+    return None
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      break
+    name, _, value = line.decode('latin-1').partition(':')
+    headers[name.strip().lower()] = value.strip()
+  body = await reader.readexactly(int(headers.get('content-length', 0)))
+  return json.loads(body) if body else {}
+
+
+def _response(status, payload, extra_headers=()):
+  body = json.dumps(payload).encode('utf-8')
+  reason = {200: 'OK', 429: 'Too Many Requests', 503: 'Service Unavailable'}
+  lines = [
+      f'HTTP/1.1 {status} {reason.get(status, "Error")}',
+      'Content-Type: application/json',
+      f'Content-Length: {len(body)}',
+      'Connection: keep-alive',
+      *extra_headers,
+      '',
+      '',
+  ]
+  return '\r\n'.join(lines).encode('latin-1') + body
+
+
+async def start_local_server(
+    respond=None,
+    host='127.0.0.1',
+    port=0,
+    latency=0.0,
+    error_rate=0.0,
+    seed=0,
+    latency_per_token=0.0,
+    prefix_cache_tokens=0,
+):
+  """Starts the stand-in server on the running event loop.
+
+  Args:
+    respond: An optional function mapping a request dict and a
+      `random.Random` to the list of response texts. Defaults to `n` random
+      '<answer>...</answer>' numbers from 0 to 100.
+    host: The host to bind.
+    port: The port to bind, 0 for any free port.
+    latency: The simulated seconds per request.
+    error_rate: The fraction of requests answered with a 429 or 503.
+    seed: The seed of the server's random number generator.
+    latency_per_token: The simulated seconds per prompt token not found in
+      the prefix cache (by `token_accounting.estimate_tokens`).
+    prefix_cache_tokens: The capacity of the simulated prefix cache, in
+      tokens (0 for none).
+
+  Returns:
+    server: A dict with the `url` to pass to `backends.http_backend`, the
+      `stats` (requests, errors, open connections, and with a per-token
+      latency or a prefix cache, the `prompt_tokens` and `cached_tokens` of
+      the requests) and the asyncio `server`.
+      Call `stop_local_server` when done.
+  """
+  respond = respond or _default_respond
+  rng = random.Random(seed)
+  stats = {
+      'requests': 0,
+      'errors': 0,
+      'connections': 0,
+      'prompt_tokens': 0,
+      'cached_tokens': 0,
+  }
+  handlers = {}
+  prefix_cache = collections.OrderedDict()
+  prefix_cache_blocks = prefix_cache_tokens * _CHARS_PER_TOKEN // _BLOCK_CHARS
+
+  def request_latency(request):
+    if not latency_per_token and not prefix_cache_blocks:
+      return latency
+    prompt = ''.join(m['content'] for m in request.get('messages', ()))
+    tokens = token_accounting.estimate_tokens(prompt)
+    cached = 0
+    if prefix_cache_blocks:
+      cached = round(
+          tokens * _cached_fraction(prefix_cache, prefix_cache_blocks, prompt)
+      )
+    stats['prompt_tokens'] += tokens
+    stats['cached_tokens'] += cached
+    return latency + latency_per_token * (tokens - cached)
+
+  async def handle(reader, writer):
+    stats['connections'] += 1
+    handlers[asyncio.current_task()] = writer
+    try:
+      while True:
+        request = await _read_request(reader)
+        if request is None:
+          break
+        stats['requests'] += 1
+        delay = request_latency(request)
+        if delay:
+          await asyncio.sleep(delay)
+        if rng.random() < error_rate:
+          stats['errors'] += 1
+          status = rng.choice((429, 503))
+          writer.write(
+              _response(status, {'error': 'injected'}, ['Retry-After: 0'])
+          )
+        else:
+          writer.write(
+              _response(200, {'responses': respond(request, rng)})
+          )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+      handlers.pop(asyncio.current_task())
+
+  server = await asyncio.start_server(handle, host, port)
+  bound_port = server.sockets[0].getsockname()[1]
+  return {
+      'url': f'http://{host}:{bound_port}/',
+      'stats': stats,
+      'server': server,
+      'handlers': handlers,
+  }
+
+
+async def stop_local_server(server):
+  """Stops a server started by `start_local_server`."""
+  server['server'].close()
+  # Closing the connections lets their handlers finish instead of being
+  # cancelled mid-read when the event loop stops
+  tasks = list(server['handlers'])
+  for writer in server['handlers'].values():
+    writer.close()
+  await asyncio.gather(*tasks, return_exceptions=True)
+  await server['server'].wait_closed()
@@ -0,0 +1,121 @@
+"""Benchmarks of dispatch orderings against the local stand-in server.
+
+Each ordering (see `request_ordering`) runs the same prompt dictionary with
+the same concurrency against a fresh `local_server`, whose latency grows
+with the prompt tokens that miss its simulated prefix cache, and reports:
+
+  * the makespan, in `seconds`,
+  * the `mean_group_seconds` until a group has all its responses, and the
+    `mean_first_response_seconds` until it has its first one (how early
+    partial results come in), and
+  * the `cached_fraction` of the prompt tokens found in the prefix cache.
+"""
+
+import asyncio
+import statistics
+import time
+
+from generation.corpus import batch_requests
+from generation.corpus import prompt_records
+from inference import backends
+from inference import local_server
+from inference import request_ordering
+from inference import runner
+
+
+async def benchmark_ordering_async(
+    prompts,
+    ordering=None,
+    concurrency=16,
+    max_n=None,
+    sampling_params=None,
+    latency=0.0,
+    latency_per_token=0.0,
+    prefix_cache_tokens=0,
+    seed=0,
+):
+  """Runs a prompt dictionary in one dispatch order against a local server.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name.
+    ordering: The dispatch order (see `request_ordering.order_records`).
+    concurrency: The number of requests in flight.
+    max_n: The most samples per request (None for no limit).
+    sampling_params: See `runner.run_prompts_async`.
+    latency: The server's fixed seconds per request.
+    latency_per_token: The server's seconds per uncached prompt token.
+    prefix_cache_tokens: The server's prefix cache capacity, in tokens.
+    seed: The seed of the server and of the runner.
+
+  Returns:
+    A dict with the `seconds`, `mean_group_seconds`,
+    `mean_first_response_seconds` and `cached_fraction`.
+  """
+  request_groups = {}
+  for record in prompt_records.iter_prompt_records(prompts):
+    for first in range(record['repeats']):
+      request_id = batch_requests.custom_id(
+          record['group'], record['index'], first
+      )
+      request_groups[request_id] = record['group']
+
+  server = await local_server.start_local_server(
+      latency=latency,
+      seed=seed,
+      latency_per_token=latency_per_token,
+      prefix_cache_tokens=prefix_cache_tokens,
+  )
+  backend = backends.http_backend(server['url'], max_n=max_n)
+  send = backend['send']
+  group_seconds = {}
+  first_response_seconds = {}
+  start = time.monotonic()
+
+  async def timed_send(client, request):
+    choices = await send(client, request)
+    group = request_groups[request['custom_id']]
+    group_seconds[group] = time.monotonic() - start
+    first_response_seconds.setdefault(group, group_seconds[group])
+    return choices
+
+  backend['send'] = timed_send
+  try:
+    _, stats = await runner.run_prompts_async(
+        prompts,
+        backend,
+        concurrency=concurrency,
+        sampling_params=sampling_params,
+        seed=seed,
+        ordering=ordering,
+    )
+  finally:
+    await local_server.stop_local_server(server)
+  server_stats = server['stats']
+  return {
+      'seconds': stats['seconds'],
+      'mean_group_seconds': statistics.mean(group_seconds.values()),
+      'mean_first_response_seconds': statistics.mean(
+          first_response_seconds.values()
+      ),
+      'cached_fraction': (
+          server_stats['cached_tokens'] / server_stats['prompt_tokens']
+          if server_stats['prompt_tokens']
+          else 0.0
+      ),
+  }
+
+
+def benchmark_orderings(
+    prompts, orderings=request_ordering.ORDERINGS, **kwargs
+):
+  """Benchmarks several dispatch orders (see `benchmark_ordering_async`).
+
+  Returns:
+    A dict mapping each ordering to its results.
+  """
+  return {
+      ordering: asyncio.run(
+          benchmark_ordering_async(prompts, ordering, **kwargs)
+      )
+      for ordering in orderings
+  }
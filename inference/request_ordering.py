@@ -0,0 +1,85 @@
+"""Dispatch orderings of prompt records.
+
+The prompt generators emit groups in a fixed order, from 0-shot to 9-shot,
+whose prompts differ in length by over 10x. With a fixed concurrency budget,
+the order requests are dispatched in changes a job's makespan and how soon
+results come in:
+
+  * 'longest_first' starts the most expensive records first, so that a long
+    request started last does not set the job's tail,
+  * 'shared_prefix' sends prompts in lexicographic order (a depth-first walk
+    of their prefix tree), so that prompts sharing a prefix reach a server's
+    prefix cache back to back,
+  * 'interleave' takes records from every group in turn, so that every group
+    has partial results early, and
+  * a function of the record can be passed as a custom priority sort key,
+    e.g., `lambda record: record['num_shots']`.
+
+Responses are still returned in prompt order. See `ordering_benchmark` to
+compare the orderings against a local stand-in server.
+"""
+
+import itertools
+
+from generation.corpus import token_accounting
+
+ORDERINGS = (
+    'prompt',
+    'longest_first',
+    'shortest_first',
+    'shared_prefix',
+    'interleave',
+)
+
+
+def prompt_tokens(record):
+  """Returns a record's estimated prompt tokens, kept as `prompt_tokens`."""
+  if 'prompt_tokens' not in record:
+    record['prompt_tokens'] = token_accounting.estimate_tokens(record['prompt'])
+  return record['prompt_tokens']
+
+
+def record_cost(record):
+  """Returns the estimated prompt tokens of all of a record's repeats."""
+  return prompt_tokens(record) * record['repeats']
+
+
+def order_records(records, ordering=None):
+  """Returns prompt records in dispatch order.
+
+  Args:
+    records: Prompt records (see `prompt_records.iter_prompt_records`).
+    ordering: One of `ORDERINGS`, a function mapping a record to its sort
+      key, or None for the prompt order. Ties keep the prompt order.
+
+  Returns:
+    The list of records.
+
+  Raises:
+    ValueError: If the ordering is not supported.
+  """
+  records = list(records)
+  if ordering is None or ordering == 'prompt':
+    return records
+  if callable(ordering):
+    return sorted(records, key=ordering)
+  if ordering == 'longest_first':
+    return sorted(records, key=lambda record: -record_cost(record))
+  if ordering == 'shortest_first':
+    return sorted(records, key=record_cost)
+  if ordering == 'shared_prefix':
+    return sorted(records, key=lambda record: record['prompt'])
+  if ordering == 'interleave':
+    groups = {}
+    for record in records:
+      groups.setdefault(record['group'], []).append(record)
+    return [
+        record
+        for records_at in itertools.zip_longest(*groups.values())
+        for record in records_at
+        if record is not None
+    ]
+  raise ValueError(
+      f'Unsupported ordering: {ordering}. Please pick from {ORDERINGS}, or'
+      ' pass a sort key function.'
+  )
@@ -0,0 +1,277 @@
+"""A persistent SQLite cache of model responses.
+
+Responses are keyed by (backend, model, decoding parameters, prompt hash,
+repeat index), so rerunning a prompt dictionary only queries the model for
+samples it has not answered before under the same settings. Entries can
+expire after a TTL, and the least recently used ones are evicted beyond a
+size limit.
+
+A replay cache serves results that were collected elsewhere, such as the
+`sample_results_from_paper` CSVs, read-only: its lookups match the prompt
+text and repeat index only, since the settings those responses were sampled
+with are not recorded.
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import time
+
+from generation.corpus import corpus_export
+from inference import results_csv
+
+REPLAY_BACKEND = 'replay'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+  backend TEXT NOT NULL,
+  model TEXT NOT NULL,
+  params TEXT NOT NULL,
+  prompt_hash TEXT NOT NULL,
+  repeat INTEGER NOT NULL,
+  response TEXT NOT NULL,
+  bytes INTEGER NOT NULL,
+  created REAL NOT NULL,
+  accessed REAL NOT NULL,
+  PRIMARY KEY (backend, model, params, prompt_hash, repeat)
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+# Commits are batched, since a commit per response would dominate run time
+_COMMIT_EVERY = 1000
+
+
+def params_key(sampling_params):
+  """Returns the canonical form of decoding parameters used in keys."""
+  return json.dumps(
+      {k: v for k, v in (sampling_params or {}).items() if v is not None},
+      sort_keys=True,
+      separators=(',', ':'),
+  )
+
+
+def open_cache(
+    path, ttl_seconds=None, max_entries=None, max_bytes=None, read_only=False
+):
+  """Opens (or creates) a response cache.
+
+  Args:
+    path: The SQLite database file, or ':memory:'.
+    ttl_seconds: An optional lifetime of entries. Expired entries are not
+      served, and are deleted by `evict`.
+    max_entries: An optional limit on the number of entries.
+    max_bytes: An optional limit on the total size of the responses.
+    read_only: Whether `put` should be a no-op.
+
+  Returns:
+    cache: A handle to pass to the other functions. Call `close_cache` when
+      done, which also evicts entries beyond the limits.
+  """
+  if path != ':memory:':
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  connection = sqlite3.connect(path)
+  connection.execute('PRAGMA journal_mode=WAL')
+  connection.executescript(_SCHEMA)
+  return {
+      'connection': connection,
+      'ttl_seconds': ttl_seconds,
+      'max_entries': max_entries,
+      'max_bytes': max_bytes,
+      'read_only': read_only,
+      'replay': False,
+      'pending': 0,
+  }
+
+
+def _commit(cache, force=False):
+  if force or cache['pending'] >= _COMMIT_EVERY:
+    cache['connection'].commit()
+    cache['pending'] = 0
+
+
+def get_responses(
+    cache, backend, model, sampling_params, prompt, repeats, first_repeat=0
+):
+  """Looks up the cached responses of consecutive repeats of a prompt.
+
+  Args:
+    cache: A handle from `open_cache` or `open_replay_cache`.
+    backend: The backend name.
+    model: The model name.
+    sampling_params: The decoding parameters.
+    prompt: The prompt text.
+    repeats: The number of repeats to look up.
+    first_repeat: The repeat index of the first one.
+
+  Returns:
+    A list with the cached response of each repeat index, or None.
+  """
+  prompt_hash = corpus_export.text_hash(prompt)
+  now = time.time()
+  if cache['replay']:
+    rows = cache['connection'].execute(
+        'SELECT repeat, response FROM responses'
+        ' WHERE prompt_hash = ? AND repeat >= ? AND repeat < ?',
+        (prompt_hash, first_repeat, first_repeat + repeats),
+    ).fetchall()
+  else:
+    min_created = now - cache['ttl_seconds'] if cache['ttl_seconds'] else 0
+    key = (backend, model, params_key(sampling_params), prompt_hash)
+    rows = cache['connection'].execute(
+        'SELECT repeat, response FROM responses WHERE backend = ?'
+        ' AND model = ? AND params = ? AND prompt_hash = ? AND repeat >= ?'
+        ' AND repeat < ? AND created >= ?',
+        (*key, first_repeat, first_repeat + repeats, min_created),
+    ).fetchall()
+    if rows and not cache['read_only']:
+      cache['connection'].execute(
+          'UPDATE responses SET accessed = ? WHERE backend = ? AND model = ?'
+          ' AND params = ? AND prompt_hash = ? AND repeat >= ?'
+          ' AND repeat < ?',
+          (now, *key, first_repeat, first_repeat + repeats),
+      )
+      cache['pending'] += 1
+      _commit(cache)
+  responses = [None] * repeats
+  for repeat, response in rows:
+    responses[repeat - first_repeat] = response
+  return responses
+
+
+def put_responses(
+    cache, backend, model, sampling_params, prompt, first_repeat, responses
+):
+  """Stores the responses of consecutive repeats of a prompt.
+
+  Args:
+    cache: A handle from `open_cache`.
+    backend: The backend name.
+    model: The model name.
+    sampling_params: The decoding parameters.
+    prompt: The prompt text.
+    first_repeat: The repeat index of the first response.
+    responses: The response texts. None entries (failures) are skipped.
+  """
+  if cache['read_only']:
+    return
+  prompt_hash = corpus_export.text_hash(prompt)
+  params = params_key(sampling_params)
+  now = time.time()
+  rows = [
+      (
+          backend, model, params, prompt_hash, first_repeat + i, response,
+          len(response.encode('utf-8')), now, now,
+      )
+      for i, response in enumerate(responses)
+      if response is not None
+  ]
+  cache['connection'].executemany(
+      'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+      rows,
+  )
+  cache['pending'] += len(rows)
+  _commit(cache)
+
+
+def cache_stats(cache):
+  """Returns the number of `entries` and the total response `bytes`."""
+  entries, total_bytes = cache['connection'].execute(
+      'SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM responses'
+  ).fetchone()
+  return {'entries': entries, 'bytes': total_bytes}
+
+
+def evict(cache):
+  """Deletes expired entries, then the least recently used beyond the limits.
+
+  Returns:
+    The number of deleted entries.
+  """
+  if cache['read_only']:
+    return 0
+  connection = cache['connection']
+  deleted = 0
+  if cache['ttl_seconds']:
+    deleted += connection.execute(
+        'DELETE FROM responses WHERE created < ?',
+        (time.time() - cache['ttl_seconds'],),
+    ).rowcount
+  stats = cache_stats(cache)
+  if cache['max_entries'] is not None and (
+      stats['entries'] > cache['max_entries']
+  ):
+    deleted += connection.execute(
+        'DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses'
+        ' ORDER BY accessed LIMIT ?)',
+        (stats['entries'] - cache['max_entries'],),
+    ).rowcount
+    stats = cache_stats(cache)
+  if cache['max_bytes'] is not None and stats['bytes'] > cache['max_bytes']:
+    excess = stats['bytes'] - cache['max_bytes']
+    rowids = []
+    for rowid, size in connection.execute(
+        'SELECT rowid, bytes FROM responses ORDER BY accessed'
+    ):
+      rowids.append((rowid,))
+      excess -= size
+      if excess <= 0:
+        break
+    connection.executemany('DELETE FROM responses WHERE rowid = ?', rowids)
+    deleted += len(rowids)
+  _commit(cache, force=True)
+  return deleted
+
+
+def close_cache(cache):
+  """Evicts entries beyond the cache's limits, commits and closes it."""
+  evict(cache)
+  _commit(cache, force=True)
+  cache['connection'].close()
+
+
+def open_replay_cache(results, model=None):
+  """Builds a read-only, in-memory cache from result CSVs.
+
+  Args:
+    results: A directory (searched recursively), a glob pattern, or a list
+      of CSV paths in the `prompt,answer,reasoning` schema of
+      `sample_results_from_paper`. The k-th row of a prompt within a file is
+      its repeat k; rows without a `reasoning` fall back to the `answer`.
+    model: An optional model name (the file name prefix, e.g.,
+      'gemini_ultra' or 'Gpt4Turbo') to only load that model's files. When
+      several loaded models answered the same prompt, the files sorted last
+      win.
+
+  Returns:
+    cache: A handle for `get_responses`, which then matches the prompt text
+      and repeat index only.
+  """
+  cache = open_cache(':memory:')
+  rows = []
+  for path in sorted(results_csv.find_results_csvs(results)):
+    name = results_csv.parse_results_csv_name(path)
+    file_model = name[0] if name else ''
+    if model is not None and file_model != model:
+      continue
+    repeats = {}
+    with open(path, newline='') as f:
+      for row in csv.DictReader(f):
+        prompt_hash = corpus_export.text_hash(row['prompt'])
+        repeat = repeats.get(prompt_hash, 0)
+        repeats[prompt_hash] = repeat + 1
+        response = row.get('reasoning') or row.get('answer') or ''
+        rows.append((
+            REPLAY_BACKEND, file_model, '', prompt_hash, repeat, response,
+            len(response.encode('utf-8')), 0.0, 0.0,
+        ))
+  cache['connection'].executemany(
+      'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+      rows,
+  )
+  cache['connection'].commit()
+  cache['read_only'] = True
+  cache['replay'] = True
+  return cache
+
@@ -0,0 +1,119 @@
+"""Result files in the CSV schema of `sample_results_from_paper/`.
+
+Results are stored as one CSV per prompt group, named '<model>_<group>.csv',
+with a `prompt,answer,reasoning` row per sample, where `reasoning` is the
+full response and `answer` the text between its answer tags.
+"""
+
+import csv
+import glob
+import io
+import os
+import re
+
+CSV_COLUMNS = ('prompt', 'answer', 'reasoning')
+
+_ANSWER = re.compile(r'<answer>(.*?)</answer>', re.DOTALL)
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
+# Result file names start with the model name, e.g.,
+# 'gemini_ultra_percentiles_zero_shot_synthetic_average_temperature_10_samples'
+_RESULT_FILE_NAME = re.compile(
+    r'^(?P<model>.+?)_(?P<group>(?:percentiles|sampling|probabilities)_.+)'
+    r'\.csv$'
+)
+
+
+def extract_answer(response):
+  """Returns the text between the last answer tags of a response, or ''."""
+  answers = _ANSWER.findall(response or '')
+  return answers[-1].strip() if answers else ''
+
+
+def parse_number(text):
+  """Returns the first number in a text, ignoring thousands separators."""
+  match = _NUMBER.search((text or '').replace(',', ''))
+  return float(match.group()) if match else None
+
+
+def answer_value(response):
+  """Returns the number in a response's answer tags, or None."""
+  return parse_number(extract_answer(response))
+
+
+def find_results_csvs(results):
+  """Returns the result CSV paths of a directory, glob pattern or path list.
+
+  Directories are searched recursively.
+  """
+  if not isinstance(results, str):
+    return list(results)
+  if os.path.isdir(results):
+    return glob.glob(os.path.join(results, '**', '*.csv'), recursive=True)
+  return glob.glob(results)
+
+
+def parse_results_csv_name(path):
+  """Returns the (model, group) of a results CSV path, or None."""
+  match = _RESULT_FILE_NAME.match(os.path.basename(path))
+  return (match['model'], match['group']) if match else None
+
+
+def results_csv_path(output_dir, model_name, group):
+  """Returns the results CSV path of a group, e.g., '<model>_<group>.csv'."""
+  return os.path.join(output_dir, f'{model_name}_{group}.csv')
+
+
+def encode_rows(rows):
+  """Encodes rows as CSV bytes, in the format the result files use."""
+  buffer = io.StringIO()
+  csv.writer(buffer, lineterminator='\n').writerows(rows)
+  return buffer.getvalue().encode('utf-8')
+
+
+def decode_rows(data):
+  """Decodes CSV bytes in the format the result files use as row lists."""
+  return list(csv.reader(io.StringIO(data.decode('utf-8'), newline='')))
+
+
+def result_row(prompt, response):
+  """Returns the `prompt,answer,reasoning` row of one response."""
+  return (prompt, extract_answer(response), response or '')
+
+
+def write_results_csv(
+    prompts, responses, output_dir, model_name, skip_missing=False
+):
+  """Writes responses in the `prompt,answer,reasoning` CSV schema.
+
+  Args:
+    prompts: The prompt dictionary that was run.
+    responses: The per-group response lists from `runner.run_prompts`.
+    output_dir: The directory to write one CSV per group to.
+    model_name: The file name prefix, e.g., 'gemini_ultra'.
+    skip_missing: Whether to leave out the rows of missing (failed, or never
+      requested by `adaptive_repeats`) responses instead of writing them
+      with an empty answer.
+
+  Returns:
+    The list of written paths.
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  paths = []
+  for group, group_prompts in prompts.items():
+    path = results_csv_path(output_dir, model_name, group)
+    rows = [CSV_COLUMNS] + [
+        result_row(prompt, response)
+        for prompt, response in zip(group_prompts, responses[group])
+        if response is not None or not skip_missing
+    ]
+    with open(path, 'wb') as f:
+      f.write(encode_rows(rows))
+    paths.append(path)
+  return paths
+
+
+def read_results_csv(path):
+  """Reads a result CSV as a list of row dicts."""
+  with open(path, newline='', encoding='utf-8') as f:
+    return list(csv.DictReader(f))
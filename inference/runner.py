@@ -0,0 +1,482 @@
+"""Asynchronous, high-concurrency execution of prompt dictionaries.
+
+The runner expands a prompt dictionary into requests (one per prompt record,
+or several when its repeats exceed the backend's `max_n`), skipping repeats
+that an optional `checkpoint` or `response_cache` already holds (and, with a
+`dedup_index`, repeats of a text that another group already requests), and a
+fixed pool of worker tasks sends them to a backend with:
+
+  * bounded concurrency and pooled keep-alive connections,
+  * token-bucket rate limits on requests and tokens per second, and
+  * retries with exponential backoff and full jitter (or the server's
+    Retry-After).
+
+Responses are returned per group, in prompt order, and can be written in the
+CSV schema of `sample_results_from_paper/` with `results_csv`.
+"""
+
+import asyncio
+import random
+import time
+
+from generation.corpus import batch_requests
+from generation.corpus import decoding_settings
+from generation.corpus import dedup_index as dedup_index_lib
+from generation.corpus import prompt_records
+from inference import backends
+from inference import checkpoint as checkpoint_lib
+from inference import http_client
+from inference import request_ordering
+from inference import response_cache
+
+
+def make_token_bucket(rate, capacity=None):
+  """Creates a token bucket refilling at `rate` per second.
+
+  Args:
+    rate: The refill rate, or None for an unlimited bucket.
+    capacity: The most the bucket holds (the allowed burst). Defaults to one
+      second's worth.
+
+  Returns:
+    bucket: A handle to pass to `take`.
+  """
+  capacity = capacity or rate
+  return {
+      'rate': rate,
+      'capacity': capacity,
+      'level': capacity,
+      'updated': time.monotonic(),
+      'lock': asyncio.Lock(),
+  }
+
+
+async def take(bucket, amount=1):
+  """Waits until the bucket holds `amount` and takes it.
+
+  Waiters are served in order. Amounts above the capacity are taken once the
+  bucket is full, leaving it in debt.
+  """
+  if bucket['rate'] is None:
+    return
+  async with bucket['lock']:
+    while True:
+      now = time.monotonic()
+      bucket['level'] = min(
+          bucket['capacity'],
+          bucket['level'] + (now - bucket['updated']) * bucket['rate'],
+      )
+      bucket['updated'] = now
+      needed = min(amount, bucket['capacity'])
+      if bucket['level'] >= needed:
+        bucket['level'] -= amount
+        return
+      await asyncio.sleep((needed - bucket['level']) / bucket['rate'])
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, rng=random):
+  """Returns the full-jitter exponential backoff of a retry attempt."""
+  return rng.uniform(0, min(cap, base * 2**attempt))
+
+
+def request_tokens(record, sampling_params, n):
+  """Returns the tokens a request is charged against the token bucket.
+
+  The prompt's estimate is kept on the record (see
+  `request_ordering.prompt_tokens`), so it is made once however many
+  requests and backends the record is sent to.
+  """
+  max_tokens = sampling_params.get('max_tokens') or 0
+  return request_ordering.prompt_tokens(record) + max_tokens * n
+
+
+async def send_with_retries(
+    client, backend, request, buckets, tokens, max_retries, rng, stats
+):
+  """Sends one request, retrying retryable failures.
+
+  Returns:
+    The response (text, finish_reason) pairs, or None if the request failed
+    for good.
+  """
+  for attempt in range(max_retries + 1):
+    await take(buckets['requests'])
+    await take(buckets['tokens'], tokens)
+    try:
+      return await backend['send'](client, request)
+    except backends.BackendError as e:
+      if not e.retryable or attempt == max_retries:
+        stats['errors'].append(str(e))
+        return None
+      stats['retries'] += 1
+      delay = e.retry_after
+      if delay is None:
+        delay = backoff_delay(attempt, rng=rng)
+      await asyncio.sleep(delay)
+
+
+def number_cache_repeats(records):
+  """Numbers each record's repeats across the records of its group.
+
+  Sets each record's `cache_repeat` to the repeat index, in the cache, of its
+  first repeat, so that non-consecutive occurrences of a prompt text in a
+  group get distinct cached samples.
+  """
+  occurrences = {}
+  for record in records:
+    occurrence_key = (record['group'], record['prompt'])
+    record['cache_repeat'] = occurrences.get(occurrence_key, 0)
+    occurrences[occurrence_key] = record['cache_repeat'] + record['repeats']
+
+
+def lookup_responses(
+    backend, record, params, cache, checkpoint, stats, first=0, n=None
+):
+  """Returns a run of a record's responses from the checkpoint or cache.
+
+  Cached responses that the checkpoint lacks are checkpointed.
+
+  Args:
+    backend: The backend dict.
+    record: A prompt record, numbered with `number_cache_repeats`.
+    params: The record's sampling parameters.
+    cache: An optional `response_cache` handle.
+    checkpoint: An optional `checkpoint` handle.
+    stats: The run's stats, whose `resumed` and `cache_hits` are counted.
+    first: The first repeat of the run.
+    n: The repeats of the run. Defaults to the rest of the record's.
+
+  Returns:
+    The run's responses, None where missing.
+  """
+  n = record['repeats'] - first if n is None else n
+  responses = [None] * n
+  if checkpoint is not None:
+    completed = checkpoint_lib.completed_responses(checkpoint, record)
+    responses = completed[first:first + n]
+    stats['resumed'] += sum(r is not None for r in responses)
+  if cache is not None and None in responses:
+    cached = response_cache.get_responses(
+        cache,
+        backend['name'],
+        backend['model'],
+        params,
+        record['prompt'],
+        n,
+        record['cache_repeat'] + first,
+    )
+    cached = [c if r is None else None for r, c in zip(responses, cached)]
+    stats['cache_hits'] += sum(c is not None for c in cached)
+    if checkpoint is not None:
+      checkpoint_lib.append_responses(checkpoint, record, first, cached)
+    responses = [c if r is None else r for r, c in zip(responses, cached)]
+  return responses
+
+
+def make_request(backend, record, params, first, n):
+  """Builds the request for n repeats of a record, from repeat `first` on.
+
+  Returns:
+    A (record, sampling_params, first_repeat, n, request) tuple for
+    `run_request`.
+  """
+  messages = [{'role': 'user', 'content': record['prompt'], 'cache': False}]
+  request = batch_requests.batch_request(
+      backend['provider'],
+      batch_requests.custom_id(record['group'], record['index'], first),
+      messages,
+      backend['model'],
+      params,
+      n,
+  )
+  return record, params, first, n, request
+
+
+def iter_requests(
+    records,
+    backend,
+    sampling_params,
+    decoding,
+    cache,
+    checkpoint,
+    responses,
+    stats,
+    claimed=None,
+):
+  """Yields a request per run of repeats not in the checkpoint or cache.
+
+  Fills `responses` with each record's completed or cached responses (None
+  where missing) along the way, and checkpoints the cached ones. The records
+  must be numbered with `number_cache_repeats`.
+
+  With a `claimed` set, the records must carry canonical ids (see
+  `prompt_records.iter_prompt_records`), and each (canonical id, cache
+  repeat) slot is requested once: the repeats of slots that an earlier record
+  claimed are left to `fan_out_canonical`.
+
+  Yields:
+    (record, sampling_params, first_repeat, n, request) tuples, where
+    `first_repeat` counts within the record.
+  """
+  max_n = backend['max_n']
+  for record in records:
+    params = batch_requests.record_sampling_params(
+        record, sampling_params, decoding
+    )
+    repeats = record['repeats']
+    record_responses = lookup_responses(
+        backend, record, params, cache, checkpoint, stats
+    )
+    responses[record['id']] = record_responses
+    missing = [response is None for response in record_responses]
+    if claimed is not None:
+      for r in range(repeats):
+        slot = (record['canonical_id'], record['cache_repeat'] + r)
+        if slot in claimed:
+          missing[r] = False
+        claimed.add(slot)
+    first = 0
+    while first < repeats:
+      if not missing[first]:
+        first += 1
+        continue
+      end = first + 1
+      while (
+          end < repeats
+          and missing[end]
+          and (max_n is None or end - first < max_n)
+      ):
+        end += 1
+      yield make_request(backend, record, params, first, end - first)
+      first = end
+
+
+def fan_out_canonical(records, responses, stats, checkpoint=None):
+  """Fills the repeats that `iter_requests` left to records of the same text.
+
+  Each (canonical id, cache repeat) slot's response is fanned back out to
+  every record that shares it (see `dedup_index.fan_out_responses`). Records
+  keep the responses they have of their own, and the filled ones are
+  counted in `stats['deduplicated']` and checkpointed.
+
+  Args:
+    records: The prompt records, in group and index order, numbered with
+      `number_cache_repeats` and carrying canonical ids.
+    responses: The per-record response lists filled by `iter_requests` and
+      `run_request`, updated in place.
+    stats: The run's stats.
+    checkpoint: An optional `checkpoint` handle.
+  """
+  slots = {}
+  sizes = {}
+  canonical_ids = {}
+  for record in records:
+    canonical_id = record['canonical_id']
+    sizes[canonical_id] = max(
+        sizes.get(canonical_id, 0), record['cache_repeat'] + record['repeats']
+    )
+    canonical_ids.setdefault(record['group'], []).extend(
+        [canonical_id] * record['repeats']
+    )
+    for r, response in enumerate(responses[record['id']]):
+      if response is not None:
+        slots.setdefault((canonical_id, record['cache_repeat'] + r), response)
+  fanned_out = dedup_index_lib.fan_out_responses(
+      canonical_ids,
+      {
+          canonical_id: [slots.get((canonical_id, k)) for k in range(size)]
+          for canonical_id, size in sizes.items()
+      },
+  )
+
+  positions = {}
+  for record in records:
+    start = positions.get(record['group'], 0)
+    positions[record['group']] = start + record['repeats']
+    record_responses = responses[record['id']]
+    filled = [
+        fanned if response is None else None
+        for response, fanned in zip(
+            record_responses,
+            fanned_out[record['group']][start:start + record['repeats']],
+        )
+    ]
+    if not any(response is not None for response in filled):
+      continue
+    stats['deduplicated'] += sum(r is not None for r in filled)
+    responses[record['id']] = [
+        own if fanned is None else fanned
+        for own, fanned in zip(record_responses, filled)
+    ]
+    if checkpoint is not None:
+      checkpoint_lib.append_responses(checkpoint, record, 0, filled)
+
+
+async def run_request(
+    client,
+    backend,
+    item,
+    buckets,
+    max_retries,
+    rng,
+    stats,
+    responses,
+    cache=None,
+    checkpoint=None,
+):
+  """Sends a request from `iter_requests` and stores its responses.
+
+  The completed responses (see `decoding_settings.complete_response`) are
+  put in the record's slots of `responses`, in the cache and in the
+  checkpoint.
+  """
+  record, params, first, n, request = item
+  tokens = request_tokens(record, params, n)
+  choices = await send_with_retries(
+      client, backend, request, buckets, tokens, max_retries, rng, stats
+  )
+  stats['requests'] += 1
+  if choices is None:
+    stats['failed_requests'] += 1
+  texts = [
+      decoding_settings.complete_response(text, params, finish_reason)
+      for text, finish_reason in (choices or [])[:n]
+  ]
+  texts += [None] * (n - len(texts))
+  responses[record['id']][first:first + n] = texts
+  if cache is not None:
+    response_cache.put_responses(
+        cache,
+        backend['name'],
+        backend['model'],
+        params,
+        record['prompt'],
+        record['cache_repeat'] + first,
+        texts,
+    )
+  if checkpoint is not None:
+    checkpoint_lib.append_responses(checkpoint, record, first, texts)
+
+
+async def run_prompts_async(
+    prompts,
+    backend,
+    concurrency=64,
+    sampling_params=None,
+    max_retries=5,
+    seed=None,
+    cache=None,
+    checkpoint=None,
+    decoding=None,
+    ordering=None,
+    dedup_index=None,
+):
+  """Runs every prompt of a prompt dictionary against a backend.
+
+  Args:
+    prompts: A dict of prompt lists keyed by group name, as returned by the
+      prompt generators.
+    backend: A backend dict (see `backends`).
+    concurrency: The number of requests in flight (and the size of the
+      connection pool).
+    sampling_params: Generic sampling parameters, a dict or a function of the
+      prompt record (see `batch_requests.iter_batch_requests`).
+    max_retries: The retries of a request before it is given up on.
+    seed: An optional seed for the backoff jitter.
+    cache: An optional `response_cache` handle. Cached responses are served
+      without a request, and new ones are stored in it.
+    checkpoint: An optional `checkpoint` handle. Completed repeats are not
+      requested again, and every response is appended to it as it arrives,
+      so that an interrupted run can be resumed.
+    decoding: An optional mode of `decoding_settings.DECODING_MODES`, whose
+      stop sequence, token budget and prefill are applied under
+      `sampling_params`. Responses are stored completed (see
+      `decoding_settings.complete_response`).
+    ordering: An optional dispatch order of the prompt records (see
+      `request_ordering.order_records`).
+    dedup_index: An optional open `dedup_index` to register the prompts in.
+      Each repeat of a text is then requested once however many groups use
+      it, and its response fanned back out to all of them (see
+      `fan_out_canonical`).
+
+  Returns:
+    A tuple (responses, stats), where `responses` maps each group to its
+    per-prompt response texts (None for failed requests), in prompt order,
+    and `stats` counts the `requests`, `retries`, `failed_requests`,
+    `resumed`, `cache_hits` and `deduplicated` responses and `seconds`, and
+    lists the last `errors`.
+  """
+  records = list(prompt_records.iter_prompt_records(prompts, dedup_index))
+  number_cache_repeats(records)
+  stats = {
+      'requests': 0,
+      'retries': 0,
+      'failed_requests': 0,
+      'resumed': 0,
+      'cache_hits': 0,
+      'deduplicated': 0,
+      'errors': [],
+  }
+  record_responses = {}
+  requests = iter_requests(
+      request_ordering.order_records(records, ordering),
+      backend,
+      sampling_params,
+      decoding,
+      cache,
+      checkpoint,
+      record_responses,
+      stats,
+      None if dedup_index is None else set(),
+  )
+  queue = asyncio.Queue(maxsize=2 * concurrency)
+  buckets = {
+      'requests': make_token_bucket(backend['requests_per_second']),
+      'tokens': make_token_bucket(backend['tokens_per_second']),
+  }
+  client = http_client.make_client(max_connections_per_host=concurrency)
+  rng = random.Random(seed)
+
+  async def produce():
+    for item in requests:
+      await queue.put(item)
+    for _ in range(concurrency):
+      await queue.put(None)
+
+  async def work():
+    while (item := await queue.get()) is not None:
+      await run_request(
+          client,
+          backend,
+          item,
+          buckets,
+          max_retries,
+          rng,
+          stats,
+          record_responses,
+          cache,
+          checkpoint,
+      )
+
+  start = time.monotonic()
+  try:
+    await asyncio.gather(produce(), *(work() for _ in range(concurrency)))
+  finally:
+    await http_client.close_client(client)
+  if dedup_index is not None:
+    fan_out_canonical(records, record_responses, stats, checkpoint)
+  stats['seconds'] = time.monotonic() - start
+  stats['errors'] = stats['errors'][-10:]
+
+  responses = {}
+  for record in records:
+    responses.setdefault(record['group'], []).extend(
+        record_responses[record['id']]
+    )
+  return responses, stats
+
+
+def run_prompts(prompts, backend, **kwargs):
+  """Synchronous wrapper of `run_prompts_async`."""
+  return asyncio.run(run_prompts_async(prompts, backend, **kwargs))
+
@@ -0,0 +1,183 @@
+"""A simulated model backend that answers from the true distributions.
+
+The backend needs no network or model: it parses the distribution and the
+question out of each prompt's text and answers with the exact percentile, a
+real sample or the exact range probability, with configurable noise. It also
+simulates the latencies, errors, timeouts and malformed answers (e.g.,
+'<answer>8.4</aanswer>' or a truncated '<answer>8.4</answer') of real model
+APIs, so that inference drivers and scoring code can be load-tested offline.
+"""
+
+import asyncio
+import math
+import random
+
+import numpy as np
+
+from generation.corpus import prompt_parser
+from inference import backends
+
+# Malformed answer styles seen in model outputs (see the sample results)
+_MALFORMED_ANSWERS = (
+    '<answer>{}</answer',
+    '<answer>{}',
+    '<answer>{}</aanswer>',
+    '<answer>{}</stranswer>',
+    '<answer>{}</Answer>',
+    '```xml\n<answer>{}</answer>\n```',
+    'The answer is approximately {}.',
+)
+
+
+def oracle_answers(parsed, n, rng, noise=0.0, dist=None):
+  """Answers a parsed prompt `n` times from its true distribution.
+
+  Args:
+    parsed: A dict from `prompt_parser.parse_prompt`.
+    n: The number of answers.
+    rng: A `random.Random` to draw samples and noise from.
+    noise: The standard deviation of Gaussian noise added to the answers, as
+      a fraction of their range: of 100 percentile points, of probability 1,
+      or of the distribution's standard deviation for samples.
+    dist: The prompt's distribution, if already built by
+      `prompt_parser.prompt_distribution`.
+
+  Returns:
+    A list of the numeric answers.
+  """
+  dist = dist or prompt_parser.prompt_distribution(parsed)
+  if parsed['task'] == 'sampling':
+    answers = dist.ppf(np.array([rng.random() for _ in range(n)])).tolist()
+    scale = noise * float(dist.std())
+    return [a + rng.gauss(0, scale) if noise else a for a in answers]
+  answer = prompt_parser.true_answer(parsed, dist)
+  if parsed['task'] == 'percentiles':
+    scale, high = noise * 100, 100.0
+  else:
+    scale, high = noise, 1.0
+  if not noise:
+    return [answer] * n
+  return [min(max(answer + rng.gauss(0, scale), 0.0), high) for _ in range(n)]
+
+
+def _format_answer(task, answer):
+  if task == 'probabilities':
+    return f'{answer:.3f}'
+  return f'{answer:.2f}'
+
+
+def _as_provider_returns(response, request):
+  """Drops a request's prefill and stop sequences from a response.
+
+  Returns:
+    A (text, finish_reason) pair, whose finish reason is 'stop' if the
+    response was cut at a stop sequence and 'end' otherwise.
+  """
+  last_message = request['messages'][-1]
+  if last_message['role'] == 'assistant':
+    response = response.removeprefix(last_message['content'])
+  finish_reason = 'end'
+  for stop in request.get('params', {}).get('stop') or ():
+    if stop in response:
+      response = response.split(stop, 1)[0]
+      finish_reason = 'stop'
+  return response, finish_reason
+
+
+def simulated_backend(
+    noise=0.0,
+    latency=0.0,
+    latency_sigma=0.5,
+    error_rate=0.0,
+    timeout_rate=0.0,
+    timeout=30.0,
+    malformed_rate=0.0,
+    seed=None,
+    max_n=None,
+    requests_per_second=None,
+    tokens_per_second=None,
+):
+  """Creates a simulated backend answering from the true distributions.
+
+  It takes 'generic' requests (see `batch_requests.batch_request`), like
+  `local_server`, but answers in process without a connection. Like model
+  APIs, it continues a prefilled response and leaves out stop sequences.
+
+  Args:
+    noise: The answer noise (see `oracle_answers`).
+    latency: The median simulated latency of a request, in seconds.
+    latency_sigma: The sigma of the log-normal latency distribution.
+    error_rate: The fraction of requests that fail with a retryable 429 or
+      503.
+    timeout_rate: The fraction of requests that hang for `timeout` seconds
+      and then fail with a retryable timeout.
+    timeout: The simulated timeout, in seconds.
+    malformed_rate: The fraction of answers that are malformed (truncated
+      or wrongly closed tags, code fences, or prose).
+    seed: An optional seed of the simulation.
+    max_n: The most samples per request (None for no limit).
+    requests_per_second: An optional request rate limit for the runner.
+    tokens_per_second: An optional token rate limit for the runner.
+
+  Returns:
+    backend: The backend dict (see `backends`). Its `stats` count the
+    `requests`, `errors`, `timeouts`, `malformed` answers and `unparsed`
+    or unsupported prompts (answered with an empty response).
+  """
+  rng = random.Random(seed)
+  stats = {
+      'requests': 0,
+      'errors': 0,
+      'timeouts': 0,
+      'malformed': 0,
+      'unparsed': 0,
+  }
+  async def send(client, request):
+    del client  # Unused
+    stats['requests'] += 1
+    if latency:
+      await asyncio.sleep(rng.lognormvariate(math.log(latency), latency_sigma))
+    draw = rng.random()
+    if draw < timeout_rate:
+      stats['timeouts'] += 1
+      await asyncio.sleep(timeout)
+      raise backends.BackendError('Simulated timeout', retryable=True)
+    if draw < timeout_rate + error_rate:
+      stats['errors'] += 1
+      status = rng.choice((429, 503))
+      raise backends.BackendError(
+          f'Simulated {status}', retryable=True, retry_after=0
+      )
+
+    prompt = '\n\n'.join(
+        m['content'] for m in request['messages'] if m['role'] != 'assistant'
+    )
+    n = request.get('n', 1)
+    parsed = prompt_parser.parse_prompt(prompt)
+    try:
+      dist = parsed and prompt_parser.cached_distribution(parsed)
+    except ValueError:
+      dist = None
+    if dist is None:
+      stats['unparsed'] += 1
+      return [('', 'end')] * n
+    responses = []
+    for answer in oracle_answers(parsed, n, rng, noise, dist):
+      answer = _format_answer(parsed['task'], answer)
+      if rng.random() < malformed_rate:
+        stats['malformed'] += 1
+        responses.append(rng.choice(_MALFORMED_ANSWERS).format(answer))
+      else:
+        responses.append(f'<answer>{answer}</answer>')
+    return [_as_provider_returns(r, request) for r in responses]
+
+  return {
+      'name': 'simulated',
+      'provider': 'generic',
+      'model': 'simulated',
+      'max_n': max_n,
+      'requests_per_second': requests_per_second,
+      'tokens_per_second': tokens_per_second,
+      'send': send,
+      'stats': stats,
+  }
@@ -134,3 +134,135 @@ Question:
 Considering only values including and between the 1st percentile and the 99th percentile, what is the probability that a value from the outcome {outcome_num} distribution is between {lower_target_number} and {upper_target_number}?
 Answer:
 """
+
+
+# Shared-prefix layouts of the sampling templates. Every prompt of a sampling
+# group draws its own few-shot examples, so here the distribution description
+# comes before them. The prompts of a group then share a byte-identical prefix
+# up to the few-shot examples, which prefix-caching inference servers can reuse.
+shared_prefix_distribution_sample_prompt = """
+## You are an expert on statistics. Your task is to sample a number from a given distribution. Do not write any code or use any additional tools to perform the sampling. Answer with just a numerical response. Make sure your final answer is enclosed by xml tags <answer> and </answer>
+
+## Consider the following distribution:
+{distribution_description}
+
+## Here are some examples to help you understand the task:
+
+{few_shot_examples}
+
+## Instruction: Sample a number from the given distribution and output only the numerical value.
+"""
+
+
+shared_prefix_multinomial_distribution_sample_prompt = """
+## You are an expert on statistics. Your task is to sample a number from a given distribution. Do not write any code or use any additional tools to perform the sampling. Answer with just a numerical response. Make sure your final answer is enclosed by xml tags <answer> and </answer>
+
+## Consider the following distribution:
+{distribution_description}
+
+## Here are some examples to help you understand the task:
+
+{few_shot_examples}
+
+## Instruction: Sample a number from the outcome {outcome_num} distribution and output only the numerical value.
+"""
+
+
+# Compact layouts for the distribution stats shot modes. The few-shot examples
+# there all describe the distribution in question, so it is stated once, before
+# the examples, and the examples are listed as short question/answer pairs.
+compact_distribution_percentile_prompt = """
+## You are an expert on statistics. Your task is to estimate the percentile of a number within a specific distribution. Answer with just a numerical response from 0 to 100. Make sure your final answer is enclosed by xml tags <answer> and </answer>
+
+## Consider the following distribution:
+
+{distribution_description}
+
+## Here are some example questions about this distribution, with their answers:
+
+{few_shot_examples}
+
+## Here is your question:
+Question:
+What is the percentile of the value {target_number} within the provided distribution?
+Answer:
+"""
+
+
+compact_multinomial_distribution_percentile_prompt = """
+## You are an expert on statistics. Your task is to estimate the percentile of a number within a multinomial distribution. Answer with just a numerical response from 0 to 100. Make sure your final answer is enclosed by xml tags <answer> and </answer>
+
+## Consider the following distribution:
+{distribution_description}
+
+## Here are some example questions about this distribution, with their answers:
+
+{few_shot_examples}
+
+## Here is your question:
+Question:
+If outcome {outcome_num} appears {target_number} times, what is the percentile of this occurrence within the provided distribution?
+Answer:
+"""
+
+
+compact_distribution_sample_prompt = """
+## You are an expert on statistics. Your task is to sample a number from a given distribution. Do not write any code or use any additional tools to perform the sampling. Answer with just a numerical response. Make sure your final answer is enclosed by xml tags <answer> and </answer>
+
+## Consider the following distribution:
+{distribution_description}
+
+## Here are some example samples from this distribution:
+
+{few_shot_examples}
+
+## Instruction: Sample a number from the given distribution and output only the numerical value.
+"""
+
+
+compact_multinomial_distribution_sample_prompt = """
+## You are an expert on statistics. Your task is to sample a number from a given distribution. Do not write any code or use any additional tools to perform the sampling. Answer with just a numerical response. Make sure your final answer is enclosed by xml tags <answer> and </answer>
+
+## Consider the following distribution:
+{distribution_description}
+
+## Here are some example samples from the outcome {outcome_num} distribution:
+
+{few_shot_examples}
+
+## Instruction: Sample a number from the outcome {outcome_num} distribution and output only the numerical value.
+"""
+
+
+compact_distribution_probability_prompt = """
+## You are an expert on statistics. Your task is to estimate the probability of being in a range of values within a given distribution. Answer with just a numerical response from 0 to 1, representing the probability. Make sure your final answer is enclosed by xml tags <answer> and </answer>.
+
+## Consider the following distribution:
+{distribution_description}
+
+## Here are some example questions about this distribution, with their answers. They consider only values including and between the 1st percentile and the 99th percentile:
+
+{few_shot_examples}
+
+## Here is your question:
+Question:
+Considering only values including and between the 1st percentile and the 99th percentile, what is the probability that a value from the provided distribution is between {lower_target_number} and {upper_target_number}?
+Answer:
+"""
+
+
+compact_multinomial_distribution_probability_prompt = """
+## You are an expert on statistics. Your task is to estimate the probability of being in a range of values within a given distribution. Answer with just a numerical response from 0 to 1, representing the probability. Make sure your final answer is enclosed by xml tags <answer> and </answer>.
+
+## Consider the following distribution:
+{distribution_description}
+
+## Here are some example questions about this distribution, with their answers. They consider only values including and between the 1st percentile and the 99th percentile:
+
+{few_shot_examples}
+
+## Here is your question:
+Question:
+Considering only values including and between the 1st percentile and the 99th percentile, what is the probability that a value from the outcome {outcome_num} distribution is between {lower_target_number} and {upper_target_number}?
+Answer:
+"""